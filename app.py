@@ -1,14 +1,32 @@
-from flask import Flask, render_template, request, jsonify, session, send_from_directory
+from flask import (Flask, render_template, request, jsonify, session, send_from_directory, g,
+                   Response, stream_with_context)
 import os
+import time
+import signal
 import logging
+import tempfile
 import mysql.connector
 from datetime import datetime
 from decimal import Decimal
 from security_advanced import (
-    load_master_key, encrypt_secret, decrypt_secret, 
+    load_master_key, encrypt_secret, card_fingerprint, make_cvv_verifier,
     generate_otp, get_otp_expiry, verify_otp
 )
+from card_index import verify_card
 import json
+import model_server
+from model_server import start_model_server
+from model_registry import registry, ModelWatcher
+from db_pool import get_pool, get_write_pool
+from profile_cache import profile_cache
+from prediction_cache import prediction_cache
+from payment_dao import fetch_profile, fetch_card_limit, record_payment, DEBIT_CARD_LIMIT
+from txlog import txlog
+from otp_store import otp_store, OTP_LOOKUP_QUERY, APPROVE_OTP_TRANSACTION, MARK_OTP_VERIFIED
+from feature_store import feature_store, card_key
+from otp_dispatch import otp_dispatcher
+from shadow_scoring import shadow_scorer
+import metrics
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,12 +38,15 @@ app.secret_key = os.urandom(24)  # For session management
 # 1. Existing env `MODEL_PATH`
 # 2. `model.pkl` in project root
 # 3. `models/model.pkl` under project
+# A current version in the model registry (model_registry.py) overrides all three.
 model_path = os.environ.get('MODEL_PATH') or os.path.join(app.root_path, 'model.pkl')
 if not os.path.exists(model_path):
     alt = os.path.join(app.root_path, 'models', 'model.pkl')
     if os.path.exists(alt):
         model_path = alt
+model_path, model_version = registry.resolve(model_path)
 os.environ['MODEL_PATH'] = model_path
+os.environ['MODEL_VERSION'] = model_version or ''
 
 # Load encryption key
 MASTER_KEY = load_master_key()
@@ -33,38 +54,48 @@ if not MASTER_KEY:
     print("CRITICAL: master.key not found. Run security_advanced.py first.")
     exit(1)
 
-# Database connection
-def get_db_connection():
-    # Prefer PyMySQL (pure-Python) to avoid native driver instability in-process.
+# Warm the persistent scoring workers now so no request pays for a process
+# spawn or model load (MODEL_SERVER=0 restores one subprocess per prediction)
+if os.environ.get('MODEL_SERVER', '1') != '0':
+    start_model_server(model_path=model_path, version=model_version)
+
+# Swap in newly activated registry versions without a restart: polled, or at
+# once on SIGHUP (prefork_server.py watches the registry from its master instead)
+if os.environ.get('MODEL_REGISTRY_WATCH', '1') != '0':
+    model_watcher = ModelWatcher().start()
     try:
-        import pymysql
-        from pymysql.cursors import DictCursor
-        try:
-            conn = pymysql.connect(host='127.0.0.1', user='root', password='newpassword',
-                                   database='fraud_detection_system', port=3306,
-                                   connect_timeout=5, cursorclass=DictCursor)
-            return conn
-        except Exception:
-            logging.exception('pymysql connect failed, falling back')
-    except Exception:
-        logging.info('pymysql not available, will try mysql.connector')
+        signal.signal(signal.SIGHUP, model_watcher.check_now)
+    except (ValueError, AttributeError):
+        pass  # imported outside the main thread, or no SIGHUP on this platform
+
+# Candidate model for shadow/canary scoring, if SHADOW_MODEL_VERSION or SHADOW_MODEL_PATH is set
+shadow_scorer.start()
 
+# Database connection (pooled; conn.close() returns it to the pool)
+def get_db_connection():
     try:
-        # Fallback to mysql.connector
-        return mysql.connector.connect(
-            host="127.0.0.1",
-            user="root",
-            password="newpassword",
-            database="fraud_detection_system",
-            port=3306,
-            connection_timeout=5,
-            auth_plugin='mysql_native_password'
-        )
+        return get_pool().connection()
     except Exception as e:
         logging.exception(f"Database connection failed: {e}")
         return None
 
 
+def warm_feature_store(days):
+    """Load recent transactions into the rolling feature store"""
+    conn = get_db_connection()
+    if not conn:
+        return
+    try:
+        cursor = get_cursor(conn)
+        loaded = feature_store.load_recent(cursor, days)
+        cursor.close()
+        logging.info(f"Feature store warmed with {loaded} transactions from the last {days} days")
+    except Exception:
+        logging.exception("Feature store warm-up failed")
+    finally:
+        conn.close()
+
+
 def get_cursor(conn):
     """Return a cursor compatible with both mysql.connector and pymysql."""
     try:
@@ -73,6 +104,34 @@ def get_cursor(conn):
         # pymysql's cursor doesn't accept dictionary arg if DictCursor set at connect
         return conn.cursor()
 
+# Background threads: OTP delivery and sweeping, the transaction log writer and
+# feature store peers. The pre-fork master sets APP_BACKGROUND_THREADS=0 and
+# calls start_background_threads() in each worker instead: a thread running in
+# the master at fork() could hold a lock that would stay held in every child.
+APP_BACKGROUND_THREADS = os.environ.get('APP_BACKGROUND_THREADS', '1') == '1'
+
+
+def start_background_threads():
+    otp_dispatcher.start()
+    otp_store.start()
+    # Write-behind transaction log (TXLOG=1): replays what a crash left first
+    txlog.start()
+    feature_store.start()
+
+
+if APP_BACKGROUND_THREADS:
+    start_background_threads()
+elif txlog.enabled:
+    # Replay before warming, without starting the writer thread
+    try:
+        txlog.recover()
+    except Exception:
+        logging.exception("Transaction log replay failed; the workers will retry")
+
+FEATURE_STORE_WARM_DAYS = int(os.environ.get('FEATURE_STORE_WARM_DAYS', 7))
+if feature_store.enabled and FEATURE_STORE_WARM_DAYS > 0:
+    warm_feature_store(FEATURE_STORE_WARM_DAYS)
+
 # Get IP address from request
 def get_client_ip():
     ip = request.headers.get('X-Forwarded-For', '').split(',')[0].strip()
@@ -108,6 +167,7 @@ def favicon():
 # API: User Registration
 @app.route('/api/register', methods=['POST'])
 def register_user():
+    conn = None
     try:
         data = request.get_json()
         logging.info(f"register_user called with data: %s", data)
@@ -167,10 +227,12 @@ def register_user():
         
         # Insert user
         cursor.execute("""
-            INSERT INTO users (user_id, encrypted_card_no, encrypted_cvv, expiry_date, 
-                            email, city, mobile_number, registered_ip, card_limit, current_card_limit)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (user_id, encrypted_card, encrypted_cvv, expiry_date, email, city, 
+            INSERT INTO users (user_id, encrypted_card_no, encrypted_cvv, card_fingerprint,
+                            cvv_verifier, expiry_date, email, city, mobile_number,
+                            registered_ip, card_limit, current_card_limit)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (user_id, encrypted_card, encrypted_cvv, card_fingerprint(card_no, MASTER_KEY),
+              make_cvv_verifier(cvv, MASTER_KEY), expiry_date, email, city,
               mobile_number, ip_address, 100000.00, 100000.00))
         logging.info('User insert executed')
         
@@ -183,7 +245,7 @@ def register_user():
         
         conn.commit()
         cursor.close()
-        conn.close()
+        profile_cache.invalidate(user_id)
         
         return jsonify({
             "success": True,
@@ -201,10 +263,14 @@ def register_user():
             "success": False,
             "message": f"Registration failed: {str(e)}"
         }), 500
+    finally:
+        if conn:
+            conn.close()
 
 # API: Payment Processing
 @app.route('/api/payment', methods=['POST'])
 def process_payment():
+    conn = None
     try:
         data = request.get_json()
         logging.info(f"process_payment called with data: %s", data)
@@ -228,43 +294,45 @@ def process_payment():
                 "message": "All fields are required"
             }), 400
         
+        clock = metrics.stage_clock()
         conn = get_db_connection()
+        clock.mark('db_checkout')
         logging.info(f"DB connection returned: %s", conn)
         if not conn:
             return jsonify({"success": False, "message": "Database connection failed"}), 500
         
-        cursor = get_cursor(conn)
-        
-        # Get user data
-        cursor.execute("""
-            SELECT user_id, encrypted_card_no, encrypted_cvv, expiry_date, email, 
-                   city, mobile_number, registered_ip, current_card_limit
-            FROM users WHERE user_id = %s
-        """, (user_id,))
-        
-        user = cursor.fetchone()
-        
-        if not user:
+        # Get user data and behavior profile (served from memory when cached,
+        # otherwise one JOINed query)
+        profile = profile_cache.get(user_id)
+        if not profile:
+            profile = fetch_profile(conn, user_id)
+            if not profile:
+                return jsonify({
+                    "success": False,
+                    "message": "User ID not found. Please register first."
+                }), 404
+            profile_cache.put(user_id, *profile)
+        user, behavior = profile
+        clock.mark('profile_fetch')
+        
+        # Verify card information: cheap field checks first, then a constant-time
+        # check of card number and CVV against the stored fingerprint/verifier
+        if user['expiry_date'] != expiry_date or user['email'] != email:
             return jsonify({
                 "success": False,
-                "message": "User ID not found. Please register first."
-            }), 404
+                "message": "Wrong information. Please provide correct card details."
+            }), 400
         
-        # Decrypt and verify card details
-        decrypted_card = decrypt_secret(user['encrypted_card_no'], MASTER_KEY)
-        decrypted_cvv = decrypt_secret(user['encrypted_cvv'], MASTER_KEY)
+        card_ok = verify_card(user, card_no, cvv, MASTER_KEY)
+        clock.mark('verify_card')
         
-        if not decrypted_card or not decrypted_cvv:
+        if card_ok is None:
             return jsonify({
                 "success": False,
                 "message": "Card verification failed"
             }), 500
         
-        # Verify card information
-        if (decrypted_card != card_no or 
-            user['expiry_date'] != expiry_date or 
-            decrypted_cvv != cvv or 
-            user['email'] != email):
+        if not card_ok:
             return jsonify({
                 "success": False,
                 "message": "Wrong information. Please provide correct card details."
@@ -278,15 +346,6 @@ def process_payment():
                           str(user['current_card_limit'])
             }), 400
         
-        # Get user behavior
-        cursor.execute("""
-            SELECT usual_city, usual_state, avg_spend, total_transactions, 
-                   last_transaction_timestamp, last_transaction_location, last_transaction_ip
-            FROM user_behavior WHERE user_id = %s
-        """, (user_id,))
-        
-        behavior = cursor.fetchone()
-        
         # Use city name for location (transaction_location should be city name from frontend)
         current_city = transaction_location if transaction_location else 'Unknown'
         
@@ -302,61 +361,63 @@ def process_payment():
             ip_address=transaction_ip,
             user_data=user,
             behavior_data=behavior,
-            cursor=cursor
+            cursor=None
         )
+        clock.mark('detect_fraud')
+        
+        approved = fraud_result['status'] == 'Approved'
+        otp = None
+        if fraud_result['status'] == 'OTP_Sent':
+            otp = {'user_id': user_id, 'otp_code': generate_otp(), 'email': email,
+                   'mobile_number': user['mobile_number'], 'expires_at': get_otp_expiry()}
+        
+        # Save the transaction with its follow-up writes and commit, in one round
+        # trip where the driver allows it. An approval takes the amount off the
+        # limit only if it is still there: another payment may have spent it
+        # since the profile was read (or cached). With TXLOG=1 the transactions row
+        # of a payment without an OTP is logged locally and inserted in a later batch
+        transaction = {
+            'user_id': user_id, 'card_no_last4': card_no[-4:], 'amount': amount,
+            'transaction_location': current_city, 'transaction_ip': transaction_ip,
+            'device_id': device_id, 'status': fraud_result['status'],
+            'fraud_score': fraud_result['fraud_score'], 'ml_score': fraud_result.get('ml_score'),
+            'bla_score': fraud_result.get('bla_score'), 'prediction_method': fraud_result['method'],
+            'model_version': fraud_result.get('model_version'),
+            'otp_code': otp['otp_code'] if otp else None, 'timestamp': datetime.now(),
+        }
+        transaction_id = record_payment(
+            conn, transaction, debit=approved, otp=otp if otp_store.mirror else None,
+            behavior=(transaction_location, transaction_ip) if approved and behavior else None,
+            log=txlog if txlog.enabled else None)
+        clock.mark('db_write')
+        
+        if transaction_id is None:
+            profile_cache.invalidate(user_id)
+            return jsonify({
+                "success": False,
+                "message": "You exceed your card limit. Available limit: " +
+                          str(fetch_card_limit(conn, user_id) or 0)
+            }), 400
         
-        # Save transaction
-        cursor.execute("""
-            INSERT INTO transactions (user_id, card_no_last4, amount, transaction_location, 
-                                    transaction_ip, device_id, status, fraud_score, 
-                                    ml_score, bla_score, prediction_method, timestamp)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (user_id, card_no[-4:], amount, current_city, transaction_ip, 
-              device_id, fraud_result['status'], fraud_result['fraud_score'],
-              fraud_result.get('ml_score'), fraud_result.get('bla_score'),
-              fraud_result['method'], datetime.now()))
-        
-        transaction_id = cursor.lastrowid
-        
-        # Handle based on status
+        # Delivered asynchronously now that the transaction is committed
+        otp_message = None
+        if otp:
+            otp_store.put(transaction_id, user_id, amount, otp['otp_code'], otp['expires_at'])
+            otp_message = {
+                'transaction_id': transaction_id, 'user_id': user_id, 'otp_code': otp['otp_code'],
+                'email': email, 'mobile_number': user['mobile_number'],
+                'expires_at': otp['expires_at'].isoformat(),
+            }
+        
+        if otp_message:
+            otp_dispatcher.submit(otp_message)
+        shadow_scorer.submit(transaction_id, user_id, fraud_result)
+        feature_store.record(user_id, card_key(user, card_no), amount, current_city,
+                             transaction_ip, device_id)
         if fraud_result['status'] == 'Approved':
-            # Update card limit
-            new_limit = user['current_card_limit'] - amount
-            cursor.execute("UPDATE users SET current_card_limit = %s WHERE user_id = %s",
-                          (new_limit, user_id))
-            
-            # Update behavior
-            if behavior:
-                new_avg = ((behavior['avg_spend'] * behavior['total_transactions']) + amount) / (behavior['total_transactions'] + 1)
-                cursor.execute("""
-                    UPDATE user_behavior 
-                    SET avg_spend = %s, total_transactions = total_transactions + 1,
-                        last_transaction_timestamp = NOW(), last_transaction_location = %s,
-                        last_transaction_ip = %s
-                    WHERE user_id = %s
-                """, (new_avg, transaction_location, transaction_ip, user_id))
-        
-        elif fraud_result['status'] == 'OTP_Sent':
-            # Generate and send OTP
-            otp_code = generate_otp()
-            expires_at = get_otp_expiry()
-            
-            cursor.execute("""
-                UPDATE transactions SET otp_code = %s WHERE transaction_id = %s
-            """, (otp_code, transaction_id))
-            
-            cursor.execute("""
-                INSERT INTO otp_verification (transaction_id, user_id, otp_code, email, 
-                                             mobile_number, expires_at)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (transaction_id, user_id, otp_code, email, user['mobile_number'], expires_at))
-            
-            # TODO: Send OTP via email/SMS
-            logging.info(f"OTP {otp_code} generated for transaction {transaction_id}")
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+            profile_cache.record_approval(user_id, amount, transaction_location, transaction_ip)
+        clock.mark('post_commit')
+        metrics.PAYMENTS.inc(fraud_result['status'])
         
         return jsonify({
             "success": True,
@@ -384,26 +445,30 @@ def process_payment():
             "message": f"Payment processing failed: {str(e)}",
             "error_type": type(e).__name__
         }), 500
+    finally:
+        if conn:
+            conn.close()
 
 # API: Verify OTP
 @app.route('/api/verify_otp', methods=['POST'])
 def verify_otp_endpoint():
+    conn = None
     try:
         data = request.get_json()
         transaction_id = data.get('transaction_id')
         otp_code = data.get('otp_code', '').strip()
         
         conn = get_db_connection()
+        if not conn:
+            return jsonify({"success": False, "message": "Database connection failed"}), 500
         cursor = get_cursor(conn)
         
-        cursor.execute("""
-            SELECT otp_code, expires_at, user_id, amount, transaction_id
-            FROM otp_verification ov
-            JOIN transactions t ON ov.transaction_id = t.transaction_id
-            WHERE ov.transaction_id = %s
-        """, (transaction_id,))
-        
-        otp_data = cursor.fetchone()
+        # Pending OTPs are in memory; the database only has the ones this
+        # process did not issue (other workers, before a restart)
+        otp_data = entry = otp_store.get(transaction_id)
+        if otp_data is None and otp_store.mirror:
+            cursor.execute(OTP_LOOKUP_QUERY, (transaction_id,))
+            otp_data = cursor.fetchone()
         
         if not otp_data:
             return jsonify({"success": False, "message": "Transaction not found"}), 404
@@ -411,21 +476,34 @@ def verify_otp_endpoint():
         is_valid, message = verify_otp(otp_code, otp_data['otp_code'], otp_data['expires_at'])
         
         if is_valid:
-            # Update transaction status
-            cursor.execute("""
-                UPDATE transactions SET status = 'Approved', otp_verified = TRUE
-                WHERE transaction_id = %s
-            """, (transaction_id,))
-            
-            # Update card limit
-            cursor.execute("""
-                UPDATE users u
-                JOIN transactions t ON u.user_id = t.user_id
-                SET u.current_card_limit = u.current_card_limit - t.amount
-                WHERE t.transaction_id = %s
-            """, (transaction_id,))
-            
-            conn.commit()
+            # One approval per OTP here; the conditional UPDATE covers other processes
+            if entry is not None and otp_store.claim(transaction_id) is None:
+                return jsonify({"success": False, "message": "Transaction already verified"}), 400
+            try:
+                # Approve only a transaction still waiting for its OTP, so a repeated
+                # submit cannot debit the card twice
+                cursor.execute(APPROVE_OTP_TRANSACTION, (transaction_id,))
+                if cursor.rowcount != 1:
+                    conn.rollback()
+                    return jsonify({"success": False, "message": "Transaction already verified"}), 400
+                
+                # Update card limit, if it still covers the amount
+                cursor.execute(DEBIT_CARD_LIMIT, (otp_data['amount'], otp_data['user_id'], otp_data['amount']))
+                if cursor.rowcount != 1:
+                    conn.rollback()
+                    if entry is not None:
+                        otp_store.restore(entry)
+                    profile_cache.invalidate(otp_data['user_id'])
+                    return jsonify({"success": False, "message": "You exceed your card limit"}), 400
+                
+                if otp_store.mirror:
+                    cursor.execute(MARK_OTP_VERIFIED, (transaction_id,))
+                conn.commit()
+            except Exception:
+                if entry is not None:
+                    otp_store.restore(entry)
+                raise
+            profile_cache.record_limit_change(otp_data['user_id'], -otp_data['amount'])
             return jsonify({
                 "success": True,
                 "message": "OTP verified. Transaction approved."
@@ -442,6 +520,128 @@ def verify_otp_endpoint():
             "success": False,
             "message": f"OTP verification failed: {str(e)}"
         }), 500
+    finally:
+        if conn:
+            conn.close()
+
+# API: Bulk offline scoring (historical replay)
+@app.route('/api/score_batch', methods=['POST'])
+def score_batch():
+    """
+    Rescore transactions in bulk and stream the results back chunk by chunk.
+    Accepts either a multipart upload (`file` as CSV/JSONL/Parquet) or a JSON
+    body {"source": "sql", "start_id": 0, "end_id": 1000000}.
+    """
+    import batch_scoring
+
+    if request.files.get('file'):
+        options = request.form
+    else:
+        options = request.get_json(silent=True) or {}
+    out_format = options.get('format', 'jsonl')
+    if out_format not in ('jsonl', 'csv'):
+        return jsonify({"success": False, "message": "format must be jsonl or csv"}), 400
+    try:
+        chunk_size = int(options.get('chunk_size', batch_scoring.DEFAULT_CHUNK_SIZE))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "chunk_size must be an integer"}), 400
+    if chunk_size <= 0:
+        return jsonify({"success": False, "message": "chunk_size must be positive"}), 400
+    try:
+        start_id = int(options.get('start_id') or 0)
+        end_id = options.get('end_id')
+        end_id = int(end_id) if end_id not in (None, '') else None
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "message": "start_id and end_id must be integers"}), 400
+    if start_id < 0 or (end_id is not None and end_id < start_id):
+        return jsonify({"success": False, "message": "Need 0 <= start_id <= end_id"}), 400
+
+    conn = None
+    spool = None
+    if request.files.get('file'):
+        upload = request.files['file']
+        try:
+            in_format = options.get('input_format') or batch_scoring.infer_format(upload.filename)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+        # Spool to disk: the upload stream may be closed before the response is consumed
+        spool = tempfile.NamedTemporaryFile(suffix='.' + in_format, delete=False)
+        upload.save(spool)
+        spool.close()
+        chunks = batch_scoring.read_file_chunks(spool.name, in_format, chunk_size)
+    elif options.get('source') == 'sql':
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({"success": False, "message": "Database connection failed"}), 500
+        chunks = batch_scoring.read_sql_chunks(conn, start_id, end_id, chunk_size)
+    else:
+        return jsonify({"success": False, "message": "Provide a file or source=sql"}), 400
+
+    def generate():
+        try:
+            scored = batch_scoring.score_chunks(chunks, batch_scoring.server_predictor())
+            yield from batch_scoring.iter_encoded(scored, out_format)
+        finally:
+            if conn is not None:
+                conn.close()
+            if spool is not None:
+                os.unlink(spool.name)
+
+    mimetype = 'text/csv' if out_format == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+# Request latency per endpoint (sampled with METRICS_SAMPLE_RATE)
+@app.before_request
+def start_request_timer():
+    if metrics.sampled():
+        g.request_started = time.perf_counter()
+
+@app.teardown_request
+def stop_request_timer(exc=None):
+    started = g.pop('request_started', None)
+    if started is not None:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, request.endpoint or 'unknown')
+
+# Component stats exported as gauges at scrape time
+@metrics.register_collector
+def collect_component_stats():
+    samples = []
+    for name, value in get_pool().stats().items():
+        samples.append(('db_pool_' + name, 'gauge', f'Connection pool {name}', None, value))
+    if get_write_pool() is not None:
+        for name, value in get_write_pool().stats().items():
+            samples.append(('db_write_pool_' + name, 'gauge', f'Write connection pool {name}', None, value))
+    for name, value in profile_cache.stats().items():
+        samples.append(('profile_cache_' + name, 'gauge', f'Profile cache {name}', None, value))
+    for name, value in prediction_cache.stats().items():
+        samples.append(('prediction_cache_' + name, 'gauge', f'Prediction cache {name}', None, value))
+    for name, value in otp_dispatcher.stats().items():
+        samples.append(('otp_' + name, 'gauge', f'OTP dispatcher {name}', None, value))
+    for name, value in otp_store.stats().items():
+        samples.append(('otp_store_' + name, 'gauge', f'OTP store {name}', None, value))
+    if shadow_scorer.enabled:
+        for name, value in shadow_scorer.stats().items():
+            samples.append(('shadow_' + name, 'gauge', f'Shadow scoring {name}', None, value))
+    if txlog.enabled:
+        for name, value in txlog.stats().items():
+            samples.append(('txlog_' + name, 'gauge', f'Transaction log {name}', None, value))
+    for name, value in feature_store.stats().items():
+        samples.append(('feature_store_' + name, 'gauge', f'Feature store {name}', None, value))
+    import fraud_detection_engine
+    if fraud_detection_engine._batcher is not None:
+        for name, value in fraud_detection_engine._batcher.stats().items():
+            samples.append(('predict_batcher_' + name, 'gauge', f'Prediction batcher {name}', None, value))
+    server = model_server._server
+    if server is not None:
+        samples.append(('model_server_restarts', 'gauge', 'Model workers replaced', None, server.restarts))
+        samples.append(('model_reloads', 'gauge', 'Model versions swapped in', None, server.reloads))
+        samples.append(('model_info', 'gauge', 'Model currently serving', {'version': server.version or ''}, 1))
+    return samples
+
+# Prometheus scrape endpoint
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # Error handler for all exceptions
 @app.errorhandler(Exception)
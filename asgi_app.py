@@ -0,0 +1,528 @@
+"""
+Async (ASGI) serving mode for the fraud detection API.
+
+Serves the same routes as app.py on Starlette: MySQL through an aiomysql pool,
+predictions through an asyncio client for the persistent scoring workers, and
+OTPs queued to the background dispatcher without blocking. Payments waiting on
+the database or the model are suspended coroutines, not parked threads, so a
+few threads can carry thousands of in-flight requests.
+
+    pip install starlette aiomysql uvicorn
+    python asgi_app.py                  # uvicorn on ASGI_HOST:ASGI_PORT
+    uvicorn asgi_app:app --workers 4    # each worker runs its own model pool
+
+Bulk rescoring (/api/score_batch) is CPU-bound and stays on the Flask app.
+"""
+import os
+import time
+import signal
+import asyncio
+import logging
+import contextlib
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from pymysql.err import IntegrityError
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, FileResponse, Response
+from starlette.routing import Route
+
+import metrics
+from security_advanced import (
+    load_master_key, encrypt_secret, card_fingerprint, make_cvv_verifier,
+    generate_otp, get_otp_expiry, verify_otp
+)
+from card_index import verify_card
+from db_pool import create_async_pool
+from async_model_client import AsyncModelServer, AsyncBatcher
+from model_registry import registry, probe_rows, MODEL_REGISTRY_POLL
+from fraud_detection_engine import prepare_fraud_check, finish_fraud_check
+from profile_cache import profile_cache
+from prediction_cache import prediction_cache
+from payment_dao import fetch_profile_async, fetch_card_limit_async, record_payment_async, DEBIT_CARD_LIMIT
+from txlog import txlog
+from otp_store import otp_store, OTP_LOOKUP_QUERY, APPROVE_OTP_TRANSACTION, MARK_OTP_VERIFIED
+from feature_store import feature_store, card_key, RECENT_TRANSACTIONS_QUERY, FEATURE_STORE_WARM_BATCH
+from otp_dispatch import otp_dispatcher
+from shadow_scoring import shadow_scorer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TEMPLATES_DIR = os.path.join(ROOT, 'templates')
+ASGI_HOST = os.environ.get('ASGI_HOST', '127.0.0.1')
+ASGI_PORT = int(os.environ.get('ASGI_PORT', 8000))
+ASGI_WORKERS = int(os.environ.get('ASGI_WORKERS', 1))
+FEATURE_STORE_WARM_DAYS = int(os.environ.get('FEATURE_STORE_WARM_DAYS', 7))
+
+# Same model resolution as app.py: registry CURRENT, MODEL_PATH, ./model.pkl, ./models/model.pkl
+MODEL_PATH = os.environ.get('MODEL_PATH') or os.path.join(ROOT, 'model.pkl')
+if not os.path.exists(MODEL_PATH) and os.path.exists(os.path.join(ROOT, 'models', 'model.pkl')):
+    MODEL_PATH = os.path.join(ROOT, 'models', 'model.pkl')
+MODEL_PATH, MODEL_VERSION = registry.resolve(MODEL_PATH)
+os.environ['MODEL_PATH'] = MODEL_PATH
+os.environ['MODEL_VERSION'] = MODEL_VERSION or ''
+
+MASTER_KEY = load_master_key()
+if not MASTER_KEY:
+    print("CRITICAL: master.key not found. Run security_advanced.py first.")
+    exit(1)
+
+
+def error(message, status_code, **extra):
+    return JSONResponse({"success": False, "message": message, **extra}, status_code=status_code)
+
+
+def get_client_ip(request):
+    ip = request.headers.get('X-Forwarded-For', '').split(',')[0].strip()
+    if not ip:
+        ip = request.headers.get('X-Real-IP', '')
+    if not ip:
+        ip = request.client.host if request.client else '127.0.0.1'
+    return ip
+
+
+async def fetchone(cursor, sql, params):
+    await cursor.execute(sql, params)
+    return await cursor.fetchone()
+
+
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+# Pages
+async def home(request):
+    return FileResponse(os.path.join(TEMPLATES_DIR, 'home.html'))
+
+
+async def signup_page(request):
+    return FileResponse(os.path.join(TEMPLATES_DIR, 'signup.html'))
+
+
+async def payment_page(request):
+    return FileResponse(os.path.join(TEMPLATES_DIR, 'payment.html'))
+
+
+async def favicon(request):
+    ico_path = os.path.join(ROOT, 'static', 'favicon.ico')
+    if os.path.exists(ico_path):
+        return FileResponse(ico_path)
+    return Response(status_code=204)
+
+
+# API: User Registration
+async def register_user(request):
+    data = await read_json(request)
+    if data is None:
+        return error("Invalid JSON body", 400)
+    user_id = data.get('user_id', '').strip()
+    card_no = data.get('card_no', '').strip()
+    expiry_date = data.get('expiry_date', '').strip()
+    cvv = data.get('cvv', '').strip()
+    email = data.get('email', '').strip().lower()
+    city = data.get('city', '').strip()
+    mobile_number = data.get('mobile_number', '').strip()
+
+    if not all([user_id, card_no, expiry_date, cvv, email, city, mobile_number]):
+        return error("All fields are required", 400)
+    ip_address = get_client_ip(request)
+
+    try:
+        async with request.app.state.db.acquire() as conn:
+            async with conn.cursor() as cursor:
+                existing = await fetchone(
+                    cursor, "SELECT user_id, email FROM users WHERE user_id = %s OR email = %s",
+                    (user_id, email))
+                if existing:
+                    if existing['user_id'] == user_id:
+                        return error("User ID already exists. Please try another one.", 400)
+                    if existing['email'] == email:
+                        return error("Email already exists. Please try another one.", 400)
+
+                encrypted_card = encrypt_secret(card_no, MASTER_KEY)
+                encrypted_cvv = encrypt_secret(cvv, MASTER_KEY)
+                if not encrypted_card or not encrypted_cvv:
+                    return error("Encryption failed", 500)
+
+                try:
+                    await cursor.execute("""
+                        INSERT INTO users (user_id, encrypted_card_no, encrypted_cvv, card_fingerprint,
+                                        cvv_verifier, expiry_date, email, city, mobile_number,
+                                        registered_ip, card_limit, current_card_limit)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    """, (user_id, encrypted_card, encrypted_cvv, card_fingerprint(card_no, MASTER_KEY),
+                          make_cvv_verifier(cvv, MASTER_KEY), expiry_date, email, city,
+                          mobile_number, ip_address, 100000.00, 100000.00))
+                    await cursor.execute("""
+                        INSERT INTO user_behavior (user_id, usual_city, usual_state, avg_spend, total_transactions)
+                        VALUES (%s, %s, %s, %s, %s)
+                    """, (user_id, city, city, 0.00, 0))
+                    await conn.commit()
+                except BaseException:
+                    await conn.rollback()
+                    raise
+        profile_cache.invalidate(user_id)
+        return JSONResponse({"success": True, "message": "Registration successful! You can now make payments."})
+    except IntegrityError:
+        return error("User ID or Email already exists", 400)
+    except Exception as e:
+        logging.exception("Registration error")
+        return error(f"Registration failed: {str(e)}", 500)
+
+
+# API: Payment Processing
+async def predict_fraud_proba(state, row):
+    """(fraud probability, model version), from the prediction cache when this model just scored the row."""
+    model = state.model
+
+    async def score():
+        ml_prob, model_version = await state.batcher.predict_proba(row)
+        return None if ml_prob is None else (ml_prob, model_version)
+
+    identity = (model.model_path, model.version, model.reloads)
+    return await prediction_cache.get_or_compute_async(identity, row, score) or (None, None)
+
+
+async def process_payment(request):
+    data = await read_json(request)
+    if data is None:
+        return error("Invalid JSON body", 400)
+    try:
+        user_id = data.get('user_id', '').strip()
+        card_no = data.get('card_no', '').strip()
+        expiry_date = data.get('expiry_date', '').strip()
+        cvv = data.get('cvv', '').strip()
+        email = data.get('email', '').strip().lower()
+        amount = Decimal(str(data.get('amount', 0)))
+    except (ValueError, InvalidOperation, AttributeError) as e:
+        return error(f"Invalid input: {str(e)}", 400)
+
+    transaction_location = data.get('location', '')
+    transaction_ip = get_client_ip(request)
+    device_id = data.get('device_id', '')
+
+    if not all([user_id, card_no, expiry_date, cvv, email, amount > 0]):
+        return error("All fields are required", 400)
+
+    try:
+        clock = metrics.stage_clock()
+        async with request.app.state.db.acquire() as conn:
+            clock.mark('db_checkout')
+            async with conn.cursor() as cursor:
+                # User and behavior profile (served from memory when cached, else one JOINed query)
+                profile = profile_cache.get(user_id)
+                if not profile:
+                    profile = await fetch_profile_async(cursor, user_id)
+                    if not profile:
+                        return error("User ID not found. Please register first.", 404)
+                    profile_cache.put(user_id, *profile)
+                user, behavior = profile
+                clock.mark('profile_fetch')
+
+                if user['expiry_date'] != expiry_date or user['email'] != email:
+                    return error("Wrong information. Please provide correct card details.", 400)
+                card_ok = verify_card(user, card_no, cvv, MASTER_KEY)
+                clock.mark('verify_card')
+                if card_ok is None:
+                    return error("Card verification failed", 500)
+                if not card_ok:
+                    return error("Wrong information. Please provide correct card details.", 400)
+                if user['current_card_limit'] < amount:
+                    return error("You exceed your card limit. Available limit: " +
+                                 str(user['current_card_limit']), 400)
+
+                current_city = transaction_location if transaction_location else 'Unknown'
+                check = prepare_fraud_check(user_id, card_no, amount, current_city, transaction_ip,
+                                            user, behavior)
+                canary = shadow_scorer.is_canary(user_id)
+                if canary:
+                    ml_prob, model_version = await asyncio.get_running_loop().run_in_executor(
+                        None, shadow_scorer.predict, check['features'])
+                    canary = ml_prob is not None  # failed candidate: production decides
+                if not canary:
+                    ml_prob, model_version = await predict_fraud_proba(request.app.state, check['features'])
+                fraud_result = finish_fraud_check(check, ml_prob, model_version)
+                fraud_result['canary'] = canary
+                fraud_result['check'] = check
+                clock.mark('detect_fraud')
+
+                approved = fraud_result['status'] == 'Approved'
+                otp = None
+                if fraud_result['status'] == 'OTP_Sent':
+                    otp = {'user_id': user_id, 'otp_code': generate_otp(), 'email': email,
+                           'mobile_number': user['mobile_number'], 'expires_at': get_otp_expiry()}
+                transaction = {
+                    'user_id': user_id, 'card_no_last4': card_no[-4:], 'amount': amount,
+                    'transaction_location': current_city, 'transaction_ip': transaction_ip,
+                    'device_id': device_id, 'status': fraud_result['status'],
+                    'fraud_score': fraud_result['fraud_score'], 'ml_score': fraud_result.get('ml_score'),
+                    'bla_score': fraud_result.get('bla_score'), 'prediction_method': fraud_result['method'],
+                    'model_version': fraud_result.get('model_version'),
+                    'otp_code': otp['otp_code'] if otp else None, 'timestamp': datetime.now(),
+                }
+                try:
+                    # Transaction, limit debit (only if the limit still covers it), behavior
+                    # update or OTP row, and the commit: one round trip on aiomysql. With
+                    # TXLOG=1 a row without an OTP is logged locally and inserted later
+                    transaction_id = await record_payment_async(
+                        conn, cursor, transaction, debit=approved, otp=otp if otp_store.mirror else None,
+                        behavior=(transaction_location, transaction_ip) if approved and behavior else None,
+                        log=txlog if txlog.enabled else None)
+                    clock.mark('db_write')
+                    if transaction_id is None:
+                        profile_cache.invalidate(user_id)
+                        limit = await fetch_card_limit_async(cursor, user_id)
+                        await conn.rollback()
+                        return error("You exceed your card limit. Available limit: " + str(limit or 0), 400)
+                except BaseException:
+                    await conn.rollback()
+                    raise
+
+        otp_message = None
+        if otp:
+            otp_store.put(transaction_id, user_id, amount, otp['otp_code'], otp['expires_at'])
+            otp_message = {
+                'transaction_id': transaction_id, 'user_id': user_id, 'otp_code': otp['otp_code'],
+                'email': email, 'mobile_number': user['mobile_number'],
+                'expires_at': otp['expires_at'].isoformat(),
+            }
+        # submit() only enqueues, so it is safe to call on the event loop
+        if otp_message:
+            otp_dispatcher.submit(otp_message)
+        shadow_scorer.submit(transaction_id, user_id, fraud_result)
+        feature_store.record(user_id, card_key(user, card_no), amount, current_city,
+                             transaction_ip, device_id)
+        if fraud_result['status'] == 'Approved':
+            profile_cache.record_approval(user_id, amount, transaction_location, transaction_ip)
+        clock.mark('post_commit')
+        metrics.PAYMENTS.inc(fraud_result['status'])
+
+        return JSONResponse({
+            "success": True,
+            "status": fraud_result['status'],
+            "message": fraud_result['message'],
+            "fraud_score": fraud_result['fraud_score'],
+            "transaction_id": transaction_id,
+            "otp_required": fraud_result['status'] == 'OTP_Sent'
+        })
+    except Exception as e:
+        logging.exception("Payment processing error")
+        return error(f"Payment processing failed: {str(e)}", 500,
+                     status="Error", error_type=type(e).__name__)
+
+
+# API: Verify OTP
+async def verify_otp_endpoint(request):
+    data = await read_json(request)
+    if data is None:
+        return error("Invalid JSON body", 400)
+    transaction_id = data.get('transaction_id')
+    otp_code = str(data.get('otp_code', '')).strip()
+    try:
+        # Pending OTPs are in memory: no database round trip to check one
+        otp_data = entry = otp_store.get(transaction_id)
+        if otp_data is None and otp_store.mirror:
+            # Issued by another process, or before a restart
+            async with request.app.state.db.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    otp_data = await fetchone(cursor, OTP_LOOKUP_QUERY, (transaction_id,))
+                await conn.rollback()
+        if not otp_data:
+            return error("Transaction not found", 404)
+
+        is_valid, message = verify_otp(otp_code, otp_data['otp_code'], otp_data['expires_at'])
+        if not is_valid:
+            return error(message, 400)
+        # One approval per OTP here; the conditional UPDATE covers other processes
+        if entry is not None and otp_store.claim(transaction_id) is None:
+            return error("Transaction already verified", 400)
+        approved = False
+        try:
+            async with request.app.state.db.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    try:
+                        # Only a transaction still waiting for its OTP: a repeated submit must not debit twice
+                        await cursor.execute(APPROVE_OTP_TRANSACTION, (transaction_id,))
+                        if cursor.rowcount != 1:
+                            await conn.rollback()
+                            entry = None  # approved by another request: nothing to put back
+                            return error("Transaction already verified", 400)
+                        await cursor.execute(DEBIT_CARD_LIMIT,
+                                             (otp_data['amount'], otp_data['user_id'], otp_data['amount']))
+                        if cursor.rowcount != 1:
+                            await conn.rollback()
+                            profile_cache.invalidate(otp_data['user_id'])
+                            return error("You exceed your card limit", 400)
+                        if otp_store.mirror:
+                            await cursor.execute(MARK_OTP_VERIFIED, (transaction_id,))
+                        await conn.commit()
+                        approved = True
+                    except BaseException:
+                        await conn.rollback()
+                        raise
+        finally:
+            if not approved and entry is not None:
+                otp_store.restore(entry)
+        profile_cache.record_limit_change(otp_data['user_id'], -otp_data['amount'])
+        return JSONResponse({"success": True, "message": "OTP verified. Transaction approved."})
+    except Exception as e:
+        logging.exception("OTP verification error")
+        return error(f"OTP verification failed: {str(e)}", 500)
+
+
+# Prometheus scrape endpoint
+async def metrics_endpoint(request):
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+async def warm_feature_store(pool, days):
+    """Load recent transactions into the rolling feature store"""
+    try:
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                loaded = last_id = 0
+                while True:
+                    await cursor.execute(RECENT_TRANSACTIONS_QUERY, (last_id, days, FEATURE_STORE_WARM_BATCH))
+                    rows = await cursor.fetchall()
+                    loaded += feature_store.load_rows(rows)
+                    if len(rows) < FEATURE_STORE_WARM_BATCH:
+                        break
+                    last_id = rows[-1]['transaction_id']
+            await conn.rollback()
+        logging.info(f"Feature store warmed with {loaded} transactions from the last {days} days")
+    except Exception:
+        logging.exception("Feature store warm-up failed")
+
+
+async def watch_registry(model, wake):
+    """Swap newly activated registry versions into the scoring pool (polled or on SIGHUP)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await asyncio.wait_for(wake.wait(), MODEL_REGISTRY_POLL if MODEL_REGISTRY_POLL > 0 else None)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+        try:
+            model_version = registry.poll()
+            if model_version is None:
+                continue
+            logging.info(f"Model version {model_version.version} activated, swapping in")
+            await loop.run_in_executor(None, registry.verify, model_version)
+            await model.reload(model_version.path, model_version.version, probe_rows())
+        except Exception:
+            logging.exception("Model reload failed; keeping the current model")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    app.state.db = await create_async_pool()
+    app.state.model = AsyncModelServer(model_path=MODEL_PATH, version=MODEL_VERSION)
+    if os.environ.get('MODEL_SERVER', '1') != '0':
+        await app.state.model.start()
+    app.state.batcher = AsyncBatcher(app.state.model)
+    otp_dispatcher.start()
+    otp_store.start()
+    shadow_scorer.start()
+    # Replays what a crash left in the transaction log, so before warming
+    await asyncio.get_running_loop().run_in_executor(None, txlog.start)
+    if feature_store.enabled and FEATURE_STORE_WARM_DAYS > 0:
+        await warm_feature_store(app.state.db, FEATURE_STORE_WARM_DAYS)
+    feature_store.start()
+
+    @metrics.register_collector
+    def collect_component_stats():
+        samples = [
+            ('db_pool_size', 'gauge', 'Connection pool size', None, app.state.db.size),
+            ('db_pool_idle', 'gauge', 'Connection pool idle', None, app.state.db.freesize),
+            ('model_server_restarts', 'gauge', 'Model workers replaced', None, app.state.model.restarts),
+            ('model_reloads', 'gauge', 'Model versions swapped in', None, app.state.model.reloads),
+            ('model_info', 'gauge', 'Model currently serving', {'version': app.state.model.version or ''}, 1),
+        ]
+        for name, value in profile_cache.stats().items():
+            samples.append(('profile_cache_' + name, 'gauge', f'Profile cache {name}', None, value))
+        for name, value in prediction_cache.stats().items():
+            samples.append(('prediction_cache_' + name, 'gauge', f'Prediction cache {name}', None, value))
+        for name, value in otp_dispatcher.stats().items():
+            samples.append(('otp_' + name, 'gauge', f'OTP dispatcher {name}', None, value))
+        for name, value in otp_store.stats().items():
+            samples.append(('otp_store_' + name, 'gauge', f'OTP store {name}', None, value))
+        if shadow_scorer.enabled:
+            for name, value in shadow_scorer.stats().items():
+                samples.append(('shadow_' + name, 'gauge', f'Shadow scoring {name}', None, value))
+        if txlog.enabled:
+            for name, value in txlog.stats().items():
+                samples.append(('txlog_' + name, 'gauge', f'Transaction log {name}', None, value))
+        for name, value in feature_store.stats().items():
+            samples.append(('feature_store_' + name, 'gauge', f'Feature store {name}', None, value))
+        for name, value in app.state.batcher.stats().items():
+            samples.append(('predict_batcher_' + name, 'gauge', f'Prediction batcher {name}', None, value))
+        return samples
+
+    watcher = None
+    if os.environ.get('MODEL_REGISTRY_WATCH', '1') != '0':
+        wake = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, wake.set)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            pass  # no SIGHUP on this platform
+        watcher = asyncio.ensure_future(watch_registry(app.state.model, wake))
+
+    try:
+        yield
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        await app.state.model.stop()
+        await asyncio.get_running_loop().run_in_executor(None, txlog.close)
+        feature_store.close()
+        app.state.db.close()
+        await app.state.db.wait_closed()
+
+
+class RequestTimer:
+    """ASGI middleware recording http_request_seconds per route (sampled)."""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.names = {route.path: route.name for route in routes}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not metrics.sampled():
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                            self.names.get(scope.get('path'), 'unknown'))
+
+
+routes = [
+    Route('/', home),
+    Route('/signup', signup_page),
+    Route('/payment', payment_page),
+    Route('/favicon.ico', favicon),
+    Route('/api/register', register_user, methods=['POST']),
+    Route('/api/payment', process_payment, methods=['POST']),
+    Route('/api/verify_otp', verify_otp_endpoint, methods=['POST']),
+    Route('/metrics', metrics_endpoint),
+]
+
+app = RequestTimer(Starlette(routes=routes, lifespan=lifespan), routes)
+
+
+def main():
+    import uvicorn
+    print(f"Fraud Detection System (ASGI) is LIVE at http://{ASGI_HOST}:{ASGI_PORT}")
+    uvicorn.run('asgi_app:app', host=ASGI_HOST, port=ASGI_PORT, workers=ASGI_WORKERS,
+                log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""
+Asyncio client for the persistent `predict_worker.py --serve` processes.
+
+Same frame protocol and restart behaviour as model_server.ModelServer, but
+requests are awaited on the event loop instead of blocking a thread, and
+concurrent rows are coalesced into one predict_proba call per batch window
+(PREDICT_BATCH_WINDOW_MS / PREDICT_BATCH_MAX_ROWS, as in batching.py).
+"""
+import os
+import sys
+import json
+import asyncio
+import logging
+
+import metrics
+from model_server import (
+    WORKER_SCRIPT, WorkerError, DEFAULT_WORKERS, DEFAULT_TIMEOUT, STARTUP_TIMEOUT, RESPAWN_BACKOFF_MAX
+)
+from batching import DEFAULT_WINDOW_MS, DEFAULT_MAX_ROWS
+from predict_worker import FRAME_HEADER
+
+
+async def read_frame_async(reader):
+    """Read one length-prefixed JSON frame; returns None on EOF."""
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        (length,) = FRAME_HEADER.unpack(header)
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return json.loads(body.decode('utf-8'))
+
+
+def encode_frame(obj):
+    body = json.dumps(obj).encode('utf-8')
+    return FRAME_HEADER.pack(len(body)) + body
+
+
+class _AsyncWorker:
+    def __init__(self, model_path, version=None, generation=0):
+        self.model_path = model_path
+        self.version = version
+        self.generation = generation
+        self.proc = None
+        self.info = {}
+
+    async def start(self, timeout):
+        env = dict(os.environ)
+        env['MODEL_PATH'] = self.model_path
+        env['MODEL_VERSION'] = self.version or ''
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, WORKER_SCRIPT, '--serve',
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, env=env
+        )
+        asyncio.ensure_future(self._drain_stderr())
+        self.info = await self._receive(timeout)
+        if not self.info.get('ready'):
+            raise WorkerError(f"unexpected handshake from predict_worker: {self.info}")
+        if self.info.get('error'):
+            logging.error(f"predict_worker {self.proc.pid} started without a model: {self.info['error']}")
+        return self
+
+    async def warm(self, probe, timeout):
+        """Probe prediction before a reloaded worker takes traffic (see ModelServer.reload)."""
+        if self.info.get('error'):
+            raise WorkerError(self.info['error'])
+        if not probe:
+            return self
+        expected = self.info.get('n_features_in')
+        if expected is not None and expected != len(probe[0]):
+            raise WorkerError(f"model expects {expected} features, probe has {len(probe[0])}")
+        response = await self.request({'features': probe, 'action': 'predict_proba'}, timeout)
+        if 'error' in response:
+            raise WorkerError(f"probe prediction failed: {response['error']}")
+        return self
+
+    async def _drain_stderr(self):
+        while True:
+            line = await self.proc.stderr.readline()
+            if not line:
+                break
+            logging.warning("predict_worker %s stderr: %s", self.proc.pid,
+                            line.decode('utf-8', 'replace').rstrip())
+
+    async def _receive(self, timeout):
+        try:
+            frame = await asyncio.wait_for(read_frame_async(self.proc.stdout), timeout)
+        except asyncio.TimeoutError:
+            raise WorkerError(f"predict_worker {self.proc.pid} timed out after {timeout}s")
+        if frame is None:
+            raise WorkerError(f"predict_worker {self.proc.pid} exited with code {self.proc.returncode}")
+        return frame
+
+    async def request(self, payload, timeout):
+        try:
+            self.proc.stdin.write(encode_frame(payload))
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError, OSError) as e:
+            raise WorkerError(f"predict_worker {self.proc.pid} is gone: {e}")
+        return await self._receive(timeout)
+
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except Exception:
+            pass
+
+
+class AsyncModelServer:
+    """Pool of scoring processes driven from the event loop."""
+
+    def __init__(self, model_path=None, size=None, timeout=None, version=None):
+        self.model_path = model_path or os.environ.get('MODEL_PATH', 'model.pkl')
+        self.version = version or os.environ.get('MODEL_VERSION') or None
+        self.size = size or DEFAULT_WORKERS
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self._idle = None
+        self._closed = False
+        self.generation = 0
+        self.restarts = 0
+        self.reloads = 0
+
+    async def start(self):
+        if self._idle is not None:
+            return self
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            await self._spawn()
+        logging.info(f"Async model server started with {self.size} workers for {self.model_path}")
+        return self
+
+    async def _spawn(self):
+        delay = 1
+        while not self._closed:
+            worker = _AsyncWorker(self.model_path, self.version, self.generation)
+            try:
+                await worker.start(STARTUP_TIMEOUT)
+            except (WorkerError, OSError):
+                logging.exception(f"predict_worker failed to start; retrying in {delay}s")
+                worker.kill()
+                # Same backoff as model_server: an import or OOM failure will not clear in a second
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RESPAWN_BACKOFF_MAX)
+                continue
+            if self._closed or worker.generation != self.generation:
+                worker.kill()
+            else:
+                self._idle.put_nowait(worker)
+            return
+
+    def _replace(self, worker):
+        worker.kill()
+        self.restarts += 1
+        asyncio.ensure_future(self._spawn())
+
+    async def request(self, payload, timeout=None):
+        """Send one request to an idle worker and return its decoded response."""
+        await self.start()
+        timeout = timeout or self.timeout
+        while True:
+            try:
+                worker = await asyncio.wait_for(self._idle.get(), timeout)
+            except asyncio.TimeoutError:
+                raise WorkerError(f"no scoring worker available within {timeout}s")
+            if worker.generation != self.generation:
+                worker.kill()  # replaced by a reload
+                continue
+            if worker.alive():
+                break
+            # Died while idle: replace it and try the next one
+            self._replace(worker)
+        try:
+            response = await worker.request(payload, timeout)
+        except (WorkerError, asyncio.CancelledError):
+            # Crashed, hung or abandoned mid-frame: never hand this process out again
+            self._replace(worker)
+            raise
+        if worker.generation == self.generation:
+            self._idle.put_nowait(worker)
+        else:
+            worker.kill()
+        response['model_version'] = worker.version
+        return response
+
+    async def reload(self, model_path, version=None, probe=None):
+        """Start, pre-warm and swap in workers for another model (see ModelServer.reload)."""
+        await self.start()
+        generation = self.generation + 1
+        workers = [_AsyncWorker(model_path, version, generation) for _ in range(self.size)]
+        try:
+            for worker in workers:
+                await worker.start(STARTUP_TIMEOUT)
+                await worker.warm(probe, STARTUP_TIMEOUT)
+        except (WorkerError, OSError):
+            logging.exception(f"Model {version or model_path} failed to start; keeping {self.version or self.model_path}")
+            for worker in workers:
+                worker.kill()
+            return False
+        self.model_path, self.version, self.generation = model_path, version, generation
+        self.reloads += 1
+        while not self._idle.empty():
+            self._idle.get_nowait().kill()
+        for worker in workers:
+            self._idle.put_nowait(worker)
+        logging.info(f"Async model server now serving {version or model_path} with {self.size} workers")
+        return True
+
+    async def stop(self):
+        self._closed = True
+        while self._idle is not None and not self._idle.empty():
+            self._idle.get_nowait().kill()
+
+
+class AsyncBatcher:
+    """Coalesce concurrent single-row predictions into one predict_proba call."""
+
+    def __init__(self, server, window_ms=None, max_rows=None):
+        self.server = server
+        self.window = (DEFAULT_WINDOW_MS if window_ms is None else window_ms) / 1000.0
+        self.max_rows = max_rows or DEFAULT_MAX_ROWS
+        self._pending = {}  # feature width -> [(row, future)]
+        self.batches = 0
+        self.rows = 0
+
+    async def predict_proba(self, row, timeout=None):
+        """(fraud probability, model version) for one feature row; (None, None) if scoring failed."""
+        row = [float(v) for v in row]
+        future = asyncio.get_running_loop().create_future()
+        width = len(row)
+        pending = self._pending.setdefault(width, [])
+        pending.append((row, future))
+        if len(pending) >= self.max_rows or self.window <= 0:
+            self._flush(width)
+        elif len(pending) == 1:
+            asyncio.get_running_loop().call_later(self.window, self._flush, width)
+        with metrics.span('predict'):
+            return await future
+
+    def _flush(self, width):
+        batch = self._pending.pop(width, None)
+        if batch:
+            asyncio.ensure_future(self._score(batch))
+
+    async def _score(self, batch):
+        rows = [row for row, _ in batch]
+        self.batches += 1
+        self.rows += len(rows)
+        if metrics.sampled():
+            metrics.MODEL_BATCH_ROWS.observe(len(rows))
+        probs = None
+        version = None
+        try:
+            with metrics.timer(metrics.MODEL_SECONDS, 'async'):
+                resp = await self.server.request({'features': rows, 'action': 'predict_proba'})
+            if 'error' in resp:
+                logging.error(f"predict_worker error: {resp['error']}")
+            else:
+                probs = [p[1] for p in resp['predict_proba']]
+                version = resp.get('model_version')
+        except Exception as e:
+            logging.exception(f"async prediction failed: {e}")
+        if probs is None:
+            metrics.MODEL_ERRORS.inc()
+        for i, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result((probs[i], version) if probs else (None, None))
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'avg_batch_size': (self.rows / self.batches) if self.batches else 0.0,
+        }
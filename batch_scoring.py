@@ -0,0 +1,370 @@
+"""
+Bulk offline scoring for historical transaction replay.
+
+Runs the same feature building, BLA rules and ML/BLA blending as
+`detect_fraud`, but over whole pandas chunks, so a backfill streams through
+millions of rows with bounded memory.
+
+Usage:
+    python batch_scoring.py --input transactions.csv --output scores.jsonl
+    python batch_scoring.py --sql --start-id 0 --end-id 10000000 --output scores.parquet
+"""
+import os
+import sys
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from fraud_detection_engine import (
+    ML_WEIGHT, BLA_WEIGHT, APPROVE_THRESHOLD, BLOCK_THRESHOLD,
+    DEFAULT_ML_PROB, safe_predict
+)
+from bla_rules import bla_engine
+from geo import assess_travel_many
+from feature_encoding import (
+    encode_column, USER_BUCKETS, CARD_BUCKETS, LOCATION_BUCKETS, IP_BUCKETS
+)
+
+DEFAULT_CHUNK_SIZE = int(os.environ.get('SCORE_BATCH_CHUNK_SIZE', 50000))
+FORMATS = ('csv', 'jsonl', 'parquet')
+# Identifiers that must not be parsed as numbers (leading zeros matter)
+TEXT_COLUMNS = {'user_id': str, 'card_no_last4': str}
+
+# Keyset-paginated replay of `transactions` with the profile columns BLA needs
+TRANSACTIONS_QUERY = """
+    SELECT t.transaction_id, t.user_id, t.card_no_last4, t.amount, t.transaction_location,
+           t.transaction_ip, t.device_id, t.timestamp, t.status, t.otp_verified,
+           u.registered_ip, u.current_card_limit, b.usual_city
+    FROM transactions t
+    JOIN users u ON u.user_id = t.user_id
+    LEFT JOIN user_behavior b ON b.user_id = t.user_id
+    WHERE t.transaction_id > %s AND t.transaction_id <= %s
+    ORDER BY t.transaction_id
+    LIMIT %s
+"""
+
+
+# ---------------------------------------------------------------------------
+# Input
+# ---------------------------------------------------------------------------
+
+def infer_format(name):
+    ext = os.path.splitext(str(name))[1].lower().lstrip('.')
+    if ext in ('json', 'ndjson'):
+        ext = 'jsonl'
+    if ext not in FORMATS:
+        raise ValueError(f"Cannot infer input format from '{name}'; use one of {FORMATS}")
+    return ext
+
+
+def read_file_chunks(source, fmt=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield DataFrames of at most `chunk_size` rows from a CSV/JSONL/Parquet path or file object."""
+    fmt = fmt or infer_format(getattr(source, 'filename', None) or getattr(source, 'name', source))
+    if fmt == 'csv':
+        yield from pd.read_csv(source, chunksize=chunk_size, dtype=TEXT_COLUMNS)
+    elif fmt == 'jsonl':
+        yield from pd.read_json(source, lines=True, chunksize=chunk_size, dtype=TEXT_COLUMNS)
+    elif fmt == 'parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+
+def read_sql_chunks(conn, start_id=0, end_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield `transactions` rows with transaction_id in (start_id, end_id] as DataFrames."""
+    end_id = int(end_id) if end_id is not None else 2 ** 31 - 1
+    cursor = conn.cursor()
+    try:
+        last_id = start_id
+        while last_id < end_id:
+            cursor.execute(TRANSACTIONS_QUERY, (last_id, end_id, chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            columns = [d[0] for d in cursor.description]
+            chunk = pd.DataFrame.from_records(rows, columns=columns)
+            last_id = int(chunk['transaction_id'].iloc[-1])
+            yield chunk
+            if len(rows) < chunk_size:
+                break
+    finally:
+        cursor.close()
+
+
+# ---------------------------------------------------------------------------
+# Scoring
+# ---------------------------------------------------------------------------
+
+def _text(df, column):
+    """Column as a string Series with '' for missing values."""
+    if column not in df.columns:
+        return pd.Series('', index=df.index)
+    return df[column].fillna('').astype(str).str.strip()
+
+
+def _number(df, column, default=0.0):
+    if column not in df.columns:
+        return pd.Series(default, index=df.index, dtype=float)
+    return pd.to_numeric(df[column], errors='coerce').fillna(default).astype(float)
+
+
+def _replay_history(df, history):
+    """
+    Rebuild the user_behavior profile each row would have seen, from the rows
+    before it. Like process_payment, only directly approved payments update
+    the profile. `history` carries per-user state across chunks.
+    """
+    users = df['user_id'].astype(str)
+    amount = _number(df, 'amount')
+    approved = _text(df, 'status').eq('Approved')
+    if 'otp_verified' in df.columns:
+        approved &= ~df['otp_verified'].fillna(False).astype(bool)
+    ts = pd.to_datetime(df['timestamp']) if 'timestamp' in df.columns else pd.Series(pd.NaT, index=df.index)
+    location = _text(df, 'transaction_location').where(approved)
+
+    seed = pd.DataFrame.from_dict(
+        {u: history[u] for u in users.unique() if u in history}, orient='index',
+        columns=['count', 'total', 'last_ts', 'last_location']
+    ).reindex(users.values).set_index(df.index)
+
+    appr = approved.astype(int)
+    prev_count = appr.groupby(users).cumsum() - appr
+    prev_total = amount.where(approved, 0.0).groupby(users).cumsum() - amount.where(approved, 0.0)
+    count = seed['count'].fillna(0) + prev_count
+    total = seed['total'].fillna(0.0) + prev_total
+
+    df['total_transactions'] = count.astype(int)
+    df['avg_spend'] = np.where(count > 0, total / count.where(count > 0, 1), 0.0)
+    df['last_transaction_timestamp'] = (ts.where(approved).groupby(users).shift(1)
+                                        .groupby(users).ffill()
+                                        .fillna(pd.to_datetime(seed['last_ts'])))
+    df['last_transaction_location'] = (location.groupby(users).shift(1)
+                                       .groupby(users).ffill()
+                                       .fillna(seed['last_location']).fillna(''))
+
+    # Carry the state after this chunk into the next one (last() skips nulls)
+    state = pd.DataFrame({
+        'count': count + appr,
+        'total': total + amount.where(approved, 0.0),
+        'last_ts': ts.where(approved).fillna(pd.to_datetime(seed['last_ts'])),
+        'last_location': location.fillna(seed['last_location']),
+    }).groupby(users.values, sort=False).last()
+    for user, row in zip(state.index, state.itertuples(index=False)):
+        history[user] = tuple(row)
+
+
+def calculate_bla_scores(df, now, travel=None):
+    """Vectorized `calculate_bla_score`: returns (bla_score array, {flag: int array})."""
+    if travel is None:
+        travel = travel_columns(df, now)
+    columns = {
+        'location': _text(df, 'transaction_location').str.lower().values.astype(str),
+        'usual_city': _text(df, 'usual_city').str.lower().values.astype(str),
+        'last_location': _text(df, 'last_transaction_location').str.lower().values.astype(str),
+        'ip': _text(df, 'transaction_ip').str.lower().values.astype(str),
+        'registered_ip': _text(df, 'registered_ip').str.lower().values.astype(str),
+        'amount': _number(df, 'amount').values,
+        'avg_spend': _number(df, 'avg_spend').values,
+        'card_limit': _number(df, 'current_card_limit', np.inf).values,
+        'minutes_since_last': np.nan_to_num(travel['minutes'], nan=np.inf),
+        'impossible_travel': travel['impossible'].astype(int),
+        'travel_distance_km': np.nan_to_num(np.round(travel['distance_km'], 1), nan=0.0),
+        'travel_speed_kmh': travel['speed_kmh'],
+    }
+    # Velocity (or any other) columns referenced by custom rules, 0 when absent
+    for name in bla_engine.extra_columns():
+        columns[name] = _number(df, name).values
+    return bla_engine.evaluate(columns, len(df))
+
+
+def travel_columns(df, now):
+    """Minutes, distance, implied speed and impossible-travel flag since each row's last transaction."""
+    if 'last_transaction_timestamp' in df.columns:
+        last_time = pd.to_datetime(df['last_transaction_timestamp'], errors='coerce')
+    else:
+        last_time = pd.Series(pd.NaT, index=df.index)
+    minutes = ((now - last_time).dt.total_seconds() / 60).values
+    travel = assess_travel_many(_text(df, 'last_transaction_location').values,
+                                _text(df, 'transaction_location').values, minutes)
+    travel['minutes'] = minutes
+    return travel
+
+
+def score_chunk(df, predict, history=None):
+    """Score one chunk; `predict(matrix)` returns fraud probabilities or None."""
+    df = df.reset_index(drop=True)
+    if 'total_transactions' not in df.columns:
+        _replay_history(df, history if history is not None else {})
+    now = (pd.to_datetime(df['timestamp']) if 'timestamp' in df.columns
+           else pd.Series(pd.Timestamp.now(), index=df.index))
+
+    user_code = encode_column(_text(df, 'user_id'), USER_BUCKETS)
+    card_code = encode_column(_text(df, 'card_no_last4').str[-4:], CARD_BUCKETS)
+    location_code = encode_column(_text(df, 'transaction_location'), LOCATION_BUCKETS, location=True)
+    ip_code = encode_column(_text(df, 'transaction_ip'), IP_BUCKETS)
+
+    travel = travel_columns(df, now)
+    bla_score, flags = calculate_bla_scores(df, now, travel)
+    ml_only = _number(df, 'total_transactions').values < 3
+    bla_score = np.where(ml_only, 0.0, bla_score)
+
+    ml_score = np.full(len(df), DEFAULT_ML_PROB)
+    for mask, matrix in (
+        (ml_only, np.column_stack([user_code, card_code, location_code, ip_code])),
+        (~ml_only, np.column_stack([user_code, card_code, _number(df, 'amount').values,
+                                    now.dt.hour.values, ip_code, location_code,
+                                    _number(df, 'avg_spend').values])),
+    ):
+        if mask.any():
+            probs = predict(matrix[mask])
+            if probs is None:
+                logging.warning("Batch ML prediction failed, using default for %d rows", mask.sum())
+            else:
+                ml_score[mask] = probs
+
+    fraud_score = np.where(ml_only, ml_score, ml_score * ML_WEIGHT + bla_score * BLA_WEIGHT)
+    fraud_score = np.where(travel['impossible'], 1.0, fraud_score)
+
+    out = pd.DataFrame({
+        'transaction_id': df['transaction_id'] if 'transaction_id' in df.columns else None,
+        'user_id': df['user_id'],
+        'status': np.select([fraud_score <= APPROVE_THRESHOLD, fraud_score <= BLOCK_THRESHOLD],
+                            ['Approved', 'OTP_Sent'], 'Blocked'),
+        'fraud_score': np.round(fraud_score, 4),
+        'ml_score': np.round(ml_score, 4),
+        'bla_score': np.round(bla_score, 4),
+        'method': np.where(ml_only, 'ML_Only', 'ML_BLA'),
+    })
+    for name, values in flags.items():
+        out[name] = np.where(ml_only, 0, values)
+    return out
+
+
+def score_chunks(chunks, predict):
+    """Score an iterable of DataFrames lazily, carrying replay state between chunks."""
+    history = {}
+    for chunk in chunks:
+        if len(chunk):
+            yield score_chunk(chunk, predict, history)
+
+
+# ---------------------------------------------------------------------------
+# Predictors
+# ---------------------------------------------------------------------------
+
+def local_predictor(model_path=None):
+    """Score in this process with a directly loaded model (CLI backfills)."""
+    from predict_worker import load_scoring_model, run_action
+    model = load_scoring_model(model_path)
+
+    def predict(matrix):
+        out = run_action(model, matrix, 'predict_proba')
+        if 'predict_proba' not in out:
+            return None
+        return np.asarray(out['predict_proba'], dtype=float)[:, 1]
+    return predict
+
+
+def server_predictor(timeout=60):
+    """Score through the shared model server (HTTP endpoint)."""
+    def predict(matrix):
+        result = safe_predict(matrix.tolist(), action='predict_proba', timeout=timeout)
+        if not result or 'predict_proba' not in result:
+            return None
+        return np.asarray(result['predict_proba'], dtype=float)[:, 1]
+    return predict
+
+
+# ---------------------------------------------------------------------------
+# Output
+# ---------------------------------------------------------------------------
+
+def _encode(frame, fmt, header):
+    if fmt == 'csv':
+        return frame.to_csv(index=False, header=header)
+    return frame.to_json(orient='records', lines=True, date_format='iso') + '\n'
+
+
+def iter_encoded(frames, fmt='jsonl'):
+    """Encode scored chunks as CSV or JSONL text, one string per chunk."""
+    for i, frame in enumerate(frames):
+        yield _encode(frame, fmt, header=(i == 0))
+
+
+def write_output(frames, path, fmt=None):
+    """Write scored chunks to a CSV/JSONL/Parquet file as they are produced."""
+    fmt = fmt or infer_format(path)
+    rows = 0
+    if fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for frame in frames:
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                rows += len(frame)
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for frame in frames:
+            f.write(_encode(frame, fmt, header=(rows == 0)))
+            rows += len(frame)
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Rescore historical transactions in bulk")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument('--input', help="CSV/JSONL/Parquet file of transactions")
+    src.add_argument('--sql', action='store_true', help="read the transactions table")
+    ap.add_argument('--input-format', choices=FORMATS)
+    ap.add_argument('--start-id', type=int, default=0, help="exclusive lower transaction_id (--sql)")
+    ap.add_argument('--end-id', type=int, help="inclusive upper transaction_id (--sql)")
+    ap.add_argument('--output', required=True, help="output file (.csv, .jsonl or .parquet)")
+    ap.add_argument('--output-format', choices=FORMATS)
+    ap.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    ap.add_argument('--model', help="model path (default: the registry's current version, MODEL_PATH or model.pkl)")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from model_registry import registry
+    model_path = args.model or registry.resolve(os.environ.get('MODEL_PATH', 'model.pkl'))[0]
+    predict = local_predictor(model_path)
+
+    conn = None
+    if args.sql:
+        from db_pool import connect
+        try:
+            conn = connect()
+        except Exception as e:
+            print(f"Database connection failed: {e}", file=sys.stderr)
+            return 1
+        chunks = read_sql_chunks(conn, args.start_id, args.end_id, args.chunk_size)
+    else:
+        chunks = read_file_chunks(args.input, args.input_format, args.chunk_size)
+
+    try:
+        rows = write_output(score_chunks(chunks, predict), args.output, args.output_format)
+    finally:
+        if conn is not None:
+            conn.close()
+    logging.info(f"Scored {rows} transactions -> {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Collect rows for at most this long (or until MAX_ROWS arrive) before scoring
+DEFAULT_WINDOW_MS = float(os.environ.get('PREDICT_BATCH_WINDOW_MS', 2))
+DEFAULT_MAX_ROWS = int(os.environ.get('PREDICT_BATCH_MAX_ROWS', 64))
+DEFAULT_CONCURRENCY = int(os.environ.get('PREDICT_BATCH_CONCURRENCY',
+                                         os.environ.get('MODEL_WORKERS', min(4, os.cpu_count() or 1))))
+
+
+class _Pending:
+    __slots__ = ('row', 'done', 'result')
+
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.result = None
+
+
+class MicroBatcher:
+    """
+    Coalesce single-row predictions from concurrent requests.
+
+    Rows are queued per feature width (ML_Only and ML_BLA rows cannot share a
+    matrix) and flushed as one matrix once `window_ms` has passed since the
+    first row of the batch or `max_rows` rows are waiting. `predict_fn`
+    receives the list of rows and returns one fraud probability per row, or
+    None if the whole batch failed.
+    """
+
+    def __init__(self, predict_fn, window_ms=None, max_rows=None, concurrency=None):
+        self.predict_fn = predict_fn
+        self.window = (DEFAULT_WINDOW_MS if window_ms is None else window_ms) / 1000.0
+        self.max_rows = max_rows or DEFAULT_MAX_ROWS
+        self._executor = ThreadPoolExecutor(max_workers=concurrency or DEFAULT_CONCURRENCY,
+                                            thread_name_prefix='predict-batch')
+        self._cond = threading.Condition()
+        self._queues = {}     # width -> [pending, ...]
+        self._deadlines = {}  # width -> monotonic flush time
+        self.batches = 0
+        self.rows = 0
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def submit(self, row, timeout=5):
+        """Queue one feature row and block until its probability (or None) is ready."""
+        pending = _Pending(row)
+        width = len(row)
+        with self._cond:
+            rows = self._queues.setdefault(width, [])
+            rows.append(pending)
+            if len(rows) == 1:
+                self._deadlines[width] = time.monotonic() + self.window
+            if len(rows) >= self.max_rows:
+                self._deadlines[width] = 0
+            self._cond.notify()
+        if not pending.done.wait(timeout):
+            logging.warning("Batched prediction timed out")
+            return None
+        return pending.result
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._deadlines:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [w for w, deadline in self._deadlines.items() if deadline <= now]
+                if not due:
+                    self._cond.wait(min(self._deadlines.values()) - now)
+                    continue
+                batches = []
+                for width in due:
+                    del self._deadlines[width]
+                    batches.append(self._queues.pop(width))
+                    self.batches += 1
+                    self.rows += len(batches[-1])
+            for batch in batches:
+                self._executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            probs = self.predict_fn([p.row for p in batch])
+        except Exception:
+            logging.exception("Batched prediction failed")
+            probs = None
+        for i, pending in enumerate(batch):
+            pending.result = probs[i] if probs is not None else None
+            pending.done.set()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'avg_batch_size': (self.rows / self.batches) if self.batches else 0.0,
+        }
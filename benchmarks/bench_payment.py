@@ -0,0 +1,306 @@
+"""
+Load test and latency benchmark for the register -> payment -> verify_otp flow.
+
+Runs the real Flask app in-process against a SQLite stand-in for MySQL and a
+deterministic synthetic model, with configurable concurrency and traffic mix:
+
+    python -m benchmarks.bench_payment --requests 2000 --concurrency 16 \
+        --mix approved=70,otp=20,blocked=5,register=5 --output bench_results.json
+
+Reports throughput, p50/p95/p99 per endpoint and per payment stage (pool
+checkout, DB fetch, card verification, feature build, prediction, DB writes,
+commit) and writes everything as JSON so runs can be compared.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import itertools
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks import sqlite_shim  # noqa: E402
+from benchmarks.synthetic_model import AmountModel, OTP_AMOUNT  # noqa: E402
+
+SCENARIOS = ('approved', 'otp', 'blocked', 'register')
+EXPECTED_STATUS = {'approved': 'Approved', 'otp': 'OTP_Sent', 'blocked': 'Blocked'}
+HOME_CITY = 'Mumbai'
+FAR_CITY = 'London'
+CLIENT_IP = '127.0.0.1'
+CARD_LIMIT = 50000000
+_registrations = itertools.count()  # unique across warm-up and measured runs
+PAYMENT_STAGES = ('db_checkout', 'db_fetch', 'verify_card', 'feature_build', 'safe_predict',
+                  'db_write', 'commit')
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario '{name}' (use {', '.join(SCENARIOS)})")
+        mix[name] = float(weight)
+    if not sum(mix.values()) > 0:
+        raise argparse.ArgumentTypeError("mix weights must sum to more than 0")
+    return mix
+
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    arr = np.asarray(samples) * 1000.0
+    return {
+        'count': int(arr.size),
+        'mean_ms': round(float(arr.mean()), 3),
+        'p50_ms': round(float(np.percentile(arr, 50)), 3),
+        'p95_ms': round(float(np.percentile(arr, 95)), 3),
+        'p99_ms': round(float(np.percentile(arr, 99)), 3),
+        'max_ms': round(float(arr.max()), 3),
+    }
+
+
+def _timed(stage, fn):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sqlite_shim.stats.add(stage, time.perf_counter() - start)
+    return wrapper
+
+
+def load_app(db_path, model_path, pool_size):
+    """Import the app wired to the SQLite shim and the synthetic model."""
+    os.environ['MODEL_PATH'] = model_path
+    os.environ.setdefault('FEATURE_STORE_WARM_DAYS', '0')
+    os.environ.setdefault('OTP_TRANSPORT', 'file')
+    os.environ.setdefault('OTP_FILE_PATH', os.path.join(os.path.dirname(db_path), 'otp_outbox.jsonl'))
+    # predict_worker processes must be able to unpickle benchmarks.synthetic_model
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')]))
+
+    import db_pool
+    db_pool._pool = db_pool.ConnectionPool(size=pool_size, connect_fn=sqlite_shim.connect_factory(db_path))
+    # SQLite runs one statement per execute: keep payment writes on the shared pool
+    db_pool.DB_MULTI_STATEMENTS = False
+
+    import logging
+    import app as app_module
+    import fraud_detection_engine
+    logging.getLogger().setLevel(logging.ERROR)
+
+    # Stage timers (recorded per request thread via sqlite_shim.stats)
+    app_module.get_db_connection = _timed('db_checkout', app_module.get_db_connection)
+    app_module.verify_card = _timed('verify_card', app_module.verify_card)
+    fraud_detection_engine.predict_fraud_proba = _timed('safe_predict', fraud_detection_engine.predict_fraud_proba)
+    fraud_detection_engine.detect_fraud = _timed('detect_fraud', fraud_detection_engine.detect_fraud)
+    return app_module
+
+
+def seed_users(db_path, key, per_scenario):
+    """Create users with enough history for the ML+BLA path, one pool per scenario."""
+    from security_advanced import encrypt_secret, card_fingerprint, make_cvv_verifier
+
+    conn = sqlite_shim.Connection(db_path)
+    cursor = conn.cursor()
+    now = datetime.now()
+    users = {}
+    for scenario in EXPECTED_STATUS:
+        users[scenario] = []
+        for i in range(per_scenario):
+            user_id = f"bench_{scenario}_{i}"
+            card_no = f"4{random.randrange(10 ** 14, 10 ** 15):015d}"
+            cvv = f"{random.randrange(1000):03d}"
+            email = f"{user_id}@bench.local"
+            cursor.execute("""
+                INSERT INTO users (user_id, encrypted_card_no, encrypted_cvv, card_fingerprint,
+                                   cvv_verifier, expiry_date, email, city, mobile_number,
+                                   registered_ip, card_limit, current_card_limit)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (user_id, encrypt_secret(card_no, key), encrypt_secret(cvv, key),
+                  card_fingerprint(card_no, key), make_cvv_verifier(cvv, key), '12/30', email,
+                  HOME_CITY, '9000000000', CLIENT_IP, CARD_LIMIT, CARD_LIMIT))
+            cursor.execute("""
+                INSERT INTO user_behavior (user_id, usual_city, usual_state, avg_spend,
+                                           total_transactions, last_transaction_timestamp,
+                                           last_transaction_location, last_transaction_ip)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, (user_id, HOME_CITY, HOME_CITY, 1000, 5, now, HOME_CITY, CLIENT_IP))
+            users[scenario].append({'user_id': user_id, 'card_no': card_no, 'cvv': cvv,
+                                    'expiry_date': '12/30', 'email': email})
+    conn.commit()
+    conn.close()
+    return users
+
+
+class Runner:
+    def __init__(self, app_module, db_path, users, mix, seed):
+        self.app = app_module.app
+        self.db_path = db_path
+        self.users = users
+        self.scenarios = list(mix)
+        self.weights = [mix[s] for s in self.scenarios]
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.latency = {'register': [], 'payment': [], 'verify_otp': []}
+        self.flow = {s: [] for s in SCENARIOS}
+        self.stages = {s: [] for s in PAYMENT_STAGES}
+        self.outcomes = {}
+        self.errors = 0
+
+    def _client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+            self.local.db = sqlite_shim.Connection(self.db_path)
+        return client
+
+    def _post(self, endpoint, path, payload):
+        sqlite_shim.stats.local.stages = {}
+        start = time.perf_counter()
+        resp = self._client().post(path, json=payload, environ_base={'REMOTE_ADDR': CLIENT_IP})
+        elapsed = time.perf_counter() - start
+        stages = sqlite_shim.stats.local.stages
+        sqlite_shim.stats.local.stages = None
+        with self.lock:
+            self.latency[endpoint].append(elapsed)
+            if endpoint == 'payment' and resp.status_code == 200:
+                stages['feature_build'] = stages.get('detect_fraud', 0.0) - stages.get('safe_predict', 0.0)
+                for stage in PAYMENT_STAGES:
+                    self.stages[stage].append(stages.get(stage, 0.0))
+        return resp, elapsed
+
+    def _count(self, key):
+        with self.lock:
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def one(self, _):
+        with self.lock:
+            scenario = self.rng.choices(self.scenarios, self.weights)[0]
+            user = self.rng.choice(self.users[scenario]) if scenario in self.users else None
+            serial = next(_registrations) if scenario == 'register' else None
+        try:
+            if scenario == 'register':
+                resp, elapsed = self._post('register', '/api/register', {
+                    'user_id': f"bench_new_{serial}_{os.getpid()}", 'card_no': '4111111111111111',
+                    'expiry_date': '12/30', 'cvv': '123', 'email': f"new_{serial}_{os.getpid()}@bench.local",
+                    'city': HOME_CITY, 'mobile_number': '9000000000',
+                })
+                self._count('register_ok' if resp.status_code == 200 else 'register_failed')
+            else:
+                elapsed = self._payment(scenario, user)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            return
+        with self.lock:
+            self.flow[scenario].append(elapsed)
+
+    def _payment(self, scenario, user):
+        amount = OTP_AMOUNT * 2 if scenario == 'otp' else self.rng.randint(10, 900)
+        resp, elapsed = self._post('payment', '/api/payment', {
+            'user_id': user['user_id'], 'card_no': user['card_no'], 'expiry_date': user['expiry_date'],
+            'cvv': user['cvv'], 'email': user['email'], 'amount': amount,
+            'location': FAR_CITY if scenario == 'blocked' else HOME_CITY,
+            'device_id': f"bench-device-{user['user_id']}",
+        })
+        body = resp.get_json() or {}
+        status = body.get('status', f"http_{resp.status_code}")
+        self._count(f"{scenario}:{status}")
+        if status == 'OTP_Sent':
+            self._client()
+            cursor = self.local.db.cursor()
+            cursor.execute("SELECT otp_code FROM otp_verification WHERE transaction_id = %s",
+                           (body['transaction_id'],))
+            otp = cursor.fetchone()
+            resp, verify_elapsed = self._post('verify_otp', '/api/verify_otp', {
+                'transaction_id': body['transaction_id'], 'otp_code': otp['otp_code'] if otp else '',
+            })
+            self._count('verify_otp_ok' if resp.status_code == 200 else 'verify_otp_failed')
+            elapsed += verify_elapsed
+        return elapsed
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Payment pipeline load test")
+    ap.add_argument('--requests', type=int, default=1000)
+    ap.add_argument('--concurrency', type=int, default=8)
+    ap.add_argument('--mix', type=parse_mix, default=parse_mix('approved=70,otp=20,blocked=5,register=5'))
+    ap.add_argument('--users', type=int, default=100, help="seeded users per payment scenario")
+    ap.add_argument('--warmup', type=int, default=50, help="untimed requests before measuring")
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--output', default='bench_results.json')
+    args = ap.parse_args(argv)
+
+    from security_advanced import load_master_key
+    key = load_master_key()
+    if not key:
+        print("master.key is required: run `python security_advanced.py` first", file=sys.stderr)
+        return 1
+
+    workdir = tempfile.mkdtemp(prefix='fraud-bench-')
+    db_path = os.path.join(workdir, 'bench.sqlite3')
+    model_path = os.path.join(workdir, 'model.pkl')
+    sqlite_shim.create_database(db_path)
+    import joblib
+    joblib.dump(AmountModel(), model_path)
+    random.seed(args.seed)
+    users = seed_users(db_path, key, args.users)
+    app_module = load_app(db_path, model_path, pool_size=args.concurrency + 2)
+
+    if args.warmup:
+        warm = Runner(app_module, db_path, users, args.mix, args.seed + 1)
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(warm.one, range(args.warmup)))
+
+    runner = Runner(app_module, db_path, users, args.mix, args.seed)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(runner.one, range(args.requests)))
+    wall = time.perf_counter() - start
+
+    mismatched = sum(n for key_, n in runner.outcomes.items()
+                     if ':' in key_ and EXPECTED_STATUS.get(key_.split(':')[0]) != key_.split(':')[1])
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'config': {'requests': args.requests, 'concurrency': args.concurrency, 'mix': args.mix,
+                   'users_per_scenario': args.users, 'warmup': args.warmup, 'seed': args.seed},
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(args.requests / wall, 2) if wall else None,
+        'errors': runner.errors,
+        'unexpected_outcomes': mismatched,
+        'outcomes': dict(sorted(runner.outcomes.items())),
+        'latency': {name: percentiles(samples) for name, samples in runner.latency.items()},
+        'flows': {name: percentiles(samples) for name, samples in runner.flow.items()},
+        'payment_stages': {name: percentiles(samples) for name, samples in runner.stages.items()},
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{args.requests} requests in {wall:.2f}s -> {results['throughput_rps']} req/s "
+          f"({runner.errors} errors, {mismatched} unexpected outcomes)")
+    for name, summary in results['latency'].items():
+        if summary['count']:
+            print(f"  {name:<12} p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms")
+    for name, summary in results['payment_stages'].items():
+        if summary['count']:
+            print(f"    {name:<14} p50={summary['p50_ms']}ms p99={summary['p99_ms']}ms")
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+"""
+SQLite stand-in for the MySQL database, for local benchmarks.
+
+Connections behave like PyMySQL connections opened with DictCursor: `%s`
+placeholders, dict rows, Decimal for DECIMAL columns and datetime for
+TIMESTAMP columns. The few MySQL-only statements the app issues are
+rewritten to SQLite equivalents. Every statement and commit is timed into
+`stats` so the benchmark can attribute time to DB stages.
+"""
+import re
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from decimal import Decimal
+
+from feature_store import RECENT_TRANSACTIONS_QUERY
+from payment_dao import INSERT_LOGGED_TRANSACTION, RESERVE_TRANSACTION_IDS, RESERVED_END_QUERY
+from otp_store import PURGE_EXPIRED_OTPS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    encrypted_card_no TEXT NOT NULL,
+    encrypted_cvv TEXT NOT NULL,
+    card_fingerprint TEXT,
+    cvv_verifier TEXT,
+    expiry_date TEXT NOT NULL,
+    email TEXT UNIQUE NOT NULL,
+    city TEXT NOT NULL,
+    mobile_number TEXT NOT NULL,
+    registered_ip TEXT NOT NULL,
+    card_limit DECIMAL(10, 2) DEFAULT 100000.00,
+    current_card_limit DECIMAL(10, 2) DEFAULT 100000.00,
+    account_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_card_fingerprint ON users (card_fingerprint);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    card_no_last4 TEXT,
+    amount DECIMAL(10, 2) NOT NULL,
+    transaction_location TEXT,
+    transaction_ip TEXT,
+    device_id TEXT,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    status TEXT NOT NULL,
+    fraud_score FLOAT,
+    ml_score FLOAT,
+    bla_score FLOAT,
+    prediction_method TEXT NOT NULL,
+    model_version TEXT,
+    otp_code TEXT,
+    otp_verified BOOLEAN DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_user_timestamp ON transactions (user_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS user_behavior (
+    user_id TEXT PRIMARY KEY,
+    usual_city TEXT,
+    usual_state TEXT,
+    usual_device TEXT,
+    avg_spend DECIMAL(10, 2) DEFAULT 0.00,
+    total_transactions INTEGER DEFAULT 0,
+    last_transaction_timestamp TIMESTAMP NULL,
+    last_transaction_location TEXT,
+    last_transaction_ip TEXT
+);
+
+CREATE TABLE IF NOT EXISTS otp_verification (
+    otp_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    otp_code TEXT NOT NULL,
+    email TEXT,
+    mobile_number TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP,
+    verified BOOLEAN DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS shadow_scores (
+    shadow_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    transaction_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    canary BOOLEAN DEFAULT 0,
+    live_version TEXT,
+    live_ml_score FLOAT,
+    live_fraud_score FLOAT,
+    live_status TEXT,
+    shadow_version TEXT,
+    shadow_ml_score FLOAT,
+    shadow_fraud_score FLOAT,
+    shadow_status TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS transaction_ids (
+    name TEXT PRIMARY KEY,
+    next_id INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO transaction_ids (name, next_id) VALUES ('transactions', 1);
+"""
+
+
+def _sql_key(sql):
+    return ' '.join(sql.split())
+
+
+# MySQL-only statements -> (SQLite statement, params mapper)
+REWRITES = {
+    _sql_key(RECENT_TRANSACTIONS_QUERY): (
+        RECENT_TRANSACTIONS_QUERY.replace("NOW() - INTERVAL %s DAY",
+                                          "datetime(NOW(), '-' || %s || ' days')").replace('%s', '?'),
+        lambda params: params,
+    ),
+    _sql_key(INSERT_LOGGED_TRANSACTION): (
+        INSERT_LOGGED_TRANSACTION.replace('%s', '?').replace(
+            "ON DUPLICATE KEY UPDATE transaction_id = transaction_id", "ON CONFLICT (transaction_id) DO NOTHING"),
+        lambda params: params,
+    ),
+    _sql_key(RESERVE_TRANSACTION_IDS): (
+        RESERVE_TRANSACTION_IDS.replace('%s', '?').replace('LAST_INSERT_ID(GREATEST(', '(MAX('),
+        lambda params: params,
+    ),
+    _sql_key(RESERVED_END_QUERY): (
+        "SELECT next_id AS end_id FROM transaction_ids WHERE name = 'transactions'",
+        lambda params: params,
+    ),
+    _sql_key(PURGE_EXPIRED_OTPS): (
+        "DELETE FROM otp_verification WHERE otp_id IN (SELECT otp_id FROM otp_verification "
+        "WHERE expires_at < datetime(NOW(), '-' || ? || ' seconds') LIMIT ?)",
+        lambda params: params,
+    ),
+}
+
+_PLACEHOLDER = re.compile(r'%s')
+_INTERVAL = re.compile(r"NOW\(\) - INTERVAL (\d+) (DAY|HOUR|MINUTE)")
+
+
+def _translate(sql, params):
+    key = _sql_key(sql)
+    if key in REWRITES:
+        sql, mapper = REWRITES[key]
+        return sql, mapper(params)
+    sql = _INTERVAL.sub(lambda m: f"datetime(NOW(), '-{m.group(1)} {m.group(2).lower()}s')", sql)
+    return _PLACEHOLDER.sub('?', sql), params
+
+
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(' '))
+sqlite3.register_converter('DECIMAL', lambda b: Decimal(b.decode()))
+sqlite3.register_converter('TIMESTAMP', lambda b: datetime.fromisoformat(b.decode()))
+sqlite3.register_converter('BOOLEAN', lambda b: bool(int(b)))
+
+
+class Stats:
+    """Thread-safe accumulation of statement timings, plus per-thread totals."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.local = threading.local()
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            count, total = self.totals.get(stage, (0, 0.0))
+            self.totals[stage] = (count + 1, total + seconds)
+        per_thread = getattr(self.local, 'stages', None)
+        if per_thread is not None:
+            per_thread[stage] = per_thread.get(stage, 0.0) + seconds
+
+
+stats = Stats()
+
+
+def _stage(sql):
+    verb = sql.lstrip().split(None, 1)[0].upper()
+    return 'db_fetch' if verb == 'SELECT' else 'db_write'
+
+
+class Cursor:
+    def __init__(self, raw):
+        self._raw = raw
+
+    def execute(self, sql, params=()):
+        sql, params = _translate(sql, params)
+        start = time.perf_counter()
+        try:
+            self._raw.execute(sql, tuple(params or ()))
+        finally:
+            stats.add(_stage(sql), time.perf_counter() - start)
+        return self._raw.rowcount
+
+    def executemany(self, sql, seq):
+        start = time.perf_counter()
+        try:
+            sql, _ = _translate(sql, ())
+            self._raw.executemany(sql, [tuple(p) for p in seq])
+        finally:
+            stats.add('db_write', time.perf_counter() - start)
+        return self._raw.rowcount
+
+    def fetchone(self):
+        return self._raw.fetchone()
+
+    def fetchall(self):
+        return self._raw.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self._raw.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._raw.rowcount
+
+    @property
+    def description(self):
+        return self._raw.description
+
+    def close(self):
+        self._raw.close()
+
+
+class Connection:
+    def __init__(self, path):
+        self._raw = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                    detect_types=sqlite3.PARSE_DECLTYPES)
+        self._raw.row_factory = lambda cur, row: {d[0]: v for d, v in zip(cur.description, row)}
+        self._raw.create_function('NOW', 0, lambda: datetime.now().isoformat(' '))
+        self._raw.execute('PRAGMA journal_mode=WAL')
+        self._raw.execute('PRAGMA synchronous=NORMAL')
+
+    def cursor(self, *args, **kwargs):
+        return Cursor(self._raw.cursor())
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            self._raw.commit()
+        finally:
+            stats.add('commit', time.perf_counter() - start)
+
+    def rollback(self):
+        self._raw.rollback()
+
+    @property
+    def in_transaction(self):
+        return self._raw.in_transaction
+
+    def ping(self, reconnect=False):
+        self._raw.execute('SELECT 1')
+
+    def close(self):
+        self._raw.close()
+
+
+def create_database(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.commit()
+    conn.close()
+
+
+def connect_factory(path):
+    """connect_fn for db_pool.ConnectionPool."""
+    return lambda: Connection(path)
@@ -0,0 +1,22 @@
+"""
+Deterministic stand-in model for benchmarks.
+
+Scores rows by amount (feature 2 of the ML+BLA vector) so the harness can
+steer traffic: small amounts are approved, amounts of at least OTP_AMOUNT
+land in the OTP band. Blocked traffic is produced with impossible travel.
+"""
+import numpy as np
+
+OTP_AMOUNT = 10000
+
+
+class AmountModel:
+    n_features_in_ = 7
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=float)
+        p = np.where(X[:, 2] >= OTP_AMOUNT, 0.60, 0.01)
+        return np.column_stack([1 - p, p])
+
+    def predict(self, X):
+        return (self.predict_proba(X)[:, 1] >= 0.5).astype(int)
@@ -0,0 +1,120 @@
+"""
+Card fingerprint index: verify cards and look users up by card without
+decrypting the stored Fernet ciphertext.
+
+Backfill rows created before migrations/001_card_fingerprints.sql:
+    python card_index.py --backfill            # rows without a fingerprint
+    python card_index.py --backfill --all      # recompute all (after changing fingerprint.key)
+
+Fingerprints are keyed with fingerprint.key, not master.key, so rotating the
+Fernet keys does not invalidate them. When fingerprint.key itself changes,
+keep the previous key on its second line until --backfill --all finishes.
+"""
+import sys
+import hmac
+import logging
+import argparse
+
+from security_advanced import (
+    load_master_key, card_fingerprint, card_fingerprints, match_card_fingerprint,
+    make_cvv_verifier, check_cvv_verifier, decrypt_secrets, verify_secret
+)
+
+
+def verify_card(user, card_no, cvv, key):
+    """
+    Check a submitted card number and CVV against a `users` row.
+    Returns True/False, or None if the stored card data can't be read.
+    Backfilled rows are checked by HMAC only; only rows without a fingerprint
+    yet fall back to decrypting the ciphertext.
+    """
+    if user.get('card_fingerprint') and user.get('cvv_verifier'):
+        card_ok = match_card_fingerprint(user['card_fingerprint'], card_no, key)
+        cvv_ok = check_cvv_verifier(user['cvv_verifier'], cvv, key)
+        return card_ok and cvv_ok
+
+    card_ok = verify_secret(user['encrypted_card_no'], card_no, key)
+    cvv_ok = verify_secret(user['encrypted_cvv'], cvv, key)
+    if card_ok is None or cvv_ok is None:
+        return None
+    return card_ok and cvv_ok
+
+
+def find_user_ids_by_card(cursor, card_no, key):
+    """Indexed lookup of the users registered with `card_no`."""
+    fingerprints = card_fingerprints(card_no, key)
+    if not fingerprints:
+        return []
+    placeholders = ", ".join(["%s"] * len(fingerprints))
+    cursor.execute(f"SELECT user_id FROM users WHERE card_fingerprint IN ({placeholders})",
+                   fingerprints)
+    rows = cursor.fetchall()
+    return [row['user_id'] if isinstance(row, dict) else row[0] for row in rows]
+
+
+def backfill(conn, key, batch_size=1000, recompute=False):
+    """Fill card_fingerprint/cvv_verifier for existing users in keyset-paginated batches."""
+    cursor = conn.cursor()
+    condition = "" if recompute else "AND card_fingerprint IS NULL"
+    last_id = ''
+    updated = failed = 0
+    try:
+        while True:
+            cursor.execute(f"""
+                SELECT user_id, encrypted_card_no, encrypted_cvv FROM users
+                WHERE user_id > %s {condition}
+                ORDER BY user_id LIMIT %s
+            """, (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            rows = [r if isinstance(r, dict) else
+                    dict(zip(('user_id', 'encrypted_card_no', 'encrypted_cvv'), r)) for r in rows]
+            cards = decrypt_secrets([r['encrypted_card_no'] for r in rows], key)
+            cvvs = decrypt_secrets([r['encrypted_cvv'] for r in rows], key)
+
+            params = []
+            for row, card, cvv in zip(rows, cards, cvvs):
+                if card is None or cvv is None:
+                    failed += 1
+                    logging.error(f"Cannot decrypt card data for user {row['user_id']}")
+                    continue
+                params.append((card_fingerprint(card, key), make_cvv_verifier(cvv, key), row['user_id']))
+            if params:
+                cursor.executemany(
+                    "UPDATE users SET card_fingerprint = %s, cvv_verifier = %s WHERE user_id = %s",
+                    params)
+                conn.commit()
+            updated += len(params)
+            last_id = rows[-1]['user_id']
+            logging.info(f"Backfilled {updated} users so far")
+    finally:
+        cursor.close()
+    return updated, failed
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Card fingerprint index maintenance")
+    ap.add_argument('--backfill', action='store_true', required=True,
+                    help="compute fingerprints/verifiers for existing users")
+    ap.add_argument('--all', action='store_true', help="recompute every row, not only missing ones")
+    ap.add_argument('--batch-size', type=int, default=1000)
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    key = load_master_key()
+    if not key:
+        return 1
+
+    from db_pool import connect
+    conn = connect()
+    try:
+        updated, failed = backfill(conn, key, args.batch_size, recompute=args.all)
+    finally:
+        conn.close()
+    print(f"Updated {updated} users, {failed} could not be decrypted")
+    return 0 if not failed else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,6 +9,8 @@ CREATE TABLE IF NOT EXISTS users (
     user_id VARCHAR(50) PRIMARY KEY,
     encrypted_card_no LONGTEXT NOT NULL,
     encrypted_cvv LONGTEXT NOT NULL,
+    card_fingerprint CHAR(64),          -- keyed HMAC of the card number
+    cvv_verifier VARCHAR(100),          -- salted, keyed CVV hash (salt$digest)
     expiry_date VARCHAR(10) NOT NULL,
     email VARCHAR(100) UNIQUE NOT NULL,
     city VARCHAR(100) NOT NULL,
@@ -18,29 +20,37 @@ CREATE TABLE IF NOT EXISTS users (
     current_card_limit DECIMAL(10, 2) DEFAULT 100000.00,
     account_created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     INDEX idx_email (email),
-    INDEX idx_mobile (mobile_number)
+    INDEX idx_mobile (mobile_number),
+    INDEX idx_card_fingerprint (card_fingerprint)
 );
 
--- Transactions Table
+-- Transactions Table, partitioned by month (partition_maintenance.py creates
+-- the monthly partitions ahead and archives old ones). Partitioned tables take
+-- no foreign keys, and the primary key must include `timestamp`.
 CREATE TABLE IF NOT EXISTS transactions (
-    transaction_id INT AUTO_INCREMENT PRIMARY KEY,
+    transaction_id INT AUTO_INCREMENT,
     user_id VARCHAR(50) NOT NULL,
     card_no_last4 VARCHAR(4),
     amount DECIMAL(10, 2) NOT NULL,
     transaction_location VARCHAR(100),
     transaction_ip VARCHAR(45),
     device_id VARCHAR(255),
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     status ENUM('Approved', 'OTP_Sent', 'Blocked', 'Failed') NOT NULL,
     fraud_score FLOAT,
     ml_score FLOAT,
     bla_score FLOAT,
     prediction_method ENUM('ML_Only', 'ML_BLA') NOT NULL,
+    model_version VARCHAR(64),
     otp_code VARCHAR(6),
     otp_verified BOOLEAN DEFAULT FALSE,
-    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+    PRIMARY KEY (transaction_id, timestamp),
     INDEX idx_user_timestamp (user_id, timestamp),
     INDEX idx_status (status)
+)
+PARTITION BY RANGE (UNIX_TIMESTAMP(timestamp)) (
+    PARTITION p_history VALUES LESS THAN (UNIX_TIMESTAMP('2026-10-01 00:00:00')),
+    PARTITION p_future VALUES LESS THAN MAXVALUE
 );
 
 -- User Behavior Profile Table
@@ -68,12 +78,38 @@ CREATE TABLE IF NOT EXISTS otp_verification (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     expires_at TIMESTAMP,
     verified BOOLEAN DEFAULT FALSE,
-    FOREIGN KEY (transaction_id) REFERENCES transactions(transaction_id) ON DELETE CASCADE,
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+    INDEX idx_otp_transaction (transaction_id),
     INDEX idx_otp_code (otp_code),
     INDEX idx_expires (expires_at)
 );
 
+-- Shadow/Canary Model Scores (shadow_scoring.py)
+CREATE TABLE IF NOT EXISTS shadow_scores (
+    shadow_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    transaction_id INT NOT NULL,
+    user_id VARCHAR(50) NOT NULL,
+    canary BOOLEAN DEFAULT FALSE,
+    live_version VARCHAR(64),
+    live_ml_score FLOAT,
+    live_fraud_score FLOAT,
+    live_status VARCHAR(20),
+    shadow_version VARCHAR(64),
+    shadow_ml_score FLOAT,
+    shadow_fraud_score FLOAT,
+    shadow_status VARCHAR(20),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_shadow_transaction (transaction_id),
+    INDEX idx_shadow_version (shadow_version, created_at)
+);
+
+-- Transaction id reservations for the write-behind transaction log (txlog.py)
+CREATE TABLE IF NOT EXISTS transaction_ids (
+    name VARCHAR(32) PRIMARY KEY,
+    next_id BIGINT NOT NULL
+);
+INSERT IGNORE INTO transaction_ids (name, next_id) VALUES ('transactions', 1);
+
 -- Verify tables created
 SELECT 'Database schema created successfully!' AS Status;
 SELECT COUNT(*) AS 'Users Table' FROM information_schema.tables 
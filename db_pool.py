@@ -0,0 +1,286 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+# Connection settings and pool sizing (override through the environment)
+DB_CONFIG = {
+    'host': os.environ.get('DB_HOST', '127.0.0.1'),
+    'user': os.environ.get('DB_USER', 'root'),
+    'password': os.environ.get('DB_PASSWORD', 'newpassword'),
+    'database': os.environ.get('DB_NAME', 'fraud_detection_system'),
+    'port': int(os.environ.get('DB_PORT', 3306)),
+    'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5)),
+}
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))             # checkout wait (s)
+POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))  # recycle after (s)
+POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', 30))       # health-check idle conns (s)
+# Let the payment writes go to the server as one multi-statement round trip
+# (payment_dao.py). Only the connections of the write pool get the capability.
+DB_MULTI_STATEMENTS = os.environ.get('DB_MULTI_STATEMENTS', '0') == '1'
+DB_WRITE_POOL_SIZE = int(os.environ.get('DB_WRITE_POOL_SIZE', POOL_SIZE))
+
+
+# PyMySQL's server status bit for "a transaction is open on this session"
+SERVER_STATUS_IN_TRANS = 1
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the checkout timeout."""
+
+
+def connect(config=None, multi_statements=False):
+    """Open a raw MySQL connection, preferring PyMySQL over mysql.connector."""
+    config = config or DB_CONFIG
+    # Prefer PyMySQL (pure-Python) to avoid native driver instability in-process.
+    try:
+        import pymysql
+        from pymysql.cursors import DictCursor
+        from pymysql.constants import CLIENT
+        try:
+            return pymysql.connect(host=config['host'], user=config['user'],
+                                   password=config['password'], database=config['database'],
+                                   port=config['port'], connect_timeout=config['connect_timeout'],
+                                   cursorclass=DictCursor,
+                                   client_flag=CLIENT.MULTI_STATEMENTS if multi_statements else 0)
+        except Exception:
+            logging.exception('pymysql connect failed, falling back')
+    except Exception:
+        logging.info('pymysql not available, will try mysql.connector')
+
+    # Fallback to mysql.connector
+    import mysql.connector
+    return mysql.connector.connect(
+        host=config['host'],
+        user=config['user'],
+        password=config['password'],
+        database=config['database'],
+        port=config['port'],
+        connection_timeout=config['connect_timeout'],
+        auth_plugin='mysql_native_password'
+    )
+
+
+def in_transaction(raw):
+    """
+    Whether a raw connection has a transaction open, from client-side state
+    (no round trip). Drivers that don't report it are assumed to have one.
+    """
+    try:
+        flag = getattr(raw, 'in_transaction', None)  # mysql.connector, sqlite3
+        if flag is not None:
+            return bool(flag)
+        status = getattr(raw, 'server_status', None)  # PyMySQL
+        if status is not None:
+            return bool(status & SERVER_STATUS_IN_TRANS)
+    except Exception:
+        pass
+    return True
+
+
+class PooledConnection:
+    """
+    Checked-out connection. Behaves like the driver connection, except that
+    close() hands it back to the pool (rolling back anything uncommitted).
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self._checked_out = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def close(self):
+        if self._checked_out:
+            self._checked_out = False
+            self._pool._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool with health checks and max-lifetime recycling."""
+
+    def __init__(self, size=None, timeout=None, max_lifetime=None, ping_after=None,
+                 config=None, connect_fn=None, multi_statements=False):
+        self.size = size or POOL_SIZE
+        self.timeout = POOL_TIMEOUT if timeout is None else timeout
+        self.max_lifetime = POOL_MAX_LIFETIME if max_lifetime is None else max_lifetime
+        self.ping_after = POOL_PING_AFTER if ping_after is None else ping_after
+        self.config = config or DB_CONFIG
+        self._connect = connect_fn or (lambda: connect(self.config, multi_statements))
+        self._idle = deque()
+        self._cond = threading.Condition()
+        self._open = 0  # idle + in use + being opened
+        self.in_use = 0
+        self.waiting = 0
+        self.created = 0
+        self.recycled = 0
+        self.unhealthy = 0
+        self.timeouts = 0
+
+    def connection(self, timeout=None):
+        """Check out a healthy connection, opening one if the pool has room."""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._open >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"no database connection available within {timeout}s")
+                    self.waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self.waiting -= 1
+                if self._idle:
+                    conn = self._idle.pop()  # LIFO keeps hot connections hot
+                else:
+                    self._open += 1
+
+            if conn is None:
+                try:
+                    conn = PooledConnection(self, self._connect())
+                except Exception:
+                    self._discard()
+                    raise
+                with self._cond:
+                    self.created += 1
+            elif not self._healthy(conn):
+                self._close_raw(conn)
+                self._discard()
+                continue
+
+            with self._cond:
+                self.in_use += 1
+            conn._checked_out = True
+            return conn
+
+    def _healthy(self, conn):
+        now = time.monotonic()
+        if now - conn.created_at > self.max_lifetime:
+            with self._cond:
+                self.recycled += 1
+            return False
+        if now - conn.last_used > self.ping_after:
+            try:
+                try:
+                    conn._raw.ping(reconnect=False)
+                except TypeError:
+                    conn._raw.ping()
+            except Exception:
+                with self._cond:
+                    self.unhealthy += 1
+                return False
+        return True
+
+    def _release(self, conn):
+        with self._cond:
+            self.in_use -= 1
+        try:
+            # Committed connections go straight back: no ROLLBACK round trip
+            if in_transaction(conn._raw):
+                conn._raw.rollback()
+        except Exception:
+            # Broken connection: drop it so the next checkout opens a fresh one
+            with self._cond:
+                self.unhealthy += 1
+            self._close_raw(conn)
+            self._discard()
+            return
+        conn.last_used = time.monotonic()
+        if conn.last_used - conn.created_at > self.max_lifetime:
+            with self._cond:
+                self.recycled += 1
+            self._close_raw(conn)
+            self._discard()
+            return
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def _discard(self):
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_raw(conn):
+        try:
+            conn._raw.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._open -= len(idle)
+        for conn in idle:
+            self._close_raw(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'created': self.created,
+                'recycled': self.recycled,
+                'unhealthy': self.unhealthy,
+                'timeouts': self.timeouts,
+            }
+
+
+_pool = None
+_write_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def get_write_pool():
+    """Pool of multi-statement connections for payment writes; None unless DB_MULTI_STATEMENTS."""
+    global _write_pool
+    if _write_pool is None and DB_MULTI_STATEMENTS:
+        with _pool_lock:
+            if _write_pool is None:
+                _write_pool = ConnectionPool(size=DB_WRITE_POOL_SIZE, multi_statements=True)
+    return _write_pool
+
+
+async def create_async_pool(size=None, config=None):
+    """
+    aiomysql pool with the same settings, for the ASGI app (asgi_app.py).
+    aiomysql is only needed when serving in async mode.
+    """
+    import aiomysql
+    config = config or DB_CONFIG
+    return await aiomysql.create_pool(
+        host=config['host'], user=config['user'], password=config['password'],
+        db=config['database'], port=config['port'], connect_timeout=config['connect_timeout'],
+        minsize=1, maxsize=size or POOL_SIZE, autocommit=False,
+        cursorclass=aiomysql.DictCursor, pool_recycle=int(POOL_MAX_LIFETIME),
+    )
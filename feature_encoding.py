@@ -0,0 +1,70 @@
+"""
+Deterministic encoding of the categorical ML features.
+
+Python's builtin hash() is salted per process, so the same user, card, city
+or IP used to encode differently in every worker. These encodings use a keyed
+BLAKE2b digest instead: identical in every process and across restarts, which
+also makes them safe to memoize and to compute in bulk.
+"""
+import os
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+# Bucket counts match the original `hash(x) % N` features
+USER_BUCKETS = 10000
+CARD_BUCKETS = 10000
+LOCATION_BUCKETS = 1000
+IP_BUCKETS = 10000
+
+# Row widths prepare_fraud_check sends to the model. One model scores both:
+# ML_Only rows are zero-padded up to its width (predict_worker.to_feature_array),
+# so it must take exactly ML_BLA_FEATURES inputs
+ML_ONLY_FEATURES = 4
+ML_BLA_FEATURES = 7
+
+ENCODING_CACHE_SIZE = int(os.environ.get('FEATURE_ENCODING_CACHE_SIZE', 100000))
+
+_PERSON = b'fraud-features'  # domain separation for the digest
+
+
+def stable_hash(value, buckets):
+    """Process-independent replacement for `hash(value) % buckets` (0 for empty values)."""
+    if value is None:
+        return 0
+    value = str(value)
+    if not value:
+        return 0
+    digest = hashlib.blake2b(value.encode('utf-8'), digest_size=8, person=_PERSON).digest()
+    return int.from_bytes(digest, 'big') % buckets
+
+
+def _normalize_location(location):
+    return str(location).strip().lower() if location else ''
+
+
+@lru_cache(maxsize=ENCODING_CACHE_SIZE)
+def encode_transaction(user_id, card_last4, location, ip_address):
+    """Encoded (user, card, location, ip) features for one transaction, memoized."""
+    return (
+        stable_hash(user_id, USER_BUCKETS),
+        stable_hash(card_last4, CARD_BUCKETS),
+        stable_hash(_normalize_location(location), LOCATION_BUCKETS),
+        stable_hash(ip_address, IP_BUCKETS),
+    )
+
+
+def encode_column(values, buckets, location=False):
+    """Vectorized stable_hash over an array-like, hashing each distinct value once."""
+    values = np.asarray(values, dtype=object)
+    values = np.where(values == None, '', values).astype(str)  # noqa: E711 (elementwise)
+    if location:
+        values = np.char.lower(np.char.strip(values))
+    uniques, inverse = np.unique(values, return_inverse=True)
+    table = np.array([stable_hash(v, buckets) for v in uniques], dtype=float)
+    return table[inverse.reshape(-1)] if len(table) else np.zeros(len(values))
+
+
+def encoding_cache_info():
+    return encode_transaction.cache_info()
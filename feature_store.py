@@ -0,0 +1,338 @@
+"""
+In-memory streaming feature store of rolling per-user and per-card aggregates.
+
+Every recorded transaction updates bucketed running totals for the 1h, 24h
+and 7d windows in O(1) (amortized), so velocity features are read at scoring
+time without scanning `transactions`. Warm it from recent history at startup
+with `load_recent()`.
+
+The store is opt-in: fraud_detection_engine only feeds and reads it when a
+BLA rule uses a velocity feature (e.g. card_count_1h), see bla_rules.py.
+
+Each process holds its own store. With FEATURE_STORE_PEERS_DIR set (the
+pre-fork server sets one for its workers), every process binds a unix
+datagram socket there and sends each transaction it records to the others,
+so all workers see a card's full velocity rather than 1/N of it. Delivery
+is best effort: a peer whose receive buffer is full misses the update.
+
+Buckets are coarse (5 minutes, 1 hour and 6 hours) and packed into one
+preallocated array per window, about 1.5 KB of aggregates per key, so the
+window edge is only as exact as one bucket.
+"""
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+
+# name, span in seconds, number of buckets
+WINDOWS = (
+    ('1h', 3600, 12),
+    ('24h', 86400, 24),
+    ('7d', 604800, 28),
+)
+MAX_SPAN = max(span for _, span, _ in WINDOWS)
+# dimension -> plural used in feature names
+DISTINCT_DIMENSIONS = {'city': 'cities', 'ip': 'ips', 'device': 'devices'}
+
+# Recent history used to warm the store, one keyset page at a time
+# (parameters: last transaction_id seen, days, page size)
+RECENT_TRANSACTIONS_QUERY = """
+    SELECT t.transaction_id, t.user_id, t.card_no_last4, t.amount, t.transaction_location,
+           t.transaction_ip, t.device_id, t.timestamp, u.card_fingerprint
+    FROM transactions t JOIN users u ON u.user_id = t.user_id
+    WHERE t.transaction_id > %s AND t.timestamp >= NOW() - INTERVAL %s DAY
+    ORDER BY t.transaction_id
+    LIMIT %s
+"""
+
+FEATURE_STORE_MAX_KEYS = int(os.environ.get('FEATURE_STORE_MAX_KEYS', 20000))
+FEATURE_STORE_MAX_DISTINCT = int(os.environ.get('FEATURE_STORE_MAX_DISTINCT', 256))
+FEATURE_STORE_WARM_BATCH = int(os.environ.get('FEATURE_STORE_WARM_BATCH', 10000))
+FEATURE_STORE_PEERS_DIR = os.environ.get('FEATURE_STORE_PEERS_DIR')
+FEATURE_STORE_PEERS_REFRESH = float(os.environ.get('FEATURE_STORE_PEERS_REFRESH', 1))  # re-list peers (s)
+
+
+class _Rolling:
+    """Count/sum/sum-of-squares over a sliding window of fixed-width buckets."""
+
+    __slots__ = ('width', 'n', 'head', 'buckets', 'count', 'sum', 'sumsq')
+
+    def __init__(self, span, buckets):
+        self.width = span / buckets
+        self.n = buckets
+        self.head = None
+        self.buckets = array('d', bytes(24 * buckets))  # count, sum, sum of squares per bucket
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+
+    def _advance(self, ts):
+        epoch = int(ts // self.width)
+        if self.head is None:
+            self.head = epoch
+        elif epoch > self.head:
+            # Expire the buckets that fell out of the window (at most n of them)
+            buckets = self.buckets
+            for e in range(max(self.head + 1, epoch - self.n + 1), epoch + 1):
+                i = (e % self.n) * 3
+                self.count -= int(buckets[i])
+                self.sum -= buckets[i + 1]
+                self.sumsq -= buckets[i + 2]
+                buckets[i] = buckets[i + 1] = buckets[i + 2] = 0.0
+            if epoch - self.head >= self.n:
+                self.count, self.sum, self.sumsq = 0, 0.0, 0.0
+            self.head = epoch
+        return epoch
+
+    def add(self, ts, amount):
+        epoch = self._advance(ts)
+        if epoch <= self.head - self.n:
+            return  # older than the window
+        i = (epoch % self.n) * 3
+        buckets = self.buckets
+        buckets[i] += 1
+        buckets[i + 1] += amount
+        buckets[i + 2] += amount * amount
+        self.count += 1
+        self.sum += amount
+        self.sumsq += amount * amount
+
+    def read(self, now):
+        self._advance(now)
+        count = self.count
+        if count <= 0:
+            return 0, 0.0, 0.0, 0.0
+        mean = self.sum / count
+        var = max(self.sumsq / count - mean * mean, 0.0)
+        return count, self.sum, mean, var
+
+
+class _Distinct:
+    """Last-seen time per value, roughly oldest first, for distinct counts over windows."""
+
+    __slots__ = ('seen',)
+
+    def __init__(self):
+        self.seen = {}  # plain dict: insertion-ordered and half the size of an OrderedDict
+
+    def add(self, ts, value):
+        if not value or self.seen.get(value, ts) > ts:
+            return  # already seen later
+        self.seen.pop(value, None)
+        self.seen[value] = ts
+        while self.seen:
+            oldest_value, oldest_ts = next(iter(self.seen.items()))
+            if oldest_ts < ts - MAX_SPAN or len(self.seen) > FEATURE_STORE_MAX_DISTINCT:
+                del self.seen[oldest_value]
+            else:
+                break
+
+    def count_since(self, since):
+        # Full scan: warm-up replays rows in transaction_id order, which is only roughly time order
+        return sum(1 for ts in self.seen.values() if ts >= since)
+
+
+class _KeyState:
+    __slots__ = ('rolling', 'distinct')
+
+    def __init__(self):
+        self.rolling = {name: _Rolling(span, buckets) for name, span, buckets in WINDOWS}
+        self.distinct = {dim: _Distinct() for dim in DISTINCT_DIMENSIONS}
+
+
+def card_key(user_data, card_no):
+    """Stable key for a card: its fingerprint when available, else user + last 4 digits."""
+    fingerprint = (user_data or {}).get('card_fingerprint')
+    if fingerprint:
+        return fingerprint
+    return f"{(user_data or {}).get('user_id', '')}:{(card_no or '')[-4:]}"
+
+
+def peer_socket_path(directory, pid):
+    return os.path.join(directory, f'{pid}.sock')
+
+
+class _Peers:
+    """This process's datagram socket in the peers directory, and the sockets of the others."""
+
+    def __init__(self, directory, apply):
+        self.directory = directory
+        self.apply = apply
+        self.path = peer_socket_path(directory, os.getpid())
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left by an earlier process with the same pid
+        self.inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.inbox.bind(self.path)
+        self.outbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.outbox.setblocking(False)
+        self.targets = []
+        self.listed_at = 0.0
+        self.metrics = {'sent': 0, 'received': 0, 'dropped': 0}
+
+    def _targets(self):
+        now = time.monotonic()
+        if now - self.listed_at >= FEATURE_STORE_PEERS_REFRESH:
+            self.listed_at = now
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                names = []
+            self.targets = [os.path.join(self.directory, name) for name in names
+                            if name.endswith('.sock') and os.path.join(self.directory, name) != self.path]
+        return self.targets
+
+    def publish(self, event):
+        payload = json.dumps(event).encode()
+        for path in self._targets():
+            try:
+                self.outbox.sendto(payload, path)
+                self.metrics['sent'] += 1
+            except (BlockingIOError, ConnectionRefusedError, FileNotFoundError):
+                self.metrics['dropped'] += 1  # peer busy, or exited since the last listing
+            except OSError:
+                logging.exception(f"Feature store update to {path} failed")
+                self.metrics['dropped'] += 1
+
+    def run(self):
+        while True:
+            try:
+                event = json.loads(self.inbox.recv(65536))
+                self.apply(*event)
+                self.metrics['received'] += 1
+            except OSError:
+                return  # closed
+            except Exception:
+                logging.exception("Bad feature store update from a peer")
+
+    def close(self):
+        self.inbox.close()
+        self.outbox.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class FeatureStore:
+    def __init__(self, max_keys=None, peers_dir=None):
+        self.max_keys = max_keys or FEATURE_STORE_MAX_KEYS
+        self.peers_dir = peers_dir or FEATURE_STORE_PEERS_DIR
+        self.enabled = True
+        self._states = OrderedDict()  # (kind, key) -> _KeyState
+        self._lock = threading.Lock()
+        self._peers = None
+
+    def after_fork(self):
+        """In a forked child: a lock the parent held stays held, and its peer socket is not ours."""
+        self._lock = threading.Lock()
+        self._peers = None
+
+    def start(self):
+        """Join the other processes in peers_dir (if set) and apply their updates."""
+        if not self.enabled or not self.peers_dir or self._peers is not None:
+            return self
+        self._peers = _Peers(self.peers_dir, self._record)
+        threading.Thread(target=self._peers.run, name='feature-store-peers', daemon=True).start()
+        return self
+
+    def close(self):
+        peers, self._peers = self._peers, None
+        if peers is not None:
+            peers.close()
+
+    def _state(self, kind, key, create):
+        k = (kind, key)
+        state = self._states.get(k)
+        if state is None and create:
+            state = self._states[k] = _KeyState()
+            while len(self._states) > self.max_keys:
+                self._states.popitem(last=False)
+        if state is not None:
+            self._states.move_to_end(k)
+        return state
+
+    def record(self, user_id, card, amount, city=None, ip_address=None, device_id=None, ts=None):
+        """Add one transaction to the user's and the card's aggregates (and the peers')."""
+        if not self.enabled:
+            return
+        ts = time.time() if ts is None else ts
+        amount = float(amount)
+        city = city.strip().lower() if city else None
+        self._record(user_id, card, amount, city, ip_address, device_id, ts)
+        peers = self._peers
+        if peers is not None:
+            peers.publish((user_id, card, amount, city, ip_address, device_id, ts))
+
+    def _record(self, user_id, card, amount, city, ip_address, device_id, ts):
+        with self._lock:
+            for kind, key in (('user', user_id), ('card', card)):
+                if not key:
+                    continue
+                state = self._state(kind, key, create=True)
+                for rolling in state.rolling.values():
+                    rolling.add(ts, amount)
+                state.distinct['city'].add(ts, city)
+                state.distinct['ip'].add(ts, ip_address)
+                state.distinct['device'].add(ts, device_id)
+
+    def snapshot(self, user_id, card=None, now=None):
+        """Flat dict of velocity features, e.g. user_count_1h, card_amount_var_24h, user_distinct_cities_7d."""
+        now = time.time() if now is None else now
+        features = {}
+        with self._lock:
+            for kind, key in (('user', user_id), ('card', card)):
+                state = self._state(kind, key, create=False) if key else None
+                for name, span, _ in WINDOWS:
+                    if state is None:
+                        count, total, mean, var = 0, 0.0, 0.0, 0.0
+                    else:
+                        count, total, mean, var = state.rolling[name].read(now)
+                    features[f'{kind}_count_{name}'] = count
+                    features[f'{kind}_amount_sum_{name}'] = round(total, 2)
+                    features[f'{kind}_amount_mean_{name}'] = round(mean, 2)
+                    features[f'{kind}_amount_var_{name}'] = round(var, 2)
+                    for dim, plural in DISTINCT_DIMENSIONS.items():
+                        distinct = state.distinct[dim].count_since(now - span) if state else 0
+                        features[f'{kind}_distinct_{plural}_{name}'] = distinct
+        return features
+
+    def load_recent(self, cursor, days=7, batch_rows=None):
+        """Warm the store from the last `days` of transactions, page by page (run at startup)."""
+        batch_rows = batch_rows or FEATURE_STORE_WARM_BATCH
+        loaded = last_id = 0
+        if not self.enabled:
+            return loaded
+        while True:
+            cursor.execute(RECENT_TRANSACTIONS_QUERY, (last_id, days, batch_rows))
+            rows = cursor.fetchall()
+            loaded += self.load_rows(rows)
+            if len(rows) < batch_rows:
+                return loaded
+            last_id = rows[-1]['transaction_id']
+
+    def load_rows(self, rows):
+        """Record rows returned by RECENT_TRANSACTIONS_QUERY, in transaction_id order (not sent to peers)."""
+        loaded = 0
+        for row in rows:
+            city = row['transaction_location']
+            self._record(row['user_id'], card_key(row, row['card_no_last4']), float(row['amount']),
+                         city.strip().lower() if city else None, row['transaction_ip'],
+                         row['device_id'], row['timestamp'].timestamp())
+            loaded += 1
+        return loaded
+
+    def stats(self):
+        stats = {'keys': len(self._states)}
+        if self._peers is not None:
+            stats.update(self._peers.metrics)
+        return stats
+
+    def __len__(self):
+        return len(self._states)
+
+
+feature_store = FeatureStore()
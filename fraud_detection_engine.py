@@ -6,249 +6,323 @@ from datetime import datetime
 from dateutil import parser
 import logging
 from decimal import Decimal
+from model_server import get_model_server
+from batching import MicroBatcher, DEFAULT_WINDOW_MS
+from prediction_cache import prediction_cache
+from feature_encoding import encode_transaction
+from feature_store import feature_store, card_key
+import threading
+import metrics
+from bla_rules import bla_engine
+from geo import assess_travel, NO_TRAVEL
 
-def safe_predict(features, action='predict', timeout=5):
-    """Run ML model prediction in isolated subprocess"""
+# BLA rule weights (see bla_rules), hybrid weighting and decision thresholds (all 0-1)
+BLA_WEIGHTS = bla_engine.weights
+ML_WEIGHT = 0.65
+BLA_WEIGHT = 0.35
+APPROVE_THRESHOLD = 0.20
+BLOCK_THRESHOLD = 0.70
+DEFAULT_ML_PROB = 0.05  # used when the model is unavailable
+
+# Velocity features are opt-in: the feature store is only fed, warmed and read
+# when a BLA rule (BLA_RULES_PATH) uses one, e.g. card_count_1h
+feature_store.enabled = bool(bla_engine.extra_columns())
+
+def _sanitize(obj):
+    """Convert Decimal -> float so features are JSON serializable"""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, list):
+        return [_sanitize(x) for x in obj]
+    if isinstance(obj, dict):
+        return {k: _sanitize(v) for k, v in obj.items()}
+    return obj
+
+def _spawn_predict(payload, timeout):
+    """Legacy path: one predict_worker process per call (MODEL_SERVER=0)"""
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__), 'predict_worker.py')],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    out, err = proc.communicate(json.dumps(payload), timeout=timeout)
+    if err:
+        logging.warning(f"predict_worker stderr: {err}")
+    if not out:
+        return None
+    return json.loads(out)
+
+def safe_predict(features, action='predict', timeout=5, server=None):
+    """
+    Run ML model prediction in an isolated, persistent worker process
+    (`server` picks another model backend, e.g. a shadow candidate)
+    """
     try:
-        # Sanitize features to ensure JSON serializable (convert Decimal -> float)
-        def _sanitize(obj):
-            if isinstance(obj, Decimal):
-                return float(obj)
-            if isinstance(obj, list):
-                return [_sanitize(x) for x in obj]
-            if isinstance(obj, dict):
-                return {k: _sanitize(v) for k, v in obj.items()}
-            return obj
-
-        payload = json.dumps(_sanitize({'features': features, 'action': action}))
-        proc = subprocess.Popen(
-            [sys.executable, os.path.join(os.path.dirname(__file__), 'predict_worker.py')],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-        )
-        out, err = proc.communicate(payload, timeout=timeout)
-        if err:
-            logging.warning(f"predict_worker stderr: {err}")
-        if not out:
+        payload = _sanitize({'features': features, 'action': action})
+        mode = os.environ.get('MODEL_SERVER', '1')
+        path = {'0': 'spawn', 'inprocess': 'inprocess'}.get(mode, 'server') if server is None else 'candidate'
+        with metrics.timer(metrics.MODEL_SECONDS, path):
+            if path == 'spawn':
+                resp = _spawn_predict(payload, timeout)
+                if resp:
+                    resp.setdefault('model_version', os.environ.get('MODEL_VERSION') or None)
+            else:
+                resp = (server or get_model_server()).request(payload, timeout=timeout)
+        if not resp:
+            metrics.MODEL_ERRORS.inc()
             return None
-        resp = json.loads(out)
         if 'error' in resp:
+            metrics.MODEL_ERRORS.inc()
             logging.error(f"predict_worker error: {resp['error']}")
             return None
         return resp
     except Exception as e:
+        metrics.MODEL_ERRORS.inc()
         logging.exception(f"safe_predict failed: {e}")
         return None
 
-def calculate_bla_score(user_data, behavior_data, amount, location, ip_address, cursor):
-    """Calculate Business Logic Analysis score"""
-    bla_score = 0.0
-    flags = {
-        'location_mismatch': 0,
-        'ip_mismatch': 0,
-        'spending_limit': 0,
-        'avg_spend_mismatch': 0,
-        'impossible_travel': 0
-    }
-    
+def _predict_batch(rows):
+    """Score a list of rows with one predict_proba call; one (fraud probability, model version) per row"""
+    if metrics.sampled():
+        metrics.MODEL_BATCH_ROWS.observe(len(rows))
+    result = safe_predict(rows, action='predict_proba')
+    if not result or 'predict_proba' not in result:
+        return None
+    version = result.get('model_version')
+    return [(row[1], version) for row in result['predict_proba']]
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+# Candidate model deciding for a share of users (installed by shadow_scoring.py)
+_canary = None
+
+def set_canary(router):
+    """`router` provides is_canary(user_id) and predict(row) -> (probability, version); None removes it"""
+    global _canary
+    _canary = router
+
+def get_batcher():
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = MicroBatcher(_predict_batch)
+    return _batcher
+
+def _model_identity():
+    """What the production model's cached results are keyed on; changes on every reload"""
+    if os.environ.get('MODEL_SERVER', '1') == '0':
+        return os.environ.get('MODEL_PATH'), os.environ.get('MODEL_VERSION')
+    server = get_model_server()
+    return server.model_path, server.version, server.reloads
+
+def _score_row(row):
+    # Includes the time spent waiting for the micro-batch window
+    with metrics.span('predict'):
+        if DEFAULT_WINDOW_MS <= 0:
+            probs = _predict_batch([row])
+            return probs[0] if probs else None
+        return get_batcher().submit(row)
+
+def predict_fraud_proba(row):
+    """
+    (fraud probability, model version) for one feature row, coalesced with
+    concurrent requests and answered from the prediction cache when the same
+    row was just scored by the same model; (None, None) if scoring failed
+    """
+    return prediction_cache.get_or_compute(_model_identity(), row, lambda: _score_row(row)) or (None, None)
+
+def _minutes_since(last_time, now=None):
+    """Minutes since a DB/str timestamp, or None when unknown"""
+    if not last_time:
+        return None
+    if isinstance(last_time, str):
+        last_time = parser.parse(last_time)
+    if not isinstance(last_time, datetime):
+        return None
+    return ((now or datetime.now()) - last_time).total_seconds() / 60
+
+def assess_last_travel(behavior_data, location, now=None):
+    """Distance/speed from the last approved transaction's city (computed once per payment)"""
     if not behavior_data:
-        return bla_score, flags
-    
-    # 1. Location/City Mismatch (0.15 weight)
-    # Compare current city (from location) with registered city
-    if location and behavior_data.get('usual_city'):
-        current_city = location  # Location should be city name, not coordinates
-        registered_city = behavior_data['usual_city']
-        if current_city.lower() != registered_city.lower():
-            flags['location_mismatch'] = 1
-            bla_score += 0.15
-            logging.info(f"Location mismatch: {current_city} != {registered_city}")
-    
-    # 2. IP Address Check (0.10 weight)
-    # If IP matches registered IP, it's NOT fraud (reduce score)
-    # If IP doesn't match, it's suspicious (increase score)
-    if ip_address and user_data.get('registered_ip'):
-        if ip_address == user_data['registered_ip']:
-            # IP matches - this is good, don't add to fraud score
-            flags['ip_mismatch'] = 0
-            logging.info(f"IP matches registered IP: {ip_address}")
-        else:
-            # IP doesn't match - suspicious
-            flags['ip_mismatch'] = 1
-            bla_score += 0.10
-            logging.info(f"IP mismatch: {ip_address} != {user_data['registered_ip']}")
-    
-    # 3. Spending Limit Check (0.20 weight)
-    if user_data.get('current_card_limit', 0) < amount:
-        flags['spending_limit'] = 1
-        bla_score += 0.20
-    
-    # 4. Average Spend Mismatch (0.15 weight)
-    avg_spend = behavior_data.get('avg_spend', 0) or 0
-    if avg_spend > 0 and amount > (avg_spend * 2):  # More than 2x average
-        flags['avg_spend_mismatch'] = 1
-        bla_score += 0.15
+        return NO_TRAVEL
+    minutes = _minutes_since(behavior_data.get('last_transaction_timestamp'), now)
+    return assess_travel(behavior_data.get('last_transaction_location'), location, minutes)
+
+def calculate_bla_score(user_data, behavior_data, amount, location, ip_address, cursor, velocity=None,
+                        travel=None):
+    """Calculate Business Logic Analysis score with the declarative rules in bla_rules"""
+    if not behavior_data:
+        return 0.0, {flag: 0 for flag in bla_engine.weights}
+    if travel is None:
+        travel = assess_last_travel(behavior_data, location)
     
-    # 5. Impossible Travel (0.30 weight - highest)
-    # Check if location changed too quickly (impossible travel)
-    if behavior_data.get('last_transaction_timestamp') and location:
-        last_time = behavior_data['last_transaction_timestamp']
-        last_location = behavior_data.get('last_transaction_location')
-        
-        if last_location and location.lower() != last_location.lower():
-            # Calculate time difference in minutes
-            if isinstance(last_time, str):
-                last_time = parser.parse(last_time)
-            elif isinstance(last_time, datetime):
-                pass
-            else:
-                last_time = datetime.now()  # Fallback
-            
-            time_diff = (datetime.now() - last_time).total_seconds() / 60  # minutes
-            # If location changed in less than 60 minutes, it's impossible
-            if time_diff < 60:
-                flags['impossible_travel'] = 1
-                bla_score += 0.30
-                logging.warning(f"Impossible travel detected: {last_location} -> {location} in {time_diff:.1f} minutes")
+    values = {
+        'location': location,
+        'usual_city': behavior_data.get('usual_city'),
+        'last_location': behavior_data.get('last_transaction_location'),
+        'ip': ip_address,
+        'registered_ip': user_data.get('registered_ip'),
+        'amount': amount,
+        'avg_spend': behavior_data.get('avg_spend') or 0,
+        'card_limit': user_data.get('current_card_limit'),
+        'minutes_since_last': travel.minutes,
+        'impossible_travel': int(travel.impossible),
+        'travel_distance_km': travel.distance_km,
+        'travel_speed_kmh': travel.speed_kmh,
+    }
+    # Rules may also reference rolling velocity features (e.g. user_count_1h)
+    for name in bla_engine.extra_columns():
+        values[name] = (velocity or {}).get(name)
     
-    return min(bla_score, 1.0), flags  # Cap at 1.0
+    bla_score, flags = bla_engine.score_one(**values)
+    raised = [flag for flag, hit in flags.items() if hit]
+    if raised:
+        logging.info(f"BLA flags raised: {', '.join(raised)} (score {bla_score:.2f})")
+    return bla_score, flags
 
-def detect_fraud(user_id, card_no, amount, location, ip_address, user_data, behavior_data, cursor):
+def decide_status(fraud_score):
+    """Map a 0-1 fraud score to (status, message)"""
+    if fraud_score <= APPROVE_THRESHOLD:
+        return 'Approved', 'Transaction approved'
+    elif fraud_score <= BLOCK_THRESHOLD:
+        return 'OTP_Sent', 'OTP sent to your registered email/mobile'
+    return 'Blocked', 'Transaction blocked due to high fraud risk'
+
+def prepare_fraud_check(user_id, card_no, amount, location, ip_address, user_data, behavior_data, cursor=None):
     """
-    Main fraud detection function
-    Returns: {
-        'status': 'Approved' | 'OTP_Sent' | 'Blocked',
-        'fraud_score': float (0.0-1.0),
-        'ml_score': float (0.0-1.0),
-        'bla_score': float (0.0-1.0),
-        'method': 'ML_Only' | 'ML_BLA',
-        'message': str
-    }
+    Everything detect_fraud does before the model call. Returns a dict whose
+    'features' row is scored by the caller (sync or async) and then passed
+    with the probability to finish_fraud_check.
     """
     total_transactions = behavior_data.get('total_transactions', 0) if behavior_data else 0
     
-    # New user or insufficient history: ML Only
-    # Check for impossible travel first (even for new users)
-    impossible_travel_detected = False
-    if behavior_data and behavior_data.get('last_transaction_timestamp') and location:
-        last_time = behavior_data['last_transaction_timestamp']
-        last_location = behavior_data.get('last_transaction_location')
-        if last_location and location.lower() != last_location.lower():
-            if isinstance(last_time, str):
-                last_time = parser.parse(last_time)
-            time_diff = (datetime.now() - last_time).total_seconds() / 60
-            if time_diff < 60:  # Less than 60 minutes
-                impossible_travel_detected = True
-                logging.warning(f"Impossible travel detected for new user: {time_diff:.1f} minutes")
+    # Rolling velocity aggregates for this user and card (no transactions scan),
+    # only read when a BLA rule uses them
+    velocity = feature_store.snapshot(user_id, card_key(user_data, card_no)) if feature_store.enabled else {}
+    
+    # Distance and implied speed since the last transaction, shared by the
+    # hard block below and the BLA rules (checked for new users too)
+    now = datetime.now()
+    travel = assess_last_travel(behavior_data, location, now)
+    if travel.impossible:
+        logging.warning(f"Impossible travel: {behavior_data.get('last_transaction_location')} -> {location}, "
+                        f"{travel.distance_km} km in {travel.minutes:.1f} minutes")
+    
+    # Deterministic, memoized encodings (identical in every process)
+    user_code, card_code, location_code, ip_code = encode_transaction(
+        user_id, card_no[-4:], location, ip_address
+    )
     
     if total_transactions < 3:
         # ML Only: user_id, card_id, location, ip_address (4 features as specified)
         # Note: Adjust feature encoding based on your actual model training
-        ml_features = [[
-            hash(user_id) % 10000,  # user_id feature
-            hash(card_no[-4:]) % 10000,  # card_id feature (last 4 digits)
-            hash(location) % 1000 if location else 0,  # location/city feature
-            hash(ip_address) % 10000 if ip_address else 0  # ip_address feature
-        ]]
+        features = [
+            user_code,  # user_id feature
+            card_code,  # card_id feature (last 4 digits)
+            location_code,  # location/city feature
+            ip_code  # ip_address feature
+        ]
         
         logging.info(f"ML Only - Features: user_id={user_id}, card_id={card_no[-4:]}, location={location}, ip={ip_address}")
-        
-        # Get ML prediction
-        ml_result = safe_predict(ml_features, action='predict_proba')
-        
-        if ml_result and 'predict_proba' in ml_result:
-            ml_prob = ml_result['predict_proba'][0][1]  # Probability of fraud (0-1)
-        else:
-            ml_prob = 0.05  # Default low risk if model fails
-            logging.warning("ML prediction failed, using default low risk")
-
-        # Work in 0-1 range internally
-        ml_score = float(ml_prob)
         bla_score = 0.0
-
-        # If impossible travel detected, block immediately
-        if impossible_travel_detected:
-            fraud_score = 1.0
-            logging.warning("Impossible travel detected - blocking transaction")
-        else:
-            fraud_score = ml_score
-
         method = 'ML_Only'
         
     else:
         # Returning user: ML + BLA (has history >= 3 transactions)
-        # Check for impossible travel first - block immediately if detected
-        impossible_travel_detected = False
-        if behavior_data.get('last_transaction_timestamp') and location:
-            last_time = behavior_data['last_transaction_timestamp']
-            last_location = behavior_data.get('last_transaction_location')
-            if last_location and location.lower() != last_location.lower():
-                if isinstance(last_time, str):
-                    last_time = parser.parse(last_time)
-                time_diff = (datetime.now() - last_time).total_seconds() / 60
-                if time_diff < 60:  # Less than 60 minutes
-                    impossible_travel_detected = True
-                    logging.warning(f"Impossible travel: {last_location} -> {location} in {time_diff:.1f} minutes")
-        
         # Calculate BLA score (returned 0-1)
         bla_score, bla_flags = calculate_bla_score(
-            user_data, behavior_data, amount, location, ip_address, cursor
+            user_data, behavior_data, amount, location, ip_address, cursor, velocity, travel
         )
         
         # Prepare ML features: user_id, card_id, amount, timestamp, ip_address, location, avg_spend (7 features)
         avg_spend = behavior_data.get('avg_spend', 0) or 0
-        now = datetime.now()
         
-        ml_features = [[
-            hash(user_id) % 10000,  # user_id
-            hash(card_no[-4:]) % 10000,  # card_id
+        features = [
+            user_code,  # user_id
+            card_code,  # card_id
             amount,  # amount
             now.hour,  # timestamp (hour)
-            hash(ip_address) % 10000 if ip_address else 0,  # ip_address
-            hash(location) % 1000 if location else 0,  # location/city
+            ip_code,  # ip_address
+            location_code,  # location/city
             avg_spend  # average spending amount
-        ]]
+        ]
         
         logging.info(f"ML+BLA - Features: user_id={user_id}, card_id={card_no[-4:]}, amount={amount}, "
                     f"timestamp={now.hour}, ip={ip_address}, location={location}, avg_spend={avg_spend}")
-        
-        # Get ML prediction
-        ml_result = safe_predict(ml_features, action='predict_proba')
-        
-        if ml_result and 'predict_proba' in ml_result:
-            ml_prob = ml_result['predict_proba'][0][1]
-        else:
-            ml_prob = 0.05
-            logging.warning("ML prediction failed, using default")
-
-        # Work in 0-1 range internally
-        ml_score = float(ml_prob)
+        method = 'ML_BLA'
+    
+    return {
+        'features': features,
+        'method': method,
+        'bla_score': bla_score,
+        'velocity': velocity,
+        'travel': travel,
+    }
 
+def finish_fraud_check(check, ml_prob, model_version=None):
+    """Blend the model probability (None if scoring failed) with the prepared check"""
+    if ml_prob is None:
+        ml_prob = DEFAULT_ML_PROB  # Default low risk if model fails
+        logging.warning("ML prediction failed, using default low risk")
+    
+    # Work in 0-1 range internally
+    ml_score = float(ml_prob)
+    bla_score = check['bla_score']
+    
+    # If impossible travel detected, block immediately
+    if check['travel'].impossible:
+        fraud_score = 1.0
+        logging.warning("Impossible travel detected - blocking transaction")
+    elif check['method'] == 'ML_Only':
+        fraud_score = ml_score
+    else:
         # Combine ML (0.65) + BLA (0.35)
-        if impossible_travel_detected:
-            fraud_score = 1.0
-            logging.warning("Impossible travel detected - blocking transaction")
-        else:
-            fraud_score = (ml_score * 0.65) + (bla_score * 0.35)
-
-        method = 'ML_BLA'
+        fraud_score = (ml_score * ML_WEIGHT) + (bla_score * BLA_WEIGHT)
     
     # Determine status based on thresholds (fraud_score in 0-1)
-    if fraud_score <= 0.20:
-        status = 'Approved'
-        message = 'Transaction approved'
-    elif fraud_score <= 0.70:
-        status = 'OTP_Sent'
-        message = 'OTP sent to your registered email/mobile'
-    else:
-        status = 'Blocked'
-        message = 'Transaction blocked due to high fraud risk'
+    status, message = decide_status(fraud_score)
 
     return {
         'status': status,
         'fraud_score': round(float(fraud_score), 4),
         'ml_score': round(float(ml_score), 4),
         'bla_score': round(float(bla_score), 4),
-        'method': method,
-        'message': message
+        'method': check['method'],
+        'message': message,
+        'velocity': check['velocity'],
+        'travel': check['travel']._asdict(),
+        'model_version': model_version
     }
 
+def detect_fraud(user_id, card_no, amount, location, ip_address, user_data, behavior_data, cursor):
+    """
+    Main fraud detection function
+    Returns: {
+        'status': 'Approved' | 'OTP_Sent' | 'Blocked',
+        'fraud_score': float (0.0-1.0),
+        'ml_score': float (0.0-1.0),
+        'bla_score': float (0.0-1.0),
+        'method': 'ML_Only' | 'ML_BLA',
+        'message': str,
+        'velocity': dict of rolling per-user/per-card aggregates (empty unless a BLA rule reads them),
+        'travel': distance_km / speed_kmh since the last transaction and whether it is impossible,
+        'model_version': registry version that produced ml_score (None if unversioned),
+        'canary': True if a canary candidate model made the decision,
+        'check': the prepared check, for shadow scoring (not for API responses)
+    }
+    """
+    check = prepare_fraud_check(user_id, card_no, amount, location, ip_address,
+                                user_data, behavior_data, cursor)
+    canary = _canary is not None and _canary.is_canary(user_id)
+    if canary:
+        ml_prob, model_version = _canary.predict(check['features'])
+        # A failing candidate must not approve its share with DEFAULT_ML_PROB
+        canary = ml_prob is not None
+    if not canary:
+        # Get ML prediction (batched with concurrent requests)
+        ml_prob, model_version = predict_fraud_proba(check['features'])
+    result = finish_fraud_check(check, ml_prob, model_version)
+    result['canary'] = canary
+    result['check'] = check
+    return result
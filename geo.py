@@ -0,0 +1,150 @@
+"""
+Offline geo lookups for the impossible-travel check.
+
+Cities come from the bundled gazetteer (data/cities.csv, override with
+GAZETTEER_PATH) and are held as radian latitude/longitude arrays plus a
+name -> row index. A move between two known cities is impossible when the
+great-circle distance over the elapsed time exceeds GEO_MAX_SPEED_KMH; for
+cities not in the gazetteer the old rule applies (a different city within
+IMPOSSIBLE_TRAVEL_MINUTES).
+"""
+import os
+import csv
+import math
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+GAZETTEER_PATH = os.environ.get(
+    'GAZETTEER_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cities.csv'))
+GEO_MAX_SPEED_KMH = float(os.environ.get('GEO_MAX_SPEED_KMH', 900))  # airliner cruise speed
+GEO_MIN_DISTANCE_KM = float(os.environ.get('GEO_MIN_DISTANCE_KM', 50))  # ignore neighbouring towns
+IMPOSSIBLE_TRAVEL_MINUTES = 60  # fallback for unknown cities
+EARTH_RADIUS_KM = 6371.0088
+
+Travel = namedtuple('Travel', 'distance_km minutes speed_kmh impossible')
+NO_TRAVEL = Travel(0.0, None, 0.0, False)
+
+
+def normalize_city(name):
+    return ' '.join(str(name).lower().split()) if name else ''
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between points given in radians (scalars or arrays)."""
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class Gazetteer:
+    def __init__(self, names, countries, lat, lon, aliases=None):
+        self.names = list(names)
+        self.countries = list(countries)
+        self.lat = np.radians(np.asarray(lat, dtype=float))
+        self.lon = np.radians(np.asarray(lon, dtype=float))
+        self._index = {}
+        for i, name in enumerate(self.names):
+            self._index.setdefault(normalize_city(name), i)
+        for i, extra in enumerate(aliases or []):
+            for alias in extra:
+                self._index.setdefault(normalize_city(alias), i)
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or GAZETTEER_PATH
+        names, countries, lat, lon, aliases = [], [], [], [], []
+        try:
+            with open(path, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    names.append(row['name'])
+                    countries.append(row.get('country', ''))
+                    lat.append(float(row['lat']))
+                    lon.append(float(row['lon']))
+                    aliases.append([a for a in (row.get('aliases') or '').split('|') if a])
+        except OSError as e:
+            logging.error(f"Gazetteer not loaded ({e}); impossible travel uses the time-only rule")
+        return cls(names, countries, lat, lon, aliases)
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, name):
+        """Row index for a city name ('Mumbai', 'mumbai, maharashtra'), or -1 if unknown."""
+        key = normalize_city(name)
+        index = self._index.get(key)
+        if index is None and ',' in key:
+            index = self._index.get(key.split(',', 1)[0].strip())
+        return -1 if index is None else index
+
+    def lookup_many(self, names):
+        names = np.asarray(names, dtype=str)
+        if not len(names):
+            return np.zeros(0, dtype=int)
+        uniques, inverse = np.unique(names, return_inverse=True)
+        return np.array([self.lookup(u) for u in uniques], dtype=int)[inverse]
+
+    def distance_km(self, a, b):
+        """Distances between row indices (arrays); NaN where either city is unknown."""
+        a = np.asarray(a)
+        b = np.asarray(b)
+        known = (a >= 0) & (b >= 0)
+        ia, ib = np.where(known, a, 0), np.where(known, b, 0)
+        if not len(self):
+            return np.full(np.shape(known), np.nan)
+        dist = haversine_km(self.lat[ia], self.lon[ia], self.lat[ib], self.lon[ib])
+        return np.where(known, dist, np.nan)
+
+
+gazetteer = Gazetteer.load()
+
+
+def assess_travel_many(from_cities, to_cities, minutes):
+    """
+    Vectorized travel check. `minutes` is the time since the previous
+    transaction (NaN or inf when there is none). Returns a dict of arrays:
+    distance_km (NaN if unknown), speed_kmh and impossible.
+    """
+    from_norm = np.array([normalize_city(c) for c in from_cities], dtype=str)
+    to_norm = np.array([normalize_city(c) for c in to_cities], dtype=str)
+    minutes = np.asarray(minutes, dtype=float)
+    a, b = gazetteer.lookup_many(from_norm), gazetteer.lookup_many(to_norm)
+    known = (a >= 0) & (b >= 0)
+    moved = (from_norm != '') & (to_norm != '') & (from_norm != to_norm) & ~(known & (a == b))
+    distance = gazetteer.distance_km(a, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(minutes > 0, distance / (minutes / 60), np.inf)
+    speed = np.where(known & moved & ~np.isnan(minutes), speed, 0.0)
+    impossible = np.where(
+        known,
+        moved & (distance >= GEO_MIN_DISTANCE_KM) & (speed > GEO_MAX_SPEED_KMH),
+        moved & (minutes < IMPOSSIBLE_TRAVEL_MINUTES),
+    )
+    return {'distance_km': distance, 'speed_kmh': speed, 'impossible': impossible}
+
+
+def assess_travel(from_city, to_city, minutes):
+    """
+    Travel between the previous and the current transaction's city (one row);
+    the scalar twin of assess_travel_many, with `minutes` None when unknown.
+    """
+    from_norm, to_norm = normalize_city(from_city), normalize_city(to_city)
+    if not from_norm or not to_norm:
+        return NO_TRAVEL._replace(minutes=minutes)
+    a, b = gazetteer.lookup(from_norm), gazetteer.lookup(to_norm)
+    known = a >= 0 and b >= 0
+    moved = from_norm != to_norm and not (known and a == b)
+    if not known:
+        impossible = moved and minutes is not None and minutes < IMPOSSIBLE_TRAVEL_MINUTES
+        return Travel(None, minutes, 0.0, bool(impossible))
+    lat1, lon1, lat2, lon2 = (float(gazetteer.lat[a]), float(gazetteer.lon[a]),
+                              float(gazetteer.lat[b]), float(gazetteer.lon[b]))
+    h = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    distance = 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(h, 1.0)))
+    speed = 0.0
+    if moved and minutes is not None:
+        speed = distance / (minutes / 60) if minutes > 0 else math.inf
+    impossible = moved and distance >= GEO_MIN_DISTANCE_KM and speed > GEO_MAX_SPEED_KMH
+    return Travel(round(distance, 1), minutes, speed, impossible)
@@ -0,0 +1,229 @@
+"""
+Lightweight in-process metrics with Prometheus text exposition.
+
+    with span('verify_card'):
+        ...
+
+records the block's duration in the `payment_stage_seconds` histogram, and
+`stage_clock().mark(stage)` times consecutive stages without nesting blocks.
+METRICS_SAMPLE_RATE (0-1) controls what fraction of spans is timed; at 0 a
+span is a shared no-op object, so instrumentation costs well under a
+microsecond on the hot path.
+"""
+import os
+import time
+import random
+import threading
+from bisect import bisect_left
+
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 1.0))
+
+# Latency buckets in seconds (100us .. 10s)
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_collectors = []
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [count per bucket..., count above last bucket, count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2) + [0.0]
+            series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            le = _format_labels(self.labelnames, labels, ('le', '+Inf'))
+            lines.append(f'{self.name}_bucket{le} {series[-2]}')
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_count{label_str} {series[-2]}')
+            lines.append(f'{self.name}_sum{label_str} {_format_value(series[-1])}')
+        return lines
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+
+def sampled():
+    """Whether to time this span/request, per METRICS_SAMPLE_RATE."""
+    rate = METRICS_SAMPLE_RATE
+    return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+
+def timer(histogram, *labels):
+    """Context manager timing a block into `histogram` (no-op when not sampled)."""
+    if not sampled():
+        return _NOOP
+    return _Span(histogram, labels)
+
+
+def set_sample_rate(rate):
+    global METRICS_SAMPLE_RATE
+    METRICS_SAMPLE_RATE = float(rate)
+
+
+def register_collector(fn):
+    """
+    Register a callable returning [(name, type, help, {label: value} or None, value), ...]
+    that is evaluated at scrape time (used to export component stats as gauges).
+    """
+    _collectors.append(fn)
+    return fn
+
+
+def render():
+    """All metrics in Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    seen = set()
+    for collect in _collectors:
+        try:
+            samples = collect()
+        except Exception:
+            continue
+        for name, kind, documentation, labels, value in samples:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {kind}')
+            names = tuple(labels) if labels else ()
+            values = tuple(labels.values()) if labels else ()
+            lines.append(f'{name}{_format_labels(names, values)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+# Shared metrics for the payment hot path
+STAGE_SECONDS = Histogram('payment_stage_seconds', 'Time spent in each payment processing stage',
+                          ('stage',))
+MODEL_SECONDS = Histogram('model_predict_seconds', 'Duration of model scoring calls', ('path',))
+MODEL_BATCH_ROWS = Histogram('model_batch_rows', 'Rows scored per model call', (),
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 1024, 4096, 16384))
+REQUEST_SECONDS = Histogram('http_request_seconds', 'API request latency', ('endpoint',))
+PAYMENTS = Counter('payments_total', 'Payments processed by outcome', ('status',))
+MODEL_ERRORS = Counter('model_predict_errors_total', 'Model scoring calls that failed', ())
+
+
+def span(stage):
+    """Time one payment stage: `with span('commit'): conn.commit()`."""
+    if not sampled():
+        return _NOOP
+    return _Span(STAGE_SECONDS, (stage,))
+
+
+class _NoopClock:
+    __slots__ = ()
+
+    def mark(self, stage):
+        pass
+
+
+_NOOP_CLOCK = _NoopClock()
+
+
+class _StageClock:
+    """Sequential stages: each mark() records the time since the previous mark."""
+
+    __slots__ = ('last',)
+
+    def __init__(self):
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        STAGE_SECONDS.observe(now - self.last, stage)
+        self.last = now
+
+
+def stage_clock():
+    """Clock for a request's stages, or a shared no-op when this request is not sampled."""
+    if not sampled():
+        return _NOOP_CLOCK
+    return _StageClock()
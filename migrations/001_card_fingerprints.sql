@@ -0,0 +1,9 @@
+-- Keyed card fingerprints and CVV verifiers next to the Fernet ciphertext
+-- Run once against an existing database, then backfill existing rows:
+--   python card_index.py --backfill
+USE fraud_detection_system;
+
+ALTER TABLE users
+    ADD COLUMN card_fingerprint CHAR(64) NULL AFTER encrypted_cvv,
+    ADD COLUMN cvv_verifier VARCHAR(100) NULL AFTER card_fingerprint,
+    ADD INDEX idx_card_fingerprint (card_fingerprint);
@@ -0,0 +1,6 @@
+-- Model registry version that scored each transaction (model_registry.py)
+-- Run once against an existing database; older rows keep NULL.
+USE fraud_detection_system;
+
+ALTER TABLE transactions
+    ADD COLUMN model_version VARCHAR(64) NULL AFTER prediction_method;
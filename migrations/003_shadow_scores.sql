@@ -0,0 +1,21 @@
+-- Candidate vs production model scores written by shadow_scoring.py
+-- Run once against an existing database.
+USE fraud_detection_system;
+
+CREATE TABLE IF NOT EXISTS shadow_scores (
+    shadow_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    transaction_id INT NOT NULL,
+    user_id VARCHAR(50) NOT NULL,
+    canary BOOLEAN DEFAULT FALSE,
+    live_version VARCHAR(64),
+    live_ml_score FLOAT,
+    live_fraud_score FLOAT,
+    live_status VARCHAR(20),
+    shadow_version VARCHAR(64),
+    shadow_ml_score FLOAT,
+    shadow_fraud_score FLOAT,
+    shadow_status VARCHAR(20),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX idx_shadow_transaction (transaction_id),
+    INDEX idx_shadow_version (shadow_version, created_at)
+);
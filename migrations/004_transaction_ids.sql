@@ -0,0 +1,11 @@
+-- Transaction id reservations for the write-behind transaction log (txlog.py)
+-- Run once against an existing database.
+USE fraud_detection_system;
+
+CREATE TABLE IF NOT EXISTS transaction_ids (
+    name VARCHAR(32) PRIMARY KEY,
+    next_id BIGINT NOT NULL
+);
+
+INSERT IGNORE INTO transaction_ids (name, next_id)
+SELECT 'transactions', COALESCE(MAX(transaction_id), 0) + 1 FROM transactions;
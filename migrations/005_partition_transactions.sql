@@ -0,0 +1,36 @@
+-- Monthly RANGE partitions of transactions on `timestamp` (partition_maintenance.py)
+-- Run once against an existing database, then schedule
+-- `python partition_maintenance.py run` daily.
+--
+-- MySQL partitioned tables cannot take part in foreign keys, and every unique
+-- key must include the partitioning column. So the two foreign keys involving
+-- transactions are dropped (deleting a user no longer cascades to its
+-- transactions or their OTP rows) and the primary key becomes
+-- (transaction_id, timestamp); AUTO_INCREMENT keeps working on its first column.
+-- The foreign key names are the ones MySQL generates for
+-- database_schema_complete.sql; check SHOW CREATE TABLE if yours differ.
+--
+-- Bounds are UNIX_TIMESTAMP() values computed in the session time zone: run
+-- this and partition_maintenance.py with the same time_zone. p_history holds
+-- everything before the first month; add monthly partitions for older data
+-- below if it should be archived month by month. Both ALTERs rebuild the
+-- table, so run them in a maintenance window.
+USE fraud_detection_system;
+
+ALTER TABLE otp_verification DROP FOREIGN KEY otp_verification_ibfk_1;
+ALTER TABLE transactions DROP FOREIGN KEY transactions_ibfk_1;
+
+ALTER TABLE transactions
+    MODIFY timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (transaction_id, timestamp);
+
+ALTER TABLE transactions
+    PARTITION BY RANGE (UNIX_TIMESTAMP(timestamp)) (
+        PARTITION p_history VALUES LESS THAN (UNIX_TIMESTAMP('2026-10-01 00:00:00')),
+        PARTITION p202610 VALUES LESS THAN (UNIX_TIMESTAMP('2026-11-01 00:00:00')),
+        PARTITION p202611 VALUES LESS THAN (UNIX_TIMESTAMP('2026-12-01 00:00:00')),
+        PARTITION p202612 VALUES LESS THAN (UNIX_TIMESTAMP('2027-01-01 00:00:00')),
+        PARTITION p202701 VALUES LESS THAN (UNIX_TIMESTAMP('2027-02-01 00:00:00')),
+        PARTITION p_future VALUES LESS THAN MAXVALUE
+    );
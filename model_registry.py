@@ -0,0 +1,281 @@
+"""
+Versioned model registry with hot reload.
+
+    MODEL_REGISTRY_DIR/             (default: models/registry)
+        CURRENT                     name of the live version
+        v3/model.pkl
+        v3/metadata.json            version, sha256, n_features_in, size, source, created_at
+
+Publish, activate and roll back from the command line:
+    python model_registry.py publish model.pkl --version v3 --activate
+    python model_registry.py activate v2
+    python model_registry.py list
+
+The app resolves the live model from CURRENT at startup. While it runs, the
+watcher re-reads CURRENT every MODEL_REGISTRY_POLL seconds (or at once on
+SIGHUP). A newly activated version is checksummed, loaded and pre-warmed with
+a probe prediction before it takes traffic; requests already being scored
+finish on the old model. Each transaction records the version that scored it
+(transactions.model_version). Without a CURRENT file the app keeps using
+MODEL_PATH and records no version.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import threading
+from collections import namedtuple
+
+from feature_encoding import ML_BLA_FEATURES
+
+MODEL_REGISTRY_DIR = os.environ.get(
+    'MODEL_REGISTRY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'registry'))
+MODEL_REGISTRY_POLL = float(os.environ.get('MODEL_REGISTRY_POLL', 5))  # seconds, 0 = signal only
+ARTIFACT_NAME = 'model.pkl'
+METADATA_NAME = 'metadata.json'
+CURRENT_NAME = 'CURRENT'
+
+ModelVersion = namedtuple('ModelVersion', 'version path metadata')
+
+
+class RegistryError(Exception):
+    """Raised for a missing, corrupt or incompatible model version."""
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_atomic(path, text):
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ModelRegistry:
+    def __init__(self, root=None):
+        self.root = root or MODEL_REGISTRY_DIR
+        self._seen = None
+
+    def _dir(self, version):
+        if not version or os.sep in version or version.startswith('.'):
+            raise RegistryError(f"Invalid model version name: {version!r}")
+        return os.path.join(self.root, version)
+
+    def versions(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.isfile(os.path.join(self.root, name, METADATA_NAME)))
+
+    def get(self, version):
+        directory = self._dir(version)
+        try:
+            with open(os.path.join(directory, METADATA_NAME), encoding='utf-8') as f:
+                metadata = json.load(f)
+        except (OSError, ValueError) as e:
+            raise RegistryError(f"Model version {version} not readable: {e}")
+        return ModelVersion(version, os.path.join(directory, ARTIFACT_NAME), metadata)
+
+    def current_name(self):
+        try:
+            with open(os.path.join(self.root, CURRENT_NAME), encoding='utf-8') as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def current(self):
+        name = self.current_name()
+        return self.get(name) if name else None
+
+    def verify(self, model_version):
+        """Check the artifact against its recorded checksum and the app's feature width."""
+        check_feature_width(model_version.metadata.get('n_features_in'), model_version.version)
+        try:
+            checksum = file_sha256(model_version.path)
+        except OSError as e:
+            raise RegistryError(f"Model version {model_version.version} has no artifact: {e}")
+        if checksum != model_version.metadata.get('sha256'):
+            raise RegistryError(f"Checksum mismatch for model version {model_version.version}")
+        return model_version
+
+    def publish(self, model_path, version=None, activate=False, source=None):
+        """Copy an artifact into the registry with its metadata; optionally make it live."""
+        from predict_worker import load_model
+        version = version or time.strftime('v%Y%m%d%H%M%S')
+        directory = self._dir(version)
+        if os.path.exists(directory):
+            raise RegistryError(f"Model version {version} already exists")
+        try:
+            model = load_model(model_path)  # refuse artifacts that do not load
+        except RuntimeError as e:
+            raise RegistryError(str(e))
+        n_features = getattr(model, 'n_features_in_', None)
+        check_feature_width(n_features, version)
+        os.makedirs(self.root, exist_ok=True)
+        staging = os.path.join(self.root, f".{version}.tmp.{os.getpid()}")
+        os.makedirs(staging)
+        try:
+            artifact = os.path.join(staging, ARTIFACT_NAME)
+            shutil.copyfile(model_path, artifact)
+            metadata = {
+                'version': version,
+                'sha256': file_sha256(artifact),
+                'size_bytes': os.path.getsize(artifact),
+                'n_features_in': int(n_features) if n_features is not None else None,
+                'model_class': type(model).__name__,
+                'source': source or os.path.abspath(model_path),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+            with open(os.path.join(staging, METADATA_NAME), 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, indent=2)
+            os.rename(staging, directory)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        logging.info(f"Published model version {version} from {model_path}")
+        if activate:
+            self.activate(version)
+        return self.get(version)
+
+    def activate(self, version):
+        """Point CURRENT at `version` (atomic rename); running apps pick it up."""
+        model_version = self.verify(self.get(version))
+        _write_atomic(os.path.join(self.root, CURRENT_NAME), version + '\n')
+        logging.info(f"Model version {version} is now current")
+        return model_version
+
+    def poll(self):
+        """The current version if CURRENT changed since the last call, else None."""
+        name = self.current_name()
+        if name is None or name == self._seen:
+            return None
+        self._seen = name
+        return self.get(name)
+
+    def resolve(self, default_path):
+        """(model path, version) to start with: CURRENT if usable, else default_path."""
+        try:
+            model_version = self.current()
+            if model_version is not None:
+                self.verify(model_version)
+                self._seen = model_version.version
+                return model_version.path, model_version.version
+        except RegistryError:
+            logging.exception("Registry model not usable, falling back to MODEL_PATH")
+        return default_path, None
+
+
+def check_feature_width(n_features, version=None):
+    """Refuse a model whose input width is not the one prepare_fraud_check sends."""
+    if n_features is not None and int(n_features) != ML_BLA_FEATURES:
+        raise RegistryError(f"Model version {version} takes {n_features} features; "
+                            f"the app sends {ML_BLA_FEATURES} (ML_Only rows padded)")
+
+
+registry = ModelRegistry()
+
+
+def probe_rows():
+    """A zero row as wide as the rows the app scores, used to check and warm a new model."""
+    return [[0.0] * ML_BLA_FEATURES]
+
+
+def apply_version(model_version, server=None):
+    """Verify, load, pre-warm and swap in a registry version for this process."""
+    registry.verify(model_version)
+    if server is not None or os.environ.get('MODEL_SERVER', '1') != '0':
+        from model_server import get_model_server
+        server = server or get_model_server()
+        if not server.reload(model_version.path, model_version.version, probe_rows()):
+            raise RegistryError(f"Model version {model_version.version} failed to load")
+    # One-shot predict_worker processes (MODEL_SERVER=0) read these when spawned
+    os.environ['MODEL_PATH'] = model_version.path
+    os.environ['MODEL_VERSION'] = model_version.version
+    return model_version
+
+
+class ModelWatcher:
+    """Background thread applying registry changes (poll + on-demand check)."""
+
+    def __init__(self, on_change=None, interval=None, source=None):
+        self.on_change = on_change or apply_version
+        self.interval = MODEL_REGISTRY_POLL if interval is None else interval
+        self.source = source or registry
+        self._wake = threading.Event()
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            threading.Thread(target=self._run, name='model-watcher', daemon=True).start()
+        return self
+
+    def check_now(self, *_):
+        """Request an immediate check; safe to call from a signal handler."""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval if self.interval > 0 else None)
+            self._wake.clear()
+            self.check()
+
+    def check(self):
+        try:
+            model_version = self.source.poll()
+            if model_version is None:
+                return None
+            logging.info(f"Model version {model_version.version} activated, swapping in")
+            return self.on_change(model_version)
+        except Exception:
+            logging.exception("Model reload failed; keeping the current model")
+            return None
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Versioned model registry")
+    ap.add_argument('--root', help="registry directory (default: MODEL_REGISTRY_DIR)")
+    sub = ap.add_subparsers(dest='command', required=True)
+    pub = sub.add_parser('publish', help="add a model artifact as a new version")
+    pub.add_argument('model_path')
+    pub.add_argument('--version')
+    pub.add_argument('--activate', action='store_true')
+    act = sub.add_parser('activate', help="make a version current (deploy or roll back)")
+    act.add_argument('version')
+    sub.add_parser('list', help="list versions")
+    args = ap.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    reg = ModelRegistry(args.root)
+    try:
+        if args.command == 'publish':
+            mv = reg.publish(args.model_path, args.version, activate=args.activate)
+            print(f"{mv.version} sha256={mv.metadata['sha256']} n_features_in={mv.metadata['n_features_in']}")
+        elif args.command == 'activate':
+            reg.activate(args.version)
+        else:
+            current = reg.current_name()
+            for version in reg.versions():
+                meta = reg.get(version).metadata
+                print(f"{'*' if version == current else ' '} {version:<20} {meta.get('created_at', '')} "
+                      f"n_features_in={meta.get('n_features_in')} sha256={meta.get('sha256', '')[:12]}")
+    except RegistryError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,339 @@
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+import subprocess
+
+from predict_worker import read_frame, write_frame, load_scoring_model, run_action
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'predict_worker.py')
+
+# Pool sizing and timeouts (override through the environment)
+DEFAULT_WORKERS = int(os.environ.get('MODEL_WORKERS', min(4, os.cpu_count() or 1)))
+DEFAULT_TIMEOUT = float(os.environ.get('MODEL_TIMEOUT', 5))
+STARTUP_TIMEOUT = float(os.environ.get('MODEL_STARTUP_TIMEOUT', 60))
+RESPAWN_BACKOFF_MAX = float(os.environ.get('MODEL_RESPAWN_BACKOFF_MAX', 30))  # seconds
+
+
+class WorkerError(Exception):
+    """Raised when a scoring worker dies, times out or cannot be reached."""
+
+
+class _Worker:
+    """One long-lived `predict_worker.py --serve` process with the model loaded."""
+
+    def __init__(self, model_path, version=None, generation=0):
+        env = dict(os.environ)
+        env['MODEL_PATH'] = model_path
+        env['MODEL_VERSION'] = version or ''
+        self.proc = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT, '--serve'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env
+        )
+        self.model_path = model_path
+        self.version = version
+        self.generation = generation
+        self.info = {}
+        self._responses = queue.Queue()
+        threading.Thread(target=self._read_stdout, daemon=True).start()
+        threading.Thread(target=self._read_stderr, daemon=True).start()
+
+    def _read_stdout(self):
+        try:
+            while True:
+                frame = read_frame(self.proc.stdout)
+                if frame is None:
+                    break
+                self._responses.put(frame)
+        except Exception:
+            logging.exception("predict_worker %s: bad frame", self.proc.pid)
+        self._responses.put(None)
+
+    def _read_stderr(self):
+        for line in iter(self.proc.stderr.readline, b''):
+            logging.warning("predict_worker %s stderr: %s", self.proc.pid,
+                            line.decode('utf-8', 'replace').rstrip())
+
+    def wait_ready(self, timeout):
+        self.info = self._receive(timeout)
+        if not self.info.get('ready'):
+            raise WorkerError(f"unexpected handshake from predict_worker: {self.info}")
+        if self.info.get('error'):
+            logging.error(f"predict_worker {self.proc.pid} started without a model: {self.info['error']}")
+        return self
+
+    def warm(self, probe, timeout):
+        """Check a freshly started worker with a probe prediction before it takes traffic."""
+        if self.info.get('error'):
+            raise WorkerError(self.info['error'])
+        if not probe:
+            return self
+        expected = self.info.get('n_features_in')
+        if expected is not None and expected != len(probe[0]):
+            raise WorkerError(f"model expects {expected} features, probe has {len(probe[0])}")
+        response = self.request({'features': probe, 'action': 'predict_proba'}, timeout)
+        if 'error' in response:
+            raise WorkerError(f"probe prediction failed: {response['error']}")
+        return self
+
+    def _receive(self, timeout):
+        try:
+            frame = self._responses.get(timeout=timeout)
+        except queue.Empty:
+            raise WorkerError(f"predict_worker {self.proc.pid} timed out after {timeout}s")
+        if frame is None:
+            raise WorkerError(f"predict_worker {self.proc.pid} exited with code {self.proc.poll()}")
+        return frame
+
+    def request(self, payload, timeout):
+        try:
+            write_frame(self.proc.stdin, payload)
+        except (BrokenPipeError, OSError, ValueError) as e:
+            raise WorkerError(f"predict_worker {self.proc.pid} is gone: {e}")
+        return self._receive(timeout)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def kill(self):
+        try:
+            self.proc.kill()
+            self.proc.wait(timeout=5)
+        except Exception:
+            pass
+
+
+class ModelServer:
+    """
+    Pool of persistent scoring processes.
+
+    Each worker loads the model once and then serves framed requests, so the
+    request path never spawns a process or reloads the model. A worker that
+    crashes or exceeds the timeout is killed and replaced in the background,
+    keeping the isolation guarantees of the old one-shot subprocess.
+
+    reload() swaps the whole pool to another model: workers belong to a
+    generation and a worker from an older generation is retired as soon as
+    it is idle, so no request is dropped and none waits for a model load.
+    """
+
+    def __init__(self, model_path=None, size=None, timeout=None, version=None):
+        self.model_path = model_path or os.environ.get('MODEL_PATH', 'model.pkl')
+        self.version = version or os.environ.get('MODEL_VERSION') or None
+        self.size = size or DEFAULT_WORKERS
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._started = False
+        self._closed = False
+        self.generation = 0
+        self.restarts = 0
+        self.reloads = 0
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        workers = [self._new_worker() for _ in range(self.size)]
+        for worker in workers:
+            try:
+                self._idle.put(worker.wait_ready(STARTUP_TIMEOUT))
+            except WorkerError:
+                logging.exception("predict_worker failed to start")
+                worker.kill()
+                self._replace_async()
+        logging.info(f"Model server started with {self.size} workers for {self.model_path}")
+        return self
+
+    def _new_worker(self):
+        return _Worker(self.model_path, self.version, self.generation)
+
+    def _spawn(self):
+        delay = 1
+        while not self._closed:
+            worker = self._new_worker()
+            try:
+                worker.wait_ready(STARTUP_TIMEOUT)
+            except WorkerError:
+                logging.exception(f"predict_worker failed to restart; retrying in {delay}s")
+                worker.kill()
+                # A worker that cannot start now (bad import, out of memory) will not a moment later either
+                time.sleep(delay)
+                delay = min(delay * 2, RESPAWN_BACKOFF_MAX)
+                continue
+            if self._closed or worker.generation != self.generation:
+                worker.kill()
+            else:
+                self._idle.put(worker)
+            return
+
+    def _replace_async(self):
+        self.restarts += 1
+        threading.Thread(target=self._spawn, daemon=True).start()
+
+    def request(self, payload, timeout=None):
+        """Send one request to an idle worker and return its decoded response."""
+        if not self._started:
+            self.start()
+        timeout = timeout or self.timeout
+        while True:
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise WorkerError(f"no scoring worker available within {timeout}s")
+            if worker.generation != self.generation:
+                worker.kill()  # replaced by a reload
+                continue
+            if worker.alive():
+                break
+            # Died while idle: replace it and try the next one
+            worker.kill()
+            self._replace_async()
+        try:
+            response = worker.request(payload, timeout)
+        except WorkerError:
+            # Crashed or hung: never hand this process out again
+            worker.kill()
+            self._replace_async()
+            raise
+        if worker.generation == self.generation:
+            self._idle.put(worker)
+        else:
+            worker.kill()
+        response['model_version'] = worker.version
+        return response
+
+    def reload(self, model_path, version=None, probe=None):
+        """
+        Start a full set of workers on another model, pre-warm them with
+        `probe` rows and swap them in at once. Returns False, leaving the
+        current model live, if the new one does not start cleanly.
+        """
+        with self._reload_lock:
+            generation = self.generation + 1
+            workers = [_Worker(model_path, version, generation) for _ in range(self.size)]
+            try:
+                for worker in workers:
+                    worker.wait_ready(STARTUP_TIMEOUT).warm(probe, STARTUP_TIMEOUT)
+            except WorkerError:
+                logging.exception(f"Model {version or model_path} failed to start; keeping {self.version or self.model_path}")
+                for worker in workers:
+                    worker.kill()
+                return False
+            with self._lock:
+                self.model_path, self.version, self.generation = model_path, version, generation
+                self._started = True
+                self.reloads += 1
+            while True:
+                try:
+                    self._idle.get_nowait().kill()
+                except queue.Empty:
+                    break
+            for worker in workers:
+                self._idle.put(worker)
+        logging.info(f"Model server now serving {version or model_path} with {self.size} workers")
+        return True
+
+    def stop(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().kill()
+            except queue.Empty:
+                break
+
+
+class LocalModel:
+    """
+    The model loaded into this process (MODEL_SERVER=inprocess).
+
+    Same request() interface as ModelServer but scored in the calling thread.
+    prefork_server.py loads it in the master before forking so every worker
+    shares one copy of the model memory copy-on-write.
+    """
+
+    def __init__(self, model_path=None, size=None, timeout=None, version=None):
+        self.model_path = model_path or os.environ.get('MODEL_PATH', 'model.pkl')
+        self.version = version or os.environ.get('MODEL_VERSION') or None
+        self.model = None
+        self.load_error = None
+        self.restarts = 0
+        self.reloads = 0
+        self._live = (None, None)  # (model, version), swapped as one reference
+
+    def start(self):
+        if self.model is None and self.load_error is None:
+            try:
+                self.model = load_scoring_model(self.model_path)
+                self._live = (self.model, self.version)
+                logging.info(f"Model loaded in process {os.getpid()} from {self.model_path}")
+            except Exception as e:
+                logging.error(f"In-process model not loaded: {e}")
+                self.load_error = str(e)
+        return self
+
+    def reload(self, model_path, version=None, probe=None):
+        """Load and pre-warm another model, then swap it in; False keeps the current one."""
+        try:
+            model = load_scoring_model(model_path)
+            expected = getattr(model, 'n_features_in_', None)
+            if probe and expected is not None and expected != len(probe[0]):
+                raise ValueError(f"model expects {expected} features, probe has {len(probe[0])}")
+            if probe:
+                run_action(model, probe, 'predict_proba')
+        except Exception:
+            logging.exception(f"Model {version or model_path} failed to load; keeping {self.version or self.model_path}")
+            return False
+        self._live = (model, version)
+        self.model, self.model_path, self.version, self.load_error = model, model_path, version, None
+        self.reloads += 1
+        logging.info(f"Process {os.getpid()} now serving model {version or model_path}")
+        return True
+
+    def request(self, payload, timeout=None):
+        self.start()
+        model, version = self._live
+        try:
+            if model is None:
+                raise RuntimeError(self.load_error)
+            response = run_action(model, payload.get('features'), payload.get('action'))
+        except Exception as e:
+            return {'error': str(e)}
+        response['model_version'] = version
+        return response
+
+    def stop(self):
+        pass
+
+
+def create_model_server(**kwargs):
+    """A new scoring backend of the configured kind (MODEL_SERVER=inprocess or the process pool)."""
+    cls = LocalModel if os.environ.get('MODEL_SERVER', '1') == 'inprocess' else ModelServer
+    return cls(**kwargs)
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def get_model_server():
+    """Return the process-wide model server, creating it on first use."""
+    global _server
+    if _server is None:
+        with _server_lock:
+            if _server is None:
+                _server = create_model_server()
+    return _server
+
+
+def start_model_server(**kwargs):
+    """Create and warm the process-wide model server (call at application startup)."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = create_model_server(**kwargs)
+    return _server.start()
@@ -0,0 +1,182 @@
+"""
+Asynchronous OTP delivery.
+
+process_payment queues the OTP after its commit and returns immediately; a
+small pool of worker threads delivers it through a pluggable transport with
+retries and exponential backoff.
+
+Transports (OTP_TRANSPORT):
+    log   - write the OTP to the application log (default, development)
+    file  - append one JSON line per OTP to OTP_FILE_PATH (local testing)
+    smtp  - send an email through SMTP_HOST:SMTP_PORT; point it at a debugging
+            SMTP server (e.g. `python -m aiosmtpd -n`) to test locally
+"""
+import os
+import json
+import time
+import queue
+import random
+import smtplib
+import logging
+import threading
+from email.message import EmailMessage
+
+OTP_TRANSPORT = os.environ.get('OTP_TRANSPORT', 'log')
+OTP_WORKERS = int(os.environ.get('OTP_WORKERS', 2))
+OTP_QUEUE_SIZE = int(os.environ.get('OTP_QUEUE_SIZE', 10000))
+OTP_MAX_ATTEMPTS = int(os.environ.get('OTP_MAX_ATTEMPTS', 4))
+OTP_BACKOFF_BASE = float(os.environ.get('OTP_BACKOFF_BASE', 0.5))  # seconds, doubled per retry
+OTP_BACKOFF_MAX = float(os.environ.get('OTP_BACKOFF_MAX', 10))
+
+
+class LogTransport:
+    def send(self, message):
+        logging.info(f"OTP {message['otp_code']} for transaction {message['transaction_id']} "
+                     f"-> {message.get('email')} / {message.get('mobile_number')}")
+
+
+class FileTransport:
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('OTP_FILE_PATH', 'otp_outbox.jsonl')
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        line = json.dumps(message, default=str)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+class SMTPTransport:
+    def __init__(self, host=None, port=None, sender=None, username=None, password=None,
+                 use_tls=None, timeout=10):
+        self.host = host or os.environ.get('SMTP_HOST', '127.0.0.1')
+        self.port = int(port or os.environ.get('SMTP_PORT', 1025))
+        self.sender = sender or os.environ.get('SMTP_SENDER', 'no-reply@fraud-detection.local')
+        self.username = username or os.environ.get('SMTP_USER')
+        self.password = password or os.environ.get('SMTP_PASSWORD')
+        self.use_tls = use_tls if use_tls is not None else os.environ.get('SMTP_TLS', '0') == '1'
+        self.timeout = timeout
+
+    def send(self, message):
+        if not message.get('email'):
+            raise ValueError(f"No email for transaction {message['transaction_id']}")
+        msg = EmailMessage()
+        msg['Subject'] = 'Your payment verification code'
+        msg['From'] = self.sender
+        msg['To'] = message['email']
+        msg.set_content(
+            f"Your OTP for transaction {message['transaction_id']} is {message['otp_code']}.\n"
+            f"It expires at {message.get('expires_at')}."
+        )
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(msg)
+
+
+TRANSPORTS = {
+    'log': LogTransport,
+    'file': FileTransport,
+    'smtp': SMTPTransport,
+}
+
+
+class OTPDispatcher:
+    """Bounded queue + worker threads delivering OTP messages with retries."""
+
+    def __init__(self, transport=None, workers=None, queue_size=None,
+                 max_attempts=None, backoff_base=None, backoff_max=None):
+        self.transport = transport or TRANSPORTS[OTP_TRANSPORT]()
+        self.workers = workers or OTP_WORKERS
+        self.max_attempts = max_attempts or OTP_MAX_ATTEMPTS
+        self.backoff_base = OTP_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.backoff_max = OTP_BACKOFF_MAX if backoff_max is None else backoff_max
+        self._queue = queue.Queue(maxsize=queue_size or OTP_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._started = False
+        self.metrics = self._new_metrics()
+
+    @staticmethod
+    def _new_metrics():
+        return {
+            'queued': 0, 'sent': 0, 'failed': 0, 'retries': 0, 'dropped': 0,
+            'delivery_seconds_total': 0.0, 'delivery_seconds_max': 0.0,
+        }
+
+    def after_fork(self):
+        """Reset in a forked child: the parent's worker threads do not exist there."""
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._started = False
+        self.metrics = self._new_metrics()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'otp-dispatch-{i}', daemon=True).start()
+        return self
+
+    def submit(self, message):
+        """Queue an OTP for delivery; never blocks. Returns False if the queue is full."""
+        if not self._started:
+            self.start()
+        try:
+            self._queue.put_nowait((time.monotonic(), message))
+        except queue.Full:
+            self._count('dropped')
+            logging.error(f"OTP queue full, dropped OTP for transaction {message.get('transaction_id')}")
+            return False
+        self._count('queued')
+        return True
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.metrics[name] += value
+
+    def _work(self):
+        while True:
+            queued_at, message = self._queue.get()
+            try:
+                self._deliver(message)
+                elapsed = time.monotonic() - queued_at
+                with self._lock:
+                    self.metrics['sent'] += 1
+                    self.metrics['delivery_seconds_total'] += elapsed
+                    self.metrics['delivery_seconds_max'] = max(self.metrics['delivery_seconds_max'], elapsed)
+            except Exception:
+                self._count('failed')
+                logging.exception(f"OTP delivery failed for transaction {message.get('transaction_id')}")
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, message):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.transport.send(message)
+                return
+            except Exception as e:
+                if attempt == self.max_attempts:
+                    raise
+                delay = min(self.backoff_base * (2 ** (attempt - 1)), self.backoff_max)
+                delay *= random.uniform(0.5, 1.0)  # jitter
+                self._count('retries')
+                logging.warning(f"OTP send attempt {attempt} failed ({e}); retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+    def wait(self):
+        """Block until everything queued so far has been handled (tests/shutdown)."""
+        self._queue.join()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+
+otp_dispatcher = OTPDispatcher()
@@ -0,0 +1,182 @@
+"""
+Pending OTPs, held in memory.
+
+process_payment puts each OTP here once its payment has committed, and
+verify_otp_endpoint finds it by transaction_id with a dict lookup instead of
+JOINing otp_verification with transactions. A verified OTP is claimed
+(removed) atomically, so two concurrent submits in this process cannot both
+approve it; the conditional UPDATE of the transaction covers other processes.
+
+With OTP_STORE_MIRROR=1 (default) every OTP is also written to
+otp_verification with its payment, and marked verified there. A verification
+that misses memory - served by another worker or server, after a restart, or
+after eviction - falls back to the database. With 0 the database is left out:
+only safe when one process issues and verifies every OTP.
+
+A sweeper thread drops OTPs OTP_RETENTION seconds past their expiry (until
+then a late attempt is told the OTP expired) and deletes expired
+otp_verification rows OTP_SWEEP_BATCH at a time.
+"""
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from db_pool import get_pool
+
+OTP_STORE_SIZE = int(os.environ.get('OTP_STORE_SIZE', 100000))
+OTP_STORE_MIRROR = os.environ.get('OTP_STORE_MIRROR', '1') == '1'
+OTP_RETENTION = int(os.environ.get('OTP_RETENTION', 600))  # seconds after expiry
+OTP_SWEEP_INTERVAL = float(os.environ.get('OTP_SWEEP_INTERVAL', 30))
+OTP_SWEEP_BATCH = int(os.environ.get('OTP_SWEEP_BATCH', 1000))
+
+# Database fallback. OTPs expire within minutes: the time bound keeps the
+# lookup to the newest partitions of transactions
+OTP_LOOKUP_QUERY = """
+    SELECT ov.otp_code, ov.expires_at, ov.user_id, t.amount, ov.transaction_id
+    FROM otp_verification ov
+    JOIN transactions t ON ov.transaction_id = t.transaction_id
+    WHERE ov.transaction_id = %s AND t.timestamp >= NOW() - INTERVAL 1 DAY
+"""
+
+# Only a transaction still waiting for its OTP: a repeated submit must not debit twice
+APPROVE_OTP_TRANSACTION = """
+    UPDATE transactions SET status = 'Approved', otp_verified = TRUE
+    WHERE transaction_id = %s AND status = 'OTP_Sent'
+      AND timestamp >= NOW() - INTERVAL 1 DAY
+"""
+
+MARK_OTP_VERIFIED = "UPDATE otp_verification SET verified = TRUE WHERE transaction_id = %s"
+
+PURGE_EXPIRED_OTPS = """
+    DELETE FROM otp_verification
+    WHERE expires_at < NOW() - INTERVAL %s SECOND
+    LIMIT %s
+"""
+
+
+def _key(transaction_id):
+    try:
+        return int(transaction_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class OTPStore:
+    """Bounded map of transaction_id -> pending OTP, oldest first, with a sweeper thread."""
+
+    def __init__(self, max_size=None, mirror=None, retention=None, sweep_interval=None, sweep_batch=None):
+        self.max_size = max_size or OTP_STORE_SIZE
+        self.mirror = OTP_STORE_MIRROR if mirror is None else mirror
+        self.retention = OTP_RETENTION if retention is None else retention
+        self.sweep_interval = sweep_interval or OTP_SWEEP_INTERVAL
+        self.sweep_batch = sweep_batch or OTP_SWEEP_BATCH
+        self._reset()
+
+    def _reset(self):
+        self._entries = OrderedDict()  # transaction_id -> OTP; expiry order, as every OTP lives equally long
+        self._lock = threading.Lock()
+        self._started = False
+        self.metrics = {'stored': 0, 'hits': 0, 'misses': 0, 'claimed': 0, 'evictions': 0,
+                        'swept': 0, 'purged_rows': 0}
+
+    def after_fork(self):
+        """Reset in a forked child: the parent's sweeper thread does not exist there."""
+        self._reset()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        threading.Thread(target=self._run, name='otp-sweeper', daemon=True).start()
+        return self
+
+    def put(self, transaction_id, user_id, amount, otp_code, expires_at):
+        entry = {'transaction_id': transaction_id, 'user_id': user_id, 'amount': amount,
+                 'otp_code': otp_code, 'expires_at': expires_at}
+        with self._lock:
+            self._entries[_key(transaction_id)] = entry
+            self.metrics['stored'] += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.metrics['evictions'] += 1
+
+    def get(self, transaction_id):
+        """The pending OTP for a transaction, or None if this process does not hold it."""
+        with self._lock:
+            entry = self._entries.get(_key(transaction_id))
+            self.metrics['hits' if entry is not None else 'misses'] += 1
+            return entry
+
+    def claim(self, transaction_id):
+        """Take the OTP out for approval; None if another request already did."""
+        with self._lock:
+            entry = self._entries.pop(_key(transaction_id), None)
+            if entry is not None:
+                self.metrics['claimed'] += 1
+            return entry
+
+    def restore(self, entry):
+        """Put back a claimed OTP whose approval did not commit."""
+        with self._lock:
+            self._entries.setdefault(_key(entry['transaction_id']), entry)
+
+    def sweep(self, now=None):
+        """Drop OTPs past expiry + retention; returns how many."""
+        cutoff = (now or datetime.now()) - timedelta(seconds=self.retention)
+        swept = 0
+        with self._lock:
+            while self._entries:
+                key, entry = next(iter(self._entries.items()))
+                if entry['expires_at'] >= cutoff:
+                    break
+                del self._entries[key]
+                swept += 1
+            self.metrics['swept'] += swept
+        return swept
+
+    def purge(self, conn):
+        """Delete otp_verification rows past expiry + retention, in batches; returns the row count."""
+        purged = 0
+        cursor = conn.cursor()
+        try:
+            while True:
+                cursor.execute(PURGE_EXPIRED_OTPS, (self.retention, self.sweep_batch))
+                deleted = cursor.rowcount
+                conn.commit()
+                purged += max(deleted, 0)
+                if deleted < self.sweep_batch:
+                    break
+        finally:
+            cursor.close()
+        with self._lock:
+            self.metrics['purged_rows'] += purged
+        return purged
+
+    def _run(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.sweep()
+            if not self.mirror:
+                continue
+            conn = None
+            try:
+                conn = get_pool().connection()
+                self.purge(conn)
+            except Exception:
+                logging.exception("Expired OTP purge failed")
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+            stats['pending'] = len(self._entries)
+        return stats
+
+
+otp_store = OTPStore()
@@ -0,0 +1,250 @@
+"""
+Monthly partitions of `transactions` (migrations/005_partition_transactions.sql).
+
+Partition pYYYYMM holds that month's rows, p_history everything before the
+first month and p_future anything past the last one. Run daily:
+
+    python partition_maintenance.py run          # create ahead, archive and drop expired
+    python partition_maintenance.py run --dry-run
+    python partition_maintenance.py status       # partitions with their row estimates
+
+`run` keeps PARTITION_MONTHS_AHEAD months of empty partitions split off
+p_future, so new rows never land in the catch-all. Partitions that ended
+more than PARTITION_RETENTION_MONTHS months before the current one are
+copied to PARTITION_ARCHIVE_DIR/transactions_<partition>.parquet (pyarrow,
+PARTITION_ARCHIVE_COMPRESSION) and then dropped, which is instant and leaves
+no fragmentation behind. The drop is skipped if the file does not hold
+every row of the partition. With PARTITION_ARCHIVE=0 expired partitions are
+dropped without a copy.
+"""
+import os
+import re
+import sys
+import logging
+import argparse
+from datetime import date
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+PARTITION_RETENTION_MONTHS = int(os.environ.get('PARTITION_RETENTION_MONTHS', 13))
+PARTITION_ARCHIVE = os.environ.get('PARTITION_ARCHIVE', '1') == '1'
+PARTITION_ARCHIVE_DIR = os.environ.get(
+    'PARTITION_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+PARTITION_ARCHIVE_COMPRESSION = os.environ.get('PARTITION_ARCHIVE_COMPRESSION', 'zstd')
+PARTITION_ARCHIVE_BATCH = int(os.environ.get('PARTITION_ARCHIVE_BATCH', 50000))
+
+HISTORY = 'p_history'
+FUTURE = 'p_future'
+_MONTHLY = re.compile(r'^p(\d{4})(\d{2})$')
+
+PARTITIONS_QUERY = """
+    SELECT PARTITION_NAME AS name, PARTITION_DESCRIPTION AS bound, TABLE_ROWS AS row_estimate
+    FROM information_schema.PARTITIONS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'transactions' AND PARTITION_NAME IS NOT NULL
+    ORDER BY PARTITION_ORDINAL_POSITION
+"""
+
+# Partition names cannot be bound as parameters; they are checked against _MONTHLY/HISTORY first
+ARCHIVE_QUERY = """
+    SELECT transaction_id, user_id, card_no_last4, amount, transaction_location, transaction_ip,
+           device_id, timestamp, status, fraud_score, ml_score, bla_score, prediction_method,
+           model_version, otp_code, otp_verified
+    FROM transactions PARTITION ({partition})
+    WHERE transaction_id > %s
+    ORDER BY transaction_id
+    LIMIT %s
+"""
+COUNT_QUERY = "SELECT COUNT(*) AS n FROM transactions PARTITION ({partition})"
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+
+def partition_month(name):
+    """First day of the month a pYYYYMM partition holds, None for the other partitions."""
+    match = _MONTHLY.match(name or '')
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def _checked(name):
+    if name != HISTORY and partition_month(name) is None:
+        raise ValueError(f"Not a transactions partition: {name!r}")
+    return name
+
+
+def plan(partitions, today, months_ahead=None, retention_months=None):
+    """
+    (months to create, partitions to archive and drop) for `today`, given the
+    partition names in order. New months continue from the last monthly
+    partition up to `months_ahead` past the current month.
+    """
+    months_ahead = PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    retention_months = PARTITION_RETENTION_MONTHS if retention_months is None else retention_months
+    current = month_start(today)
+    monthly = [month for month in map(partition_month, partitions) if month is not None]
+    month = add_months(max(monthly), 1) if monthly else current
+    create = []
+    while month <= add_months(current, months_ahead):
+        create.append(month)
+        month = add_months(month, 1)
+    # Everything below `cutoff` has left retention; p_history lies below the first month
+    cutoff = add_months(current, -retention_months)
+    expired = [name for name in partitions
+               if (partition_month(name) or date.max) < cutoff
+               or (name == HISTORY and monthly and min(monthly) <= cutoff)]
+    return create, expired
+
+
+def _bound(month):
+    return f"UNIX_TIMESTAMP('{month:%Y-%m-%d} 00:00:00')"
+
+
+def create_statement(months):
+    """Split the new months off p_future."""
+    parts = [f"PARTITION {partition_name(month)} VALUES LESS THAN ({_bound(add_months(month, 1))})"
+             for month in months]
+    parts.append(f"PARTITION {FUTURE} VALUES LESS THAN MAXVALUE")
+    return f"ALTER TABLE transactions REORGANIZE PARTITION {FUTURE} INTO (\n    " + ",\n    ".join(parts) + "\n)"
+
+
+def drop_statement(name):
+    return f"ALTER TABLE transactions DROP PARTITION {_checked(name)}"
+
+
+def _cursor(conn):
+    try:
+        return conn.cursor(dictionary=True)
+    except TypeError:
+        return conn.cursor()  # PyMySQL: DictCursor set at connect
+
+
+def list_partitions(conn):
+    cursor = _cursor(conn)
+    cursor.execute(PARTITIONS_QUERY)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+def _archive_schema(pa):
+    return pa.schema([
+        ('transaction_id', pa.int64()), ('user_id', pa.string()), ('card_no_last4', pa.string()),
+        ('amount', pa.decimal128(10, 2)), ('transaction_location', pa.string()),
+        ('transaction_ip', pa.string()), ('device_id', pa.string()), ('timestamp', pa.timestamp('s')),
+        ('status', pa.string()), ('fraud_score', pa.float64()), ('ml_score', pa.float64()),
+        ('bla_score', pa.float64()), ('prediction_method', pa.string()), ('model_version', pa.string()),
+        ('otp_code', pa.string()), ('otp_verified', pa.bool_()),
+    ])
+
+
+def archive_partition(conn, name, directory=None, compression=None, batch_rows=None):
+    """Copy a partition to a Parquet file, written in batches; returns (path, rows)."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    directory = directory or PARTITION_ARCHIVE_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"transactions_{_checked(name)}.parquet")
+    schema = _archive_schema(pa)
+    query = ARCHIVE_QUERY.format(partition=name)
+    batch_rows = batch_rows or PARTITION_ARCHIVE_BATCH
+    cursor = _cursor(conn)
+    rows = 0
+    last_id = 0
+    with pq.ParquetWriter(path + '.tmp', schema, compression=compression or PARTITION_ARCHIVE_COMPRESSION) as writer:
+        while True:
+            cursor.execute(query, (last_id, batch_rows))
+            batch = cursor.fetchall()
+            if not batch:
+                break
+            for row in batch:
+                if row['otp_verified'] is not None:
+                    row['otp_verified'] = bool(row['otp_verified'])
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            rows += len(batch)
+            last_id = batch[-1]['transaction_id']
+    cursor.close()
+    os.replace(path + '.tmp', path)
+    return path, rows
+
+
+def count_rows(conn, name):
+    cursor = _cursor(conn)
+    cursor.execute(COUNT_QUERY.format(partition=_checked(name)))
+    count = cursor.fetchone()['n']
+    cursor.close()
+    return count
+
+
+def run(conn, today=None, dry_run=False, archive=None):
+    """Create partitions ahead and archive/drop expired ones. Returns (created months, dropped partitions)."""
+    archive = PARTITION_ARCHIVE if archive is None else archive
+    names = [row['name'] for row in list_partitions(conn)]
+    if FUTURE not in names:
+        raise RuntimeError("transactions is not partitioned; run migrations/005_partition_transactions.sql")
+    create, expired = plan(names, today or date.today())
+    cursor = conn.cursor()
+    if create:
+        statement = create_statement(create)
+        logging.info(f"Creating partitions {', '.join(map(partition_name, create))}")
+        if not dry_run:
+            cursor.execute(statement)
+    dropped = []
+    for name in expired:
+        if dry_run:
+            logging.info(f"Would {'archive and ' if archive else ''}drop {name}")
+            continue
+        if archive:
+            path, rows = archive_partition(conn, name)
+            expected = count_rows(conn, name)
+            if rows != expected:
+                logging.error(f"{name}: archived {rows} of {expected} rows to {path}; not dropping it")
+                continue
+            logging.info(f"Archived {rows} rows of {name} to {path}")
+        cursor.execute(drop_statement(name))
+        dropped.append(name)
+        logging.info(f"Dropped partition {name}")
+    cursor.close()
+    return create, dropped
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Monthly partitions of the transactions table")
+    sub = ap.add_subparsers(dest='command', required=True)
+    run_parser = sub.add_parser('run', help="create partitions ahead, archive and drop expired ones")
+    run_parser.add_argument('--dry-run', action='store_true', help="log the plan without changing anything")
+    run_parser.add_argument('--no-archive', action='store_true', help="drop expired partitions without a Parquet copy")
+    sub.add_parser('status', help="list partitions")
+    args = ap.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    from db_pool import connect
+    try:
+        conn = connect()
+    except Exception as e:
+        print(f"Database connection failed: {e}", file=sys.stderr)
+        return 1
+    try:
+        if args.command == 'status':
+            for row in list_partitions(conn):
+                print(f"{row['name']:<12} {str(row['bound']):>14} {row['row_estimate'] or 0:>12}")
+        else:
+            run(conn, dry_run=args.dry_run, archive=False if args.no_archive else None)
+    except (RuntimeError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,418 @@
+"""
+Data access for the payment path (app.py and asgi_app.py).
+
+The user row and its behavior profile come back from one JOINed query. With
+DB_MULTI_STATEMENTS=1 the transaction INSERT and its follow-up statements
+(conditional card-limit debit, behavior update, OTP row) are sent together
+with the COMMIT as one multi-statement round trip, so an approved payment
+costs two round trips: the profile fetch (none when the profile is cached)
+and the write. The sync app takes these writes to their own pool
+(db_pool.get_write_pool), the only connections opened with the
+multi-statement capability; aiomysql always negotiates it.
+
+Otherwise the statements run one at a time. Connections that fell back to
+mysql.connector (only when PyMySQL cannot connect) use server-side prepared
+statements, prepared once per pooled connection.
+
+Given a write-behind log (txlog.py), transaction ids come from blocks
+reserved in the transaction_ids table, and a payment without an OTP row
+commits only its card-limit debit and behavior update here: its
+transactions row goes to the log and reaches MySQL in a later batch.
+"""
+import asyncio
+
+from db_pool import DB_MULTI_STATEMENTS, get_write_pool
+
+_CLIENT_MULTI_STATEMENTS = 1 << 16  # MySQL capability flag, as in pymysql.constants.CLIENT
+
+USER_COLUMNS = ('user_id', 'encrypted_card_no', 'encrypted_cvv', 'card_fingerprint', 'cvv_verifier',
+                'expiry_date', 'email', 'city', 'mobile_number', 'registered_ip', 'current_card_limit')
+BEHAVIOR_COLUMNS = ('usual_city', 'usual_state', 'avg_spend', 'total_transactions',
+                    'last_transaction_timestamp', 'last_transaction_location', 'last_transaction_ip')
+TRANSACTION_COLUMNS = ('user_id', 'card_no_last4', 'amount', 'transaction_location', 'transaction_ip',
+                       'device_id', 'status', 'fraud_score', 'ml_score', 'bla_score', 'prediction_method',
+                       'model_version', 'otp_code', 'timestamp')
+OTP_COLUMNS = ('user_id', 'otp_code', 'email', 'mobile_number', 'expires_at')
+LOGGED_TRANSACTION_COLUMNS = ('transaction_id',) + TRANSACTION_COLUMNS
+# Widths of the VARCHAR columns of transactions (database_schema_complete.sql):
+# longer client input is cut to fit rather than rejected by MySQL
+TRANSACTION_COLUMN_LENGTHS = {'user_id': 50, 'card_no_last4': 4, 'transaction_location': 100,
+                              'transaction_ip': 45, 'device_id': 255, 'model_version': 64, 'otp_code': 6}
+
+PROFILE_QUERY = """
+    SELECT u.user_id, u.encrypted_card_no, u.encrypted_cvv, u.card_fingerprint, u.cvv_verifier,
+           u.expiry_date, u.email, u.city, u.mobile_number, u.registered_ip, u.current_card_limit,
+           b.user_id AS behavior_user_id, b.usual_city, b.usual_state, b.avg_spend, b.total_transactions,
+           b.last_transaction_timestamp, b.last_transaction_location, b.last_transaction_ip
+    FROM users u
+    LEFT JOIN user_behavior b ON b.user_id = u.user_id
+    WHERE u.user_id = %s
+"""
+
+CARD_LIMIT_QUERY = "SELECT current_card_limit FROM users WHERE user_id = %s"
+
+# Take the amount off the limit only if it is still there
+DEBIT_CARD_LIMIT = """
+    UPDATE users SET current_card_limit = current_card_limit - %s
+    WHERE user_id = %s AND current_card_limit >= %s
+"""
+
+INSERT_TRANSACTION = f"""
+    INSERT INTO transactions ({', '.join(TRANSACTION_COLUMNS)})
+    VALUES ({', '.join(['%s'] * len(TRANSACTION_COLUMNS))})
+"""
+
+INSERT_TRANSACTION_WITH_ID = f"""
+    INSERT INTO transactions ({', '.join(LOGGED_TRANSACTION_COLUMNS)})
+    VALUES ({', '.join(['%s'] * len(LOGGED_TRANSACTION_COLUMNS))})
+"""
+
+# Rows flushed from the write-behind log; a replayed row that already made it is skipped
+INSERT_LOGGED_TRANSACTION = INSERT_TRANSACTION_WITH_ID.rstrip() + """
+    ON DUPLICATE KEY UPDATE transaction_id = transaction_id
+"""
+
+# Reserve the next %s ids, past earlier reservations and any AUTO_INCREMENT rows
+RESERVE_TRANSACTION_IDS = """
+    UPDATE transaction_ids
+    SET next_id = LAST_INSERT_ID(GREATEST(next_id, (SELECT COALESCE(MAX(transaction_id), 0) + 1
+                                                     FROM transactions)) + %s)
+    WHERE name = 'transactions'
+"""
+RESERVED_END_QUERY = "SELECT LAST_INSERT_ID() AS end_id"
+
+# Running mean folded from the row's own values (avg_spend is assigned before the count)
+UPDATE_BEHAVIOR = """
+    UPDATE user_behavior
+    SET avg_spend = ROUND((COALESCE(avg_spend, 0) * COALESCE(total_transactions, 0) + %s)
+                          / (COALESCE(total_transactions, 0) + 1), 2),
+        total_transactions = COALESCE(total_transactions, 0) + 1,
+        last_transaction_timestamp = NOW(), last_transaction_location = %s,
+        last_transaction_ip = %s
+    WHERE user_id = %s
+"""
+
+INSERT_OTP = f"""
+    INSERT INTO otp_verification (transaction_id, {', '.join(OTP_COLUMNS)})
+    VALUES (%s, {', '.join(['%s'] * len(OTP_COLUMNS))})
+"""
+
+# Batched forms: the writes after the debit only happen if it went through
+SET_DEBITED = "SET @payment_debited = ROW_COUNT()"
+INSERT_TRANSACTION_IF_DEBITED = f"""
+    INSERT INTO transactions ({', '.join(TRANSACTION_COLUMNS)})
+    SELECT {', '.join(['%s'] * len(TRANSACTION_COLUMNS))} FROM DUAL WHERE @payment_debited = 1
+"""
+UPDATE_BEHAVIOR_IF_DEBITED = UPDATE_BEHAVIOR.rstrip() + " AND @payment_debited = 1\n"
+INSERT_OTP_FOR_LAST_ID = f"""
+    INSERT INTO otp_verification (transaction_id, {', '.join(OTP_COLUMNS)})
+    VALUES (LAST_INSERT_ID(), {', '.join(['%s'] * len(OTP_COLUMNS))})
+"""
+
+
+def split_profile(row):
+    """(user, behavior) from a PROFILE_QUERY row; behavior is None without a behavior row, None if no user."""
+    if not row:
+        return None
+    user = {column: row[column] for column in USER_COLUMNS}
+    if row['behavior_user_id'] is None:
+        return user, None
+    return user, {column: row[column] for column in BEHAVIOR_COLUMNS}
+
+
+def _raw(conn):
+    return getattr(conn, '_raw', conn)
+
+
+def batched(conn):
+    """Whether the connection accepts several statements in one round trip."""
+    return DB_MULTI_STATEMENTS and bool(getattr(_raw(conn), 'client_flag', 0) & _CLIENT_MULTI_STATEMENTS)
+
+
+def _prepares(conn):
+    return type(_raw(conn)).__module__.startswith('mysql.connector')
+
+
+def _statement(conn, sql):
+    """Cursor for `sql`, kept on the (pooled) connection: prepared once where the driver supports it."""
+    statements = conn.__dict__.setdefault('_statements', {})
+    prepared = _prepares(conn)
+    key = sql if prepared else None
+    cursor = statements.get(key)
+    if cursor is None:
+        if prepared:
+            cursor = conn.cursor(prepared=True, dictionary=True)
+        else:
+            try:
+                cursor = conn.cursor(dictionary=True)
+            except TypeError:
+                cursor = conn.cursor()  # PyMySQL: DictCursor set at connect
+        statements[key] = cursor
+    return cursor
+
+
+def _execute(conn, sql, params):
+    cursor = _statement(conn, sql)
+    cursor.execute(sql, params)
+    return cursor
+
+
+def fit_transaction(transaction):
+    """Copy of `transaction` with its strings cut to the column widths."""
+    fitted = dict(transaction)
+    for column, length in TRANSACTION_COLUMN_LENGTHS.items():
+        value = fitted.get(column)
+        if isinstance(value, str) and len(value) > length:
+            fitted[column] = value[:length]
+    return fitted
+
+
+def _transaction_values(transaction):
+    return tuple(transaction.get(column) for column in TRANSACTION_COLUMNS)
+
+
+def _otp_values(otp):
+    return tuple(otp[column] for column in OTP_COLUMNS)
+
+
+def _insert(transaction):
+    """INSERT for the transactions row: with the pre-allocated id if it has one."""
+    if transaction.get('transaction_id') is not None:
+        return INSERT_TRANSACTION_WITH_ID, tuple(transaction.get(column) for column in LOGGED_TRANSACTION_COLUMNS)
+    return INSERT_TRANSACTION, _transaction_values(transaction)
+
+
+def _check(transaction, debit, otp, insert):
+    if debit and otp:
+        raise ValueError("a payment either debits the card or waits for an OTP, not both")
+    if debit and insert and transaction.get('transaction_id') is not None:
+        raise ValueError("a pre-allocated id is only used for rows written without a debit")
+
+
+def _batch(transaction, debit, behavior, otp, insert=True, commit=True):
+    """One multi-statement write, ending in COMMIT if `commit`: (sql, params, index of the INSERT's result)."""
+    _check(transaction, debit, otp, insert)
+    user_id, amount = transaction['user_id'], transaction['amount']
+    statements = []
+    if debit:
+        statements.append((DEBIT_CARD_LIMIT, (amount, user_id, amount)))
+        statements.append((SET_DEBITED, ()))
+        if insert:
+            statements.append((INSERT_TRANSACTION_IF_DEBITED, _transaction_values(transaction)))
+    elif insert:
+        statements.append(_insert(transaction))
+    insert_index = len(statements) - 1
+    if behavior:
+        location, ip_address = behavior
+        statements.append((UPDATE_BEHAVIOR_IF_DEBITED if debit else UPDATE_BEHAVIOR,
+                           (amount, location, ip_address, user_id)))
+    if otp:
+        if transaction.get('transaction_id') is not None:
+            statements.append((INSERT_OTP, (transaction['transaction_id'],) + _otp_values(otp)))
+        else:
+            statements.append((INSERT_OTP_FOR_LAST_ID, _otp_values(otp)))
+    if commit:
+        statements.append(("COMMIT", ()))
+    sql = ';\n'.join(statement.strip() for statement, _ in statements)
+    params = tuple(value for _, values in statements for value in values)
+    return sql, params, insert_index
+
+
+def fetch_profile(conn, user_id):
+    """(user, behavior) in one round trip, or None if the user does not exist."""
+    cursor = _execute(conn, PROFILE_QUERY, (user_id,))
+    return split_profile(cursor.fetchone())
+
+
+def fetch_card_limit(conn, user_id):
+    row = _execute(conn, CARD_LIMIT_QUERY, (user_id,)).fetchone()
+    return row['current_card_limit'] if row else None
+
+
+def reserve_transaction_ids(conn, count):
+    """Reserve `count` transaction ids and commit: (first, end) with `end` exclusive."""
+    _execute(conn, RESERVE_TRANSACTION_IDS, (count,))
+    end = _execute(conn, RESERVED_END_QUERY, ()).fetchone()['end_id']
+    conn.commit()
+    return end - count, end
+
+
+def insert_logged_transactions(conn, rows):
+    """Write rows of LOGGED_TRANSACTION_COLUMNS values in one multi-row INSERT and commit."""
+    cursor = conn.cursor()
+    cursor.executemany(INSERT_LOGGED_TRANSACTION, rows)
+    conn.commit()
+    cursor.close()
+
+
+def _next_id(conn, log):
+    transaction_id = log.take_id()
+    while transaction_id is None:
+        log.add_ids(*reserve_transaction_ids(conn, log.id_block))
+        transaction_id = log.take_id()
+    return transaction_id
+
+
+def record_payment(conn, transaction, debit=False, behavior=None, otp=None, log=None):
+    """
+    Write a payment and commit. `transaction` maps TRANSACTION_COLUMNS to
+    values; `debit` takes the amount off the card limit; `behavior` is the
+    (location, ip) to fold into the user's profile; `otp` maps OTP_COLUMNS
+    for the verification row. Returns the transaction_id, or None when the
+    limit no longer covers the amount (nothing is written).
+
+    With `log` (a txlog.TxLog) the id is pre-allocated and, unless the
+    payment waits for an OTP (its row is updated on verification), the
+    transactions row is appended to the log instead of being inserted here:
+    after the debit succeeded and before the COMMIT, so a committed debit
+    always has its row on disk.
+    """
+    transaction = fit_transaction(transaction)
+    deferred = log is not None and not otp and transaction.get('otp_code') is None
+    if log is not None:
+        transaction = dict(transaction, transaction_id=_next_id(conn, log))
+    return _write(conn, transaction, debit, behavior, otp, insert=not deferred, log=log if deferred else None)
+
+
+def _write(conn, transaction, debit, behavior, otp, insert, log=None):
+    _check(transaction, debit, otp, insert)
+    if not (insert or debit or behavior):
+        if log is not None:
+            log.append(transaction)  # nothing to commit
+        return transaction.get('transaction_id')
+    write_pool = get_write_pool()
+    if write_pool is None:
+        return _write_on(conn, transaction, debit, behavior, otp, insert, log)
+    with write_pool.connection() as write_conn:
+        transaction_id = _write_on(write_conn, transaction, debit, behavior, otp, insert, log)
+    if transaction_id is None:
+        conn.rollback()  # end the read snapshot, so the caller sees the current card limit
+    return transaction_id
+
+
+def _write_on(conn, transaction, debit, behavior, otp, insert, log=None):
+    known_id = transaction.get('transaction_id')
+    if batched(conn):
+        # With a log the COMMIT follows the append, in a second round trip
+        sql, params, insert_index = _batch(transaction, debit, behavior, otp, insert, commit=log is None)
+        cursor = _statement(conn, None)
+        cursor.execute(sql, params)
+        debited = cursor.rowcount if debit else 1
+        for _ in range(insert_index):
+            cursor.nextset()
+        transaction_id = cursor.lastrowid if insert else None
+        while cursor.nextset():
+            pass
+        if log is not None:
+            if debited != 1:
+                conn.rollback()
+                return None
+            log.append(transaction)
+            conn.commit()
+        return (known_id or transaction_id) if debited == 1 else None
+
+    if debit:
+        amount, user_id = transaction['amount'], transaction['user_id']
+        if _execute(conn, DEBIT_CARD_LIMIT, (amount, user_id, amount)).rowcount != 1:
+            conn.rollback()
+            return None
+    transaction_id = known_id
+    if insert:
+        cursor = _execute(conn, *_insert(transaction))
+        transaction_id = known_id or cursor.lastrowid
+    if behavior:
+        location, ip_address = behavior
+        _execute(conn, UPDATE_BEHAVIOR, (transaction['amount'], location, ip_address, transaction['user_id']))
+    if otp:
+        _execute(conn, INSERT_OTP, (transaction_id,) + _otp_values(otp))
+    if log is not None:
+        log.append(transaction)
+    conn.commit()
+    return transaction_id
+
+
+# ---------------------------------------------------------------------------
+# asyncio (aiomysql) counterparts
+# ---------------------------------------------------------------------------
+
+async def fetch_profile_async(cursor, user_id):
+    await cursor.execute(PROFILE_QUERY, (user_id,))
+    return split_profile(await cursor.fetchone())
+
+
+async def fetch_card_limit_async(cursor, user_id):
+    await cursor.execute(CARD_LIMIT_QUERY, (user_id,))
+    row = await cursor.fetchone()
+    return row['current_card_limit'] if row else None
+
+
+async def reserve_transaction_ids_async(conn, cursor, count):
+    await cursor.execute(RESERVE_TRANSACTION_IDS, (count,))
+    await cursor.execute(RESERVED_END_QUERY)
+    end = (await cursor.fetchone())['end_id']
+    await conn.commit()
+    return end - count, end
+
+
+async def record_payment_async(conn, cursor, transaction, debit=False, behavior=None, otp=None, log=None):
+    """record_payment on an aiomysql connection and cursor."""
+    transaction = fit_transaction(transaction)
+    deferred = log is not None and not otp and transaction.get('otp_code') is None
+    if log is not None:
+        transaction_id = log.take_id()
+        while transaction_id is None:
+            log.add_ids(*await reserve_transaction_ids_async(conn, cursor, log.id_block))
+            transaction_id = log.take_id()
+        transaction = dict(transaction, transaction_id=transaction_id)
+    return await _write_async(conn, cursor, transaction, debit, behavior, otp, insert=not deferred,
+                              log=log if deferred else None)
+
+
+async def _append(log, transaction):
+    # The append waits for fsync, so keep it off the event loop
+    await asyncio.get_running_loop().run_in_executor(None, log.append, transaction)
+
+
+async def _write_async(conn, cursor, transaction, debit, behavior, otp, insert, log=None):
+    _check(transaction, debit, otp, insert)
+    known_id = transaction.get('transaction_id')
+    if not (insert or debit or behavior):
+        if log is not None:
+            await _append(log, transaction)
+        return known_id
+    if batched(conn):
+        sql, params, insert_index = _batch(transaction, debit, behavior, otp, insert, commit=log is None)
+        await cursor.execute(sql, params)
+        debited = cursor.rowcount if debit else 1
+        for _ in range(insert_index):
+            await cursor.nextset()
+        transaction_id = cursor.lastrowid if insert else None
+        while await cursor.nextset():
+            pass
+        if log is not None:
+            if debited != 1:
+                await conn.rollback()
+                return None
+            await _append(log, transaction)
+            await conn.commit()
+        return (known_id or transaction_id) if debited == 1 else None
+
+    if debit:
+        amount, user_id = transaction['amount'], transaction['user_id']
+        await cursor.execute(DEBIT_CARD_LIMIT, (amount, user_id, amount))
+        if cursor.rowcount != 1:
+            await conn.rollback()
+            return None
+    transaction_id = known_id
+    if insert:
+        await cursor.execute(*_insert(transaction))
+        transaction_id = known_id or cursor.lastrowid
+    if behavior:
+        location, ip_address = behavior
+        await cursor.execute(UPDATE_BEHAVIOR, (transaction['amount'], location, ip_address, transaction['user_id']))
+    if otp:
+        await cursor.execute(INSERT_OTP, (transaction_id,) + _otp_values(otp))
+    if log is not None:
+        await _append(log, transaction)
+    await conn.commit()
+    return transaction_id
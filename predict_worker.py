@@ -1,13 +1,17 @@
 import sys
-import json
-import sys
 import os
 import json
+import struct
 import joblib
 import numpy as np
 import math
 
 
+# Frames exchanged with model_server.py in --serve mode: a 4-byte big-endian
+# length followed by that many bytes of UTF-8 JSON.
+FRAME_HEADER = struct.Struct('>I')
+
+
 def _sigmoid(x):
     try:
         return 1 / (1 + math.exp(-x))
@@ -15,6 +19,166 @@ def _sigmoid(x):
         return 1.0 if x > 0 else 0.0
 
 
+def load_model(model_path=None):
+    model_path = model_path or os.environ.get('MODEL_PATH', 'model.pkl')
+    try:
+        return joblib.load(model_path)
+    except Exception as e:
+        raise RuntimeError(f"Failed to load model from {model_path}: {e}")
+
+
+def load_scoring_model(model_path=None):
+    """load_model for long-lived scorers: with TREE_INFERENCE=1, the compiled tree engine if it matches."""
+    model = load_model(model_path)
+    if os.environ.get('TREE_INFERENCE', '0') == '1':
+        from tree_inference import compile_model
+        model = compile_model(model) or model
+    return model
+
+
+def to_feature_array(features, model=None):
+    """Convert features to a 2-D float array sized for the model's input."""
+    # Convert features to numpy array with correct shape and dtype
+    if isinstance(features, list):
+        features_array = np.array(features, dtype=float)
+        if features_array.ndim == 1:
+            features_array = features_array.reshape(1, -1)
+    else:
+        features_array = np.array(features, dtype=float)
+
+    # Check model expected input dimensionality if available
+    try:
+        n_in = getattr(model, 'n_features_in_', None)
+        if n_in is not None and features_array.shape[1] != n_in:
+            sys.stderr.write(f"WARNING: model.n_features_in_={n_in} but got {features_array.shape[1]} features - padding/truncating to match\n")
+            sys.stderr.flush()
+            # Pad with zeros or truncate to match expected input size
+            if features_array.shape[1] < n_in:
+                pad_width = n_in - features_array.shape[1]
+                pad = np.zeros((features_array.shape[0], pad_width), dtype=float)
+                features_array = np.hstack([features_array, pad])
+            else:
+                features_array = features_array[:, :n_in]
+            sys.stderr.write(f"predict_worker adjusted features shape={features_array.shape}\n")
+            sys.stderr.flush()
+    except Exception:
+        pass
+
+    return features_array
+
+
+def run_action(model, features, action):
+    """Score `features` with an already loaded model and return the JSON-able result."""
+    features_array = to_feature_array(features, model)
+
+    out = {}
+    if action == 'predict':
+        pred = model.predict(features_array)
+        # Convert numpy arrays to lists
+        out['predict'] = pred.tolist() if hasattr(pred, 'tolist') else list(pred)
+
+    elif action == 'predict_proba':
+        # Prefer predict_proba; fall back to decision_function or predict
+        if hasattr(model, 'predict_proba'):
+            prob = model.predict_proba(features_array)
+            out['predict_proba'] = prob.tolist()
+        elif hasattr(model, 'decision_function'):
+            df = model.decision_function(features_array)
+            # decision_function might return (n_samples,) or (n_samples, n_classes)
+            df = np.array(df)
+            if df.ndim == 1:
+                probs = [_sigmoid(float(v)) for v in df]
+                out['predict_proba'] = [[1 - p, p] for p in probs]
+            else:
+                # For multi-output, apply sigmoid per element and normalize
+                probs = np.apply_along_axis(lambda row: 1 / (1 + np.exp(-row)), 1, df)
+                # Normalize rows to sum to 1
+                probs = probs / probs.sum(axis=1, keepdims=True)
+                out['predict_proba'] = probs.tolist()
+        elif hasattr(model, 'predict'):
+            # Last resort: use labels and map to probabilities
+            pred = model.predict(features_array)
+            # If predictions are probabilities already, handle gracefully
+            try:
+                pred_arr = np.array(pred)
+                # If binary labels (0/1), map to [1-p, p]
+                if pred_arr.ndim == 1 and set(np.unique(pred_arr)).issubset({0, 1}):
+                    out['predict_proba'] = [[1 - float(p), float(p)] for p in pred_arr]
+                else:
+                    # Can't construct probabilities reliably; return label predictions
+                    out['predict'] = pred_arr.tolist()
+            except Exception:
+                out['predict'] = list(pred)
+        else:
+            raise AttributeError('Model has no predict_proba/decision_function/predict')
+    else:
+        raise ValueError(f"Unknown action: {action}")
+
+    return out
+
+
+def read_frame(stream):
+    """Read one length-prefixed JSON frame; returns None on EOF."""
+    header = stream.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    (length,) = FRAME_HEADER.unpack(header)
+    body = stream.read(length)
+    if len(body) < length:
+        return None
+    return json.loads(body.decode('utf-8'))
+
+
+def write_frame(stream, obj):
+    body = json.dumps(obj).encode('utf-8')
+    stream.write(FRAME_HEADER.pack(len(body)) + body)
+    stream.flush()
+
+
+def serve():
+    """Long-lived mode: load the model once, then answer framed requests on stdin/stdout."""
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    # Anything printed by the model libraries must not corrupt the frame stream
+    sys.stdout = sys.stderr
+
+    model_path = os.environ.get('MODEL_PATH', 'model.pkl')
+    try:
+        model = load_scoring_model(model_path)
+        load_error = None
+    except Exception as e:
+        # Stay up and report the failure per request, like the one-shot mode does
+        model = None
+        load_error = str(e)
+        sys.stderr.write(f"predict_worker: {load_error}\n")
+        sys.stderr.flush()
+
+    write_frame(stdout, {
+        'ready': True,
+        'pid': os.getpid(),
+        'model_path': model_path,
+        'n_features_in': getattr(model, 'n_features_in_', None),
+        'error': load_error,
+    })
+
+    while True:
+        request = read_frame(stdin)
+        if request is None:
+            break
+        features = request.get('features')
+        try:
+            if model is None:
+                raise RuntimeError(load_error)
+            out = run_action(model, features, request.get('action'))
+        except Exception as e:
+            try:
+                fea_repr = repr(features)
+            except Exception:
+                fea_repr = '<<unrepresentable>>'
+            out = {'error': str(e), 'features': fea_repr}
+        write_frame(stdout, out)
+
+
 def main():
     features = None
     try:
@@ -22,87 +186,13 @@ def main():
         features = data.get('features')
         action = data.get('action')
 
-        model_path = os.environ.get('MODEL_PATH', 'model.pkl')
-        try:
-            model = joblib.load(model_path)
-        except Exception as e:
-            raise RuntimeError(f"Failed to load model from {model_path}: {e}")
+        model = load_model()
 
         # Debug: include received feature info
         sys.stderr.write(f"predict_worker received features={features}\n")
         sys.stderr.flush()
 
-        # Convert features to numpy array with correct shape and dtype
-        if isinstance(features, list):
-            features_array = np.array(features, dtype=float)
-            if features_array.ndim == 1:
-                features_array = features_array.reshape(1, -1)
-        else:
-            features_array = np.array(features, dtype=float)
-
-        sys.stderr.write(f"predict_worker converted features shape={features_array.shape}\n")
-        sys.stderr.flush()
-
-        # Check model expected input dimensionality if available
-        try:
-            n_in = getattr(model, 'n_features_in_', None)
-            if n_in is not None and features_array.shape[1] != n_in:
-                sys.stderr.write(f"WARNING: model.n_features_in_={n_in} but got {features_array.shape[1]} features - padding/truncating to match\n")
-                sys.stderr.flush()
-                # Pad with zeros or truncate to match expected input size
-                if features_array.shape[1] < n_in:
-                    pad_width = n_in - features_array.shape[1]
-                    pad = np.zeros((features_array.shape[0], pad_width), dtype=float)
-                    features_array = np.hstack([features_array, pad])
-                else:
-                    features_array = features_array[:, :n_in]
-                sys.stderr.write(f"predict_worker adjusted features shape={features_array.shape}\n")
-                sys.stderr.flush()
-        except Exception:
-            pass
-
-        out = {}
-        if action == 'predict':
-            pred = model.predict(features_array)
-            # Convert numpy arrays to lists
-            out['predict'] = pred.tolist() if hasattr(pred, 'tolist') else list(pred)
-
-        elif action == 'predict_proba':
-            # Prefer predict_proba; fall back to decision_function or predict
-            if hasattr(model, 'predict_proba'):
-                prob = model.predict_proba(features_array)
-                out['predict_proba'] = prob.tolist()
-            elif hasattr(model, 'decision_function'):
-                df = model.decision_function(features_array)
-                # decision_function might return (n_samples,) or (n_samples, n_classes)
-                df = np.array(df)
-                if df.ndim == 1:
-                    probs = [_sigmoid(float(v)) for v in df]
-                    out['predict_proba'] = [[1 - p, p] for p in probs]
-                else:
-                    # For multi-output, apply sigmoid per element and normalize
-                    probs = np.apply_along_axis(lambda row: 1 / (1 + np.exp(-row)), 1, df)
-                    # Normalize rows to sum to 1
-                    probs = probs / probs.sum(axis=1, keepdims=True)
-                    out['predict_proba'] = probs.tolist()
-            elif hasattr(model, 'predict'):
-                # Last resort: use labels and map to probabilities
-                pred = model.predict(features_array)
-                # If predictions are probabilities already, handle gracefully
-                try:
-                    pred_arr = np.array(pred)
-                    # If binary labels (0/1), map to [1-p, p]
-                    if pred_arr.ndim == 1 and set(np.unique(pred_arr)).issubset({0, 1}):
-                        out['predict_proba'] = [[1 - float(p), float(p)] for p in pred_arr]
-                    else:
-                        # Can't construct probabilities reliably; return label predictions
-                        out['predict'] = pred_arr.tolist()
-                except Exception:
-                    out['predict'] = list(pred)
-            else:
-                raise AttributeError('Model has no predict_proba/decision_function/predict')
-        else:
-            raise ValueError(f"Unknown action: {action}")
+        out = run_action(model, features, action)
 
         print(json.dumps(out))
 
@@ -116,4 +206,7 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    if '--serve' in sys.argv[1:]:
+        serve()
+    else:
+        main()
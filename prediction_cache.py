@@ -0,0 +1,180 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 20000))
+PREDICTION_CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', 60))  # seconds; 0 disables
+
+
+def feature_key(row):
+    """Canonical digest of a feature row: equal values hash equally (int, float, Decimal, -0.0)."""
+    values = np.array([float(v) for v in row], dtype=float) + 0.0
+    return hashlib.blake2b(values.tobytes(), digest_size=16).digest()
+
+
+class _Pending:
+    """A scoring call in flight that identical rows wait for instead of running the model again."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+
+class PredictionCache:
+    """
+    LRU/TTL cache of model results per feature row, for the model identified by `model`.
+
+    Retries, double submits and repeated OTP flows score identical rows within
+    seconds; those are answered from here, and an identical row arriving while
+    the first is still being scored waits for that result. `model` is any
+    hashable identity of the serving model (path, version, reload count): when
+    it changes the cache is emptied, and results computed by the old model are
+    never stored.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or PREDICTION_CACHE_SIZE
+        self.ttl = PREDICTION_CACHE_TTL if ttl is None else ttl
+        self._entries = OrderedDict()  # feature digest -> (expires_at, value)
+        self._pending = {}  # feature digest -> _Pending (threads)
+        self._async_pending = {}  # feature digest -> asyncio.Future (event loop)
+        self._model = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _use_model(self, model):
+        # Caller holds the lock
+        if model != self._model:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._model = model
+
+    def _lookup(self, key):
+        # Caller holds the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def _store(self, model, key, value):
+        # Caller holds the lock
+        if value is None or model != self._model:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, model, row):
+        if self.ttl <= 0:
+            return None
+        key = feature_key(row)
+        with self._lock:
+            self._use_model(model)
+            return self._lookup(key)
+
+    def put(self, model, row, value):
+        if self.ttl <= 0:
+            return
+        key = feature_key(row)
+        with self._lock:
+            self._use_model(model)
+            self._store(model, key, value)
+
+    def invalidate(self):
+        with self._lock:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+
+    def get_or_compute(self, model, row, compute):
+        """Cached value for `row`, else compute() once however many threads ask; None is not cached."""
+        if self.ttl <= 0:
+            return compute()
+        key = feature_key(row)
+        with self._lock:
+            self._use_model(model)
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = _Pending()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            pending.event.wait()
+            return pending.value if pending.value is not None else compute()
+        value = None
+        try:
+            value = compute()
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+                self._store(model, key, value)
+            pending.value = value
+            pending.event.set()
+        return value
+
+    async def get_or_compute_async(self, model, row, compute):
+        """get_or_compute for the event loop: `compute` is a coroutine function."""
+        if self.ttl <= 0:
+            return await compute()
+        key = feature_key(row)
+        with self._lock:
+            self._use_model(model)
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            future = self._async_pending.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+        if future is not None:
+            value = await asyncio.shield(future)
+            return value if value is not None else await compute()
+        future = self._async_pending[key] = asyncio.get_running_loop().create_future()
+        value = None
+        try:
+            value = await compute()
+        finally:
+            self._async_pending.pop(key, None)
+            with self._lock:
+                self._store(model, key, value)
+            future.set_result(value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': ((self.hits + self.coalesced) / lookups) if lookups else 0.0,
+            }
+
+
+prediction_cache = PredictionCache()
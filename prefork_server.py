@@ -0,0 +1,316 @@
+"""
+Pre-fork serving entry point for app.py.
+
+The master imports the Flask app with MODEL_SERVER=inprocess, so the model,
+MASTER_KEY, gazetteer, BLA rules and the warmed feature store are loaded
+exactly once, freezes the heap (gc.freeze) and forks PREFORK_WORKERS
+processes that accept from one shared non-blocking listening socket. Workers
+score in their own threads against the inherited model pages, which stay
+shared copy-on-write instead of N copies of the model in RAM. When BLA rules
+use velocity features, workers send each other the transactions they record
+(feature_store.py), so every worker sees a card's full velocity.
+
+The master runs no background threads (APP_BACKGROUND_THREADS=0), so no
+lock can be held at fork() time. OTP delivery, the OTP sweeper, the
+transaction log writer and the feature store peers start in each worker.
+
+    python prefork_server.py          # PREFORK_HOST / PREFORK_PORT (default 127.0.0.1:5000)
+
+Signals (to the master):
+    HUP         reload the model (the registry's current version, see
+                model_registry.py) and master.key, start a new generation of
+                workers, then retire the old ones once their requests finish
+    TERM / INT  graceful shutdown
+
+The master also polls the model registry and rolls the workers the same way
+when a new version is activated.
+
+A worker exits after PREFORK_MAX_REQUESTS requests (plus up to
+PREFORK_MAX_REQUESTS_JITTER, so they do not all recycle at once) and the
+master replaces it. Retiring workers stop accepting, finish in-flight
+requests and are killed after PREFORK_GRACEFUL_TIMEOUT seconds.
+Code changes still need a full restart.
+"""
+import os
+import gc
+import time
+import shutil
+import signal
+import random
+import socket
+import logging
+import tempfile
+import threading
+
+# Score in-process: the model is loaded once here and inherited by every worker.
+# Registry changes are applied by the master, never by each worker on its own.
+os.environ['MODEL_SERVER'] = 'inprocess'
+os.environ['MODEL_REGISTRY_WATCH'] = '0'
+# No background threads in the master: each worker starts its own after fork()
+os.environ['APP_BACKGROUND_THREADS'] = '0'
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+from model_registry import MODEL_REGISTRY_POLL
+
+PREFORK_HOST = os.environ.get('PREFORK_HOST', '127.0.0.1')
+PREFORK_PORT = int(os.environ.get('PREFORK_PORT', 5000))
+PREFORK_WORKERS = int(os.environ.get('PREFORK_WORKERS', os.cpu_count() or 1))
+PREFORK_BACKLOG = int(os.environ.get('PREFORK_BACKLOG', 2048))
+PREFORK_MAX_REQUESTS = int(os.environ.get('PREFORK_MAX_REQUESTS', 10000))  # 0 = never recycle
+PREFORK_MAX_REQUESTS_JITTER = int(os.environ.get('PREFORK_MAX_REQUESTS_JITTER', 1000))
+PREFORK_GRACEFUL_TIMEOUT = int(os.environ.get('PREFORK_GRACEFUL_TIMEOUT', 30))
+PREFORK_ACCESS_LOG = os.environ.get('PREFORK_ACCESS_LOG', '0') == '1'
+
+
+class _RequestHandler(WSGIRequestHandler):
+    def log_request(self, code='-', size='-'):
+        if PREFORK_ACCESS_LOG:
+            super().log_request(code, size)
+
+
+class _CountingApp:
+    """WSGI wrapper that asks the worker to recycle after `max_requests`."""
+
+    def __init__(self, app, max_requests, on_limit):
+        self.app = app
+        self.max_requests = max_requests
+        self.on_limit = on_limit
+        self.handled = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.handled += 1
+            reached = self.handled == self.max_requests
+        if reached:
+            self.on_limit()
+        return self.app(environ, start_response)
+
+
+def _after_fork():
+    """Drop state that must not be shared with the master or other workers, then start the threads."""
+    import app
+    import db_pool
+    import fraud_detection_engine
+    from otp_dispatch import otp_dispatcher
+    from otp_store import otp_store
+    from shadow_scoring import shadow_scorer
+    from txlog import txlog
+    from feature_store import feature_store
+    db_pool._pool = db_pool._write_pool = None  # the master's connections were closed before forking
+    fraud_detection_engine._batcher = None
+    otp_dispatcher.after_fork()
+    otp_store.after_fork()
+    shadow_scorer.after_fork()
+    txlog.after_fork()
+    feature_store.after_fork()
+    app.start_background_threads()
+    gc.enable()
+
+
+def run_worker(sock, wsgi_app, generation):
+    """Serve on the inherited socket until told to stop; never returns."""
+    status = 0
+    # Until the server is up a TERM simply ends the worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        _after_fork()
+        server = make_server(PREFORK_HOST, PREFORK_PORT, wsgi_app, threaded=True,
+                             request_handler=_RequestHandler, fd=sock.fileno())
+        # Let server_close() join in-flight request threads (graceful drain)
+        server.daemon_threads = False
+        server.block_on_close = True
+        stopping = threading.Event()
+
+        def stop(reason):
+            if not stopping.is_set():
+                stopping.set()
+                logging.info(f"Worker {os.getpid()} stopping ({reason})")
+                threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop('shutdown'))
+        if PREFORK_MAX_REQUESTS > 0:
+            limit = PREFORK_MAX_REQUESTS + random.randint(0, max(PREFORK_MAX_REQUESTS_JITTER, 0))
+            server.app = _CountingApp(wsgi_app, limit, lambda: stop(f'recycled after {limit} requests'))
+        logging.info(f"Worker {os.getpid()} (generation {generation}) serving")
+        server.serve_forever()
+        # Hard stop if in-flight requests outlast the timeout
+        signal.alarm(PREFORK_GRACEFUL_TIMEOUT)
+        server.server_close()
+        from txlog import txlog
+        from feature_store import feature_store
+        txlog.close()  # os._exit below skips interpreter cleanup
+        feature_store.close()
+    except Exception:
+        logging.exception(f"Worker {os.getpid()} failed")
+        status = 1
+    finally:
+        logging.shutdown()
+        os._exit(status)
+
+
+class PreforkServer:
+    def __init__(self, workers=None, host=None, port=None):
+        self.size = workers or PREFORK_WORKERS
+        self.host = host or PREFORK_HOST
+        self.port = port or PREFORK_PORT
+        self.workers = {}  # pid -> generation
+        self.generation = 0
+        self.app_module = None
+        self.sock = None
+        self.peers_dir = None
+        self._reload = False
+        self._stopping = False
+
+    def load(self):
+        """Import the app (model, key, caches) in the master, once."""
+        import app as app_module
+        self.app_module = app_module
+        # The warm-up connections belong to the master; workers open their own
+        import db_pool
+        for pool in (db_pool._pool, db_pool._write_pool):
+            if pool is not None:
+                pool.close_all()
+        # Workers exchange recorded transactions so their velocity features agree
+        from feature_store import feature_store
+        if feature_store.enabled and not feature_store.peers_dir:
+            self.peers_dir = feature_store.peers_dir = tempfile.mkdtemp(prefix='feature-store-')
+
+    def reload(self, force=True):
+        """
+        Reload the model and master.key in the master, then roll the workers.
+        Without `force` only a newly activated registry version triggers it.
+        """
+        from model_server import get_model_server
+        from model_registry import registry, apply_version, probe_rows
+        from security_advanced import load_master_key
+        try:
+            model_version = registry.poll()
+            if model_version is not None:
+                apply_version(model_version)
+            elif not force:
+                return
+            else:
+                server = get_model_server()
+                if not server.reload(os.environ.get('MODEL_PATH'), server.version, probe_rows()):
+                    raise RuntimeError(f"model {os.environ.get('MODEL_PATH')} failed to load")
+        except Exception:
+            logging.exception("Reload aborted: keeping the current model and workers")
+            return
+        key = load_master_key()
+        if key:
+            self.app_module.MASTER_KEY = key
+        else:
+            logging.error("master.key not readable; keeping the current key")
+        old = list(self.workers)
+        self.generation += 1
+        self.spawn_missing()
+        # The new generation is accepting on the same socket: retire the old one
+        for pid in old:
+            self.signal_worker(pid, signal.SIGTERM)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(self.sock, self.app_module.app, self.generation)
+        self.workers[pid] = self.generation
+        return pid
+
+    def spawn_missing(self):
+        current = sum(1 for gen in self.workers.values() if gen == self.generation)
+        if current >= self.size:
+            return
+        # Collect what a reload left behind, then keep the inherited objects out
+        # of the collector (re-enabled in each worker) so their pages stay shared
+        gc.disable()
+        gc.collect()
+        gc.freeze()
+        try:
+            for _ in range(self.size - current):
+                self.spawn()
+        finally:
+            # The master collects as usual between spawns, or the objects of
+            # every replaced model would stay frozen here and in later workers
+            gc.unfreeze()
+            gc.enable()
+
+    def signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            self.workers.pop(pid, None)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            generation = self.workers.pop(pid, None)
+            if self.peers_dir:
+                from feature_store import peer_socket_path
+                try:
+                    os.unlink(peer_socket_path(self.peers_dir, pid))
+                except OSError:
+                    pass
+            code = os.waitstatus_to_exitcode(status)
+            if code != 0 and not self._stopping and generation == self.generation:
+                logging.error(f"Worker {pid} exited with code {code}")
+                time.sleep(1)  # do not spin if workers die at startup
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reload = True
+        else:
+            self._stopping = True
+
+    def run(self):
+        self.load()
+        self.sock = socket.create_server((self.host, self.port), backlog=PREFORK_BACKLOG)
+        self.sock.set_inheritable(True)
+        # Every worker wakes on a new connection; the ones that lose the race must
+        # get EAGAIN (ignored by socketserver) rather than block in accept()
+        self.sock.setblocking(False)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+        logging.info(f"Pre-fork master {os.getpid()} on http://{self.host}:{self.port} "
+                     f"with {self.size} workers")
+        self.spawn_missing()
+        next_poll = time.monotonic() + MODEL_REGISTRY_POLL
+        while not self._stopping:
+            if self._reload:
+                self._reload = False
+                self.reload()
+            elif MODEL_REGISTRY_POLL > 0 and time.monotonic() >= next_poll:
+                next_poll = time.monotonic() + MODEL_REGISTRY_POLL
+                self.reload(force=False)
+            self.reap()
+            self.spawn_missing()
+            time.sleep(0.5)
+        self.shutdown()
+
+    def shutdown(self):
+        logging.info("Stopping workers")
+        for pid in list(self.workers):
+            self.signal_worker(pid, signal.SIGTERM)
+        deadline = time.monotonic() + PREFORK_GRACEFUL_TIMEOUT + 5
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self.signal_worker(pid, signal.SIGKILL)
+        self.sock.close()
+        if self.peers_dir:
+            shutil.rmtree(self.peers_dir, ignore_errors=True)
+
+
+def main():
+    PreforkServer().run()
+
+
+if __name__ == '__main__':
+    main()
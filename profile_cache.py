@@ -0,0 +1,101 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 10000))
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', 60))  # seconds; 0 disables
+
+_CENTS = Decimal('0.01')
+
+
+class ProfileCache:
+    """
+    LRU/TTL cache of (users row, user_behavior row) per user_id.
+
+    Entries are written through after the database commit that changed them,
+    so the common payment path needs no profile SELECTs. The TTL bounds how
+    long another process's writes can go unseen.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or PROFILE_CACHE_SIZE
+        self.ttl = PROFILE_CACHE_TTL if ttl is None else ttl
+        self._entries = OrderedDict()  # user_id -> (expires_at, user, behavior)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        """Return copies of (user, behavior) or None on a miss/expiry."""
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            _, user, behavior = entry
+        return dict(user), (dict(behavior) if behavior else behavior)
+
+    def put(self, user_id, user, behavior):
+        if self.ttl <= 0 or not user:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, dict(user),
+                                      dict(behavior) if behavior else behavior)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def _update(self, user_id, fn):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                fn(entry[1], entry[2])
+
+    def record_approval(self, user_id, amount, location, ip_address):
+        """Mirror the committed card-limit and behavior updates of an approved payment."""
+        def apply(user, behavior):
+            user['current_card_limit'] = user['current_card_limit'] - amount
+            if behavior:
+                total = behavior['total_transactions'] or 0
+                avg = behavior['avg_spend'] or 0
+                behavior['avg_spend'] = (((avg * total) + amount) / (total + 1)).quantize(_CENTS)
+                behavior['total_transactions'] = total + 1
+                behavior['last_transaction_timestamp'] = datetime.now()
+                behavior['last_transaction_location'] = location
+                behavior['last_transaction_ip'] = ip_address
+        self._update(user_id, apply)
+
+    def record_limit_change(self, user_id, delta):
+        """Mirror a committed change of current_card_limit (e.g. OTP approval)."""
+        def apply(user, behavior):
+            user['current_card_limit'] = user['current_card_limit'] + delta
+        self._update(user_id, apply)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+profile_cache = ProfileCache()
@@ -1,9 +1,17 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
 import secrets
 import string
+import hmac
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime, timedelta
 import os
 
+# Ciphertext -> keyed digest of its plaintext, so repeat verifications skip the decrypt
+VERIFY_CACHE_SIZE = int(os.environ.get('CRYPTO_VERIFY_CACHE_SIZE', 10000))
+
 # Generate master key (run once)
 def generate_master_key():
     key = Fernet.generate_key()
@@ -12,6 +20,28 @@ def generate_master_key():
         key_file.write(key)
     print(f"Master Key generated and saved as '{key_path}'")
 
+# HMAC key for card fingerprints and CVV verifiers. It is kept apart from
+# master.key so that adding a Fernet key for rotation leaves every stored
+# fingerprint valid. Without it they are keyed to the master keys (newest first).
+# To change it, put the new key on the first line and keep the old one below
+# it until `python card_index.py --backfill --all` has finished.
+FINGERPRINT_KEY_PATH = os.environ.get(
+    'CARD_FINGERPRINT_KEY_PATH', os.path.join(os.path.dirname(__file__), "fingerprint.key"))
+
+# Generate fingerprint key (run once, then `python card_index.py --backfill --all`)
+def generate_fingerprint_key():
+    with open(FINGERPRINT_KEY_PATH, "w") as key_file:
+        key_file.write(secrets.token_hex(32))
+    print(f"Fingerprint Key generated and saved as '{FINGERPRINT_KEY_PATH}'")
+
+@lru_cache(maxsize=1)
+def load_fingerprint_key():
+    try:
+        with open(FINGERPRINT_KEY_PATH, "rb") as k:
+            return k.read().strip() or None
+    except FileNotFoundError:
+        return None
+
 # Load master key
 def load_master_key():
     try:
@@ -22,12 +52,35 @@ def load_master_key():
         print("ERROR: master.key not found. Run generate_master_key() first.")
         return None
 
+# One cipher per key. `key` is the master.key content: a single Fernet key, or
+# several (one per line, newest first) to decrypt tokens from rotated keys.
+_ciphers = {}
+_ciphers_lock = threading.Lock()
+
+def _key_bytes(key):
+    if isinstance(key, (list, tuple)):
+        key = b"\n".join(k.encode() if isinstance(k, str) else k for k in key)
+    return key.encode() if isinstance(key, str) else key
+
+def _get_cipher(key):
+    key = _key_bytes(key)
+    cipher = _ciphers.get(key)
+    if cipher is None:
+        keys = [k.strip() for k in key.splitlines() if k.strip()]
+        if len(keys) > 1:
+            cipher = MultiFernet([Fernet(k) for k in keys])
+        else:
+            cipher = Fernet(keys[0])
+        with _ciphers_lock:
+            _ciphers[key] = cipher
+    return cipher
+
 # Encrypt sensitive data
 def encrypt_secret(plain_text, key):
     if not key:
         return None
     try:
-        cipher_suite = Fernet(key)
+        cipher_suite = _get_cipher(key)
         encrypted_text = cipher_suite.encrypt(plain_text.encode())
         return encrypted_text.decode()
     except Exception as e:
@@ -39,13 +92,124 @@ def decrypt_secret(encrypted_text, key):
     if not key:
         return None
     try:
-        cipher_suite = Fernet(key)
+        cipher_suite = _get_cipher(key)
         decrypted_text = cipher_suite.decrypt(encrypted_text.encode())
         return decrypted_text.decode()
     except Exception as e:
         print(f"Decryption error: {e}")
         return None
 
+# Batch variants for bulk migration jobs (None for items that fail)
+def encrypt_secrets(plain_texts, key):
+    return [encrypt_secret(text, key) for text in plain_texts]
+
+def decrypt_secrets(encrypted_texts, key):
+    return [decrypt_secret(text, key) for text in encrypted_texts]
+
+# Re-encrypt a token under the newest key (after adding a key to master.key)
+def rotate_secret(encrypted_text, key):
+    if not key:
+        return None
+    try:
+        cipher_suite = _get_cipher(key)
+        if not isinstance(cipher_suite, MultiFernet):
+            return encrypted_text
+        return cipher_suite.rotate(encrypted_text.encode()).decode()
+    except Exception as e:
+        print(f"Rotation error: {e}")
+        return None
+
+def rotate_secrets(encrypted_texts, key):
+    return [rotate_secret(text, key) for text in encrypted_texts]
+
+_verify_cache = OrderedDict()
+_verify_lock = threading.Lock()
+
+def _hmac_bases(key):
+    """HMAC base keys, newest first: the fingerprint.key lines, else the master keys"""
+    fingerprint_key = load_fingerprint_key()
+    return fingerprint_key.split() if fingerprint_key else _key_bytes(key).split()
+
+@lru_cache(maxsize=16)
+def _derive_key(key, purpose, index=0):
+    """Derive a purpose-specific HMAC key from the index-th base key (0 = newest)"""
+    return hmac.new(_hmac_bases(key)[index], purpose, hashlib.sha256).digest()
+
+def _derived_keys(key, purpose):
+    key = _key_bytes(key)
+    return [_derive_key(key, purpose, i) for i in range(len(_hmac_bases(key)))]
+
+def _secret_digest(plain_bytes, key):
+    return hmac.new(_derive_key(_key_bytes(key), b"verify-cache"), plain_bytes, hashlib.sha256).digest()
+
+# Keyed fingerprint of a card number: stable for a given fingerprint key, so it can be
+# stored and indexed next to the ciphertext and compared without decrypting
+def card_fingerprint(card_number, key):
+    if not key or not card_number:
+        return None
+    digits = "".join(ch for ch in card_number if ch.isdigit())
+    return hmac.new(_derive_key(_key_bytes(key), b"card-fingerprint"), digits.encode(),
+                    hashlib.sha256).hexdigest()
+
+# Fingerprints of a card number under every fingerprint key, newest first, so
+# rows written before a fingerprint key change keep matching until re-keyed
+def card_fingerprints(card_number, key):
+    if not key or not card_number:
+        return []
+    digits = "".join(ch for ch in card_number if ch.isdigit()).encode()
+    return [hmac.new(derived, digits, hashlib.sha256).hexdigest()
+            for derived in _derived_keys(key, b"card-fingerprint")]
+
+def match_card_fingerprint(fingerprint, card_number, key):
+    matched = False
+    for expected in card_fingerprints(card_number, key):
+        matched |= hmac.compare_digest(fingerprint or "", expected)
+    return matched
+
+# Salted, keyed CVV verifier stored as "salt$digest"
+def make_cvv_verifier(cvv, key):
+    if not key or not cvv:
+        return None
+    salt = secrets.token_hex(16)
+    digest = hmac.new(_derive_key(_key_bytes(key), b"cvv-verifier"), (salt + cvv).encode(),
+                      hashlib.sha256).hexdigest()
+    return f"{salt}${digest}"
+
+def check_cvv_verifier(verifier, cvv, key):
+    try:
+        salt, stored = verifier.split("$", 1)
+    except (AttributeError, ValueError):
+        return False
+    matched = False
+    for derived in _derived_keys(key, b"cvv-verifier"):
+        digest = hmac.new(derived, (salt + (cvv or "")).encode(), hashlib.sha256).hexdigest()
+        matched |= hmac.compare_digest(stored, digest)
+    return matched
+
+# Check a submitted value against a ciphertext in constant time. Only a keyed
+# digest of the plaintext is cached, so repeat checks of the same ciphertext
+# need no decrypt. Returns True/False, or None if the ciphertext can't be read.
+def verify_secret(encrypted_text, candidate, key):
+    if not key or not encrypted_text:
+        return None
+    candidate_digest = _secret_digest((candidate or "").encode(), key)
+    with _verify_lock:
+        stored_digest = _verify_cache.get(encrypted_text)
+        if stored_digest is not None:
+            _verify_cache.move_to_end(encrypted_text)
+    if stored_digest is None:
+        try:
+            plain_bytes = _get_cipher(key).decrypt(encrypted_text.encode())
+        except Exception as e:
+            print(f"Decryption error: {e}")
+            return None
+        stored_digest = _secret_digest(plain_bytes, key)
+        with _verify_lock:
+            _verify_cache[encrypted_text] = stored_digest
+            if len(_verify_cache) > VERIFY_CACHE_SIZE:
+                _verify_cache.popitem(last=False)
+    return hmac.compare_digest(stored_digest, candidate_digest)
+
 # Mask card number (show only last 4 digits)
 def mask_card(card_number):
     if not card_number or len(card_number) < 4:
@@ -72,6 +236,8 @@ if __name__ == "__main__":
     # Generate key if not exists
     if not load_master_key():
         generate_master_key()
+    if not load_fingerprint_key():
+        generate_fingerprint_key()
     
     # Test encryption
     key = load_master_key()
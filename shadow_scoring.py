@@ -0,0 +1,298 @@
+"""
+Shadow and canary scoring for a candidate model.
+
+With a candidate configured (SHADOW_MODEL_VERSION from the model registry, or
+SHADOW_MODEL_PATH), every payment (or a SHADOW_SAMPLE_RATE fraction of them)
+is queued after its commit and scored again off the request path by the
+model that did not make the decision: the candidate for regular traffic, the
+production model for canary users. Both scores and both decisions go to the
+shadow_scores table. The running score delta and the share of decisions that
+would flip are exported as metrics.
+
+CANARY_PERCENT routes that percentage of users, chosen by a stable hash of
+user_id and candidate version, to the candidate model for the live decision.
+
+    python shadow_scoring.py report     # per candidate: rows, mean delta, flip rate
+"""
+import os
+import sys
+import zlib
+import queue
+import random
+import logging
+import threading
+
+import metrics
+import fraud_detection_engine
+from fraud_detection_engine import safe_predict, finish_fraud_check
+from model_server import create_model_server
+from db_pool import get_pool
+
+SHADOW_MODEL_VERSION = os.environ.get('SHADOW_MODEL_VERSION')
+SHADOW_MODEL_PATH = os.environ.get('SHADOW_MODEL_PATH')
+SHADOW_SAMPLE_RATE = float(os.environ.get('SHADOW_SAMPLE_RATE', 1.0))
+CANARY_PERCENT = float(os.environ.get('CANARY_PERCENT', 0))
+SHADOW_WORKERS = int(os.environ.get('SHADOW_WORKERS', 1))  # candidate scoring processes
+SHADOW_QUEUE_SIZE = int(os.environ.get('SHADOW_QUEUE_SIZE', 10000))
+SHADOW_BATCH_ROWS = int(os.environ.get('SHADOW_BATCH_ROWS', 64))
+SHADOW_TIMEOUT = float(os.environ.get('SHADOW_TIMEOUT', 30))
+
+SHADOW_DECISIONS = metrics.Counter('shadow_decisions_total',
+                                   'Shadow-scored payments by candidate and production decision',
+                                   ('candidate', 'production'))
+SHADOW_DELTA = metrics.Histogram('shadow_score_delta', 'Absolute fraud score difference, candidate vs production',
+                                 (), buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0))
+
+INSERT_SHADOW_SCORE = """
+    INSERT INTO shadow_scores (transaction_id, user_id, canary,
+                               live_version, live_ml_score, live_fraud_score, live_status,
+                               shadow_version, shadow_ml_score, shadow_fraud_score, shadow_status)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+REPORT_QUERY = """
+    SELECT CASE WHEN canary THEN live_version ELSE shadow_version END AS candidate,
+           COUNT(*) AS scored,
+           AVG(CASE WHEN canary THEN live_fraud_score - shadow_fraud_score
+                    ELSE shadow_fraud_score - live_fraud_score END) AS mean_delta,
+           AVG(ABS(shadow_fraud_score - live_fraud_score)) AS mean_abs_delta,
+           SUM(CASE WHEN shadow_status <> live_status THEN 1 ELSE 0 END) AS flips,
+           SUM(CASE WHEN canary THEN 1 ELSE 0 END) AS canary
+    FROM shadow_scores
+    GROUP BY 1
+    ORDER BY 1
+"""
+
+
+def _candidate_from_env():
+    """(model path, version) of the configured candidate, or (None, None)."""
+    if SHADOW_MODEL_VERSION:
+        from model_registry import registry
+        model_version = registry.verify(registry.get(SHADOW_MODEL_VERSION))
+        return model_version.path, model_version.version
+    if SHADOW_MODEL_PATH:
+        return SHADOW_MODEL_PATH, os.path.basename(SHADOW_MODEL_PATH)
+    return None, None
+
+
+class ShadowScorer:
+    """Scores committed payments with the other model in background threads."""
+
+    def __init__(self, model_path=None, version=None, sample_rate=None, canary_percent=None,
+                 queue_size=None, batch_rows=None, server=None):
+        self.model_path = model_path
+        self.version = version
+        self.sample_rate = SHADOW_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.canary_percent = CANARY_PERCENT if canary_percent is None else canary_percent
+        self.batch_rows = batch_rows or SHADOW_BATCH_ROWS
+        self.server = server
+        self._queue = queue.Queue(maxsize=queue_size or SHADOW_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._started = False
+        self.metrics = self._new_metrics()
+
+    @staticmethod
+    def _new_metrics():
+        return {'queued': 0, 'scored': 0, 'flips': 0, 'dropped': 0, 'errors': 0, 'canary_fallbacks': 0,
+                'delta_sum': 0.0, 'abs_delta_sum': 0.0, 'abs_delta_max': 0.0}
+
+    @property
+    def enabled(self):
+        return self.model_path is not None
+
+    def start(self):
+        """Load the candidate (at app startup) and route canary users to it."""
+        if not self.enabled:
+            return self
+        if self.server is None:
+            self.server = create_model_server(model_path=self.model_path, size=SHADOW_WORKERS, version=self.version)
+        self.server.start()
+        if self.canary_percent > 0:
+            fraud_detection_engine.set_canary(self)
+        logging.info(f"Shadow scoring candidate {self.version} ({self.sample_rate:.0%} of payments, "
+                     f"{self.canary_percent}% canary)")
+        return self
+
+    def after_fork(self):
+        """Reset in a forked child: the parent's worker threads do not exist there."""
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._started = False
+        self.metrics = self._new_metrics()
+
+    def is_canary(self, user_id):
+        """Stable per user and candidate, so a user sees one model for the whole rollout."""
+        if not self.enabled or self.canary_percent <= 0:
+            return False
+        bucket = zlib.crc32(f"{self.version}:{user_id}".encode('utf-8')) % 10000
+        return bucket < self.canary_percent * 100
+
+    def predict(self, row):
+        """
+        (probability, version) from the candidate for one live canary row, or
+        (None, None) if it failed: the caller then lets the production model decide.
+        """
+        result = safe_predict([row], action='predict_proba', server=self.server)
+        if not result or 'predict_proba' not in result:
+            self._count('canary_fallbacks')
+            logging.warning(f"Candidate {self.version} failed on a canary row; using the production model")
+            return None, None
+        return result['predict_proba'][0][1], result.get('model_version') or self.version
+
+    def submit(self, transaction_id, user_id, fraud_result):
+        """Queue a committed payment (detect_fraud result) for shadow scoring; never blocks."""
+        if not self.enabled or 'check' not in fraud_result:
+            return False
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        if not self._started:
+            self._start_workers()
+        try:
+            self._queue.put_nowait((transaction_id, user_id, fraud_result))
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('queued')
+        return True
+
+    def _start_workers(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._work, name='shadow-scoring', daemon=True).start()
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.metrics[name] += value
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_rows:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._store(self._score(batch))
+            except Exception:
+                self._count('errors', len(batch))
+                logging.exception("Shadow scoring batch failed")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _score(self, batch):
+        """Score each payment with the model that did not decide it; returns rows to store."""
+        groups = {}
+        for item in batch:
+            canary = item[2].get('canary', False)
+            features = item[2]['check']['features']
+            groups.setdefault((canary, len(features)), []).append(item)
+        rows = []
+        for (canary, _), items in groups.items():
+            # Canary payments were decided by the candidate: compare with production
+            server = None if canary else self.server
+            result = safe_predict([item[2]['check']['features'] for item in items],
+                                  action='predict_proba', timeout=SHADOW_TIMEOUT, server=server)
+            if not result or 'predict_proba' not in result:
+                self._count('errors', len(items))
+                continue
+            version = result.get('model_version') or (None if canary else self.version)
+            for (transaction_id, user_id, live), probs in zip(items, result['predict_proba']):
+                shadow = finish_fraud_check(live['check'], probs[1], version)
+                rows.append(self._compare(transaction_id, user_id, canary, live, shadow))
+        return rows
+
+    def _compare(self, transaction_id, user_id, canary, live, shadow):
+        candidate, production = (live, shadow) if canary else (shadow, live)
+        delta = candidate['fraud_score'] - production['fraud_score']
+        flipped = candidate['status'] != production['status']
+        with self._lock:
+            self.metrics['scored'] += 1
+            self.metrics['flips'] += flipped
+            self.metrics['delta_sum'] += delta
+            self.metrics['abs_delta_sum'] += abs(delta)
+            self.metrics['abs_delta_max'] = max(self.metrics['abs_delta_max'], abs(delta))
+        SHADOW_DECISIONS.inc(candidate['status'], production['status'])
+        SHADOW_DELTA.observe(abs(delta))
+        return (transaction_id, user_id, canary,
+                live.get('model_version'), live['ml_score'], live['fraud_score'], live['status'],
+                shadow.get('model_version'), shadow['ml_score'], shadow['fraud_score'], shadow['status'])
+
+    def _store(self, rows):
+        if not rows:
+            return
+        conn = get_pool().connection()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany(INSERT_SHADOW_SCORE, rows)
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+    def wait(self):
+        """Block until everything queued so far has been handled (tests/shutdown)."""
+        self._queue.join()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+        scored = stats['scored']
+        stats['pending'] = self._queue.qsize()
+        stats['mean_delta'] = stats['delta_sum'] / scored if scored else 0.0
+        stats['mean_abs_delta'] = stats['abs_delta_sum'] / scored if scored else 0.0
+        stats['flip_rate'] = stats['flips'] / scored if scored else 0.0
+        return stats
+
+
+def _from_env():
+    try:
+        model_path, version = _candidate_from_env()
+    except Exception:
+        logging.exception("Shadow candidate not usable; shadow scoring disabled")
+        model_path, version = None, None
+    return ShadowScorer(model_path, version)
+
+
+shadow_scorer = _from_env()
+
+
+def report(cursor):
+    """Per-candidate comparison from the shadow_scores table."""
+    cursor.execute(REPORT_QUERY)
+    return cursor.fetchall()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] != ['report']:
+        print("usage: python shadow_scoring.py report", file=sys.stderr)
+        return 2
+    from db_pool import connect
+    try:
+        conn = connect()
+    except Exception as e:
+        print(f"Database connection failed: {e}", file=sys.stderr)
+        return 1
+    try:
+        try:
+            cursor = conn.cursor(dictionary=True)
+        except TypeError:
+            cursor = conn.cursor()  # PyMySQL: DictCursor set at connect
+        rows = report(cursor)
+    finally:
+        conn.close()
+    print(f"{'candidate':<20} {'scored':>8} {'mean_delta':>11} {'mean_abs':>9} {'flip_rate':>9} {'canary':>7}")
+    for row in rows:
+        scored = row['scored'] or 0
+        print(f"{str(row['candidate']):<20} {scored:>8} {float(row['mean_delta'] or 0):>11.4f} "
+              f"{float(row['mean_abs_delta'] or 0):>9.4f} {(row['flips'] or 0) / scored if scored else 0:>9.2%} "
+              f"{row['canary'] or 0:>7}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
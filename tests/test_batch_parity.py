@@ -0,0 +1,82 @@
+"""
+Offline replay (batch_scoring.score_chunk) must score rows the way the
+online path (prepare_fraud_check + finish_fraud_check) does.
+
+Run with: python -m pytest tests
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch_scoring
+from fraud_detection_engine import prepare_fraud_check, finish_fraud_check
+
+ML_PROB = 0.3
+LAST_SEEN = datetime.now() - timedelta(days=2)
+
+# (user_id, card_no, amount, location, ip, user_data, behavior_data)
+CASES = [
+    ('u-normal', '4111111111111111', 120.0, 'Mumbai', '10.0.0.1',
+     {'registered_ip': '10.0.0.1', 'current_card_limit': 50000.0},
+     {'total_transactions': 12, 'avg_spend': 100.0, 'usual_city': 'Mumbai',
+      'last_transaction_location': 'Mumbai', 'last_transaction_timestamp': LAST_SEEN}),
+    ('u-over-limit', '4111111111112222', 9000.0, 'Mumbai', '10.0.0.2',
+     {'registered_ip': '10.0.0.2', 'current_card_limit': 5000.0},
+     {'total_transactions': 8, 'avg_spend': 8000.0, 'usual_city': 'Mumbai',
+      'last_transaction_location': 'Mumbai', 'last_transaction_timestamp': LAST_SEEN}),
+    ('u-new-city', '4111111111113333', 4000.0, 'Delhi', '172.16.0.9',
+     {'registered_ip': '10.0.0.3', 'current_card_limit': 100000.0},
+     {'total_transactions': 5, 'avg_spend': 200.0, 'usual_city': 'Mumbai',
+      'last_transaction_location': 'Mumbai', 'last_transaction_timestamp': LAST_SEEN}),
+    ('u-first', '4111111111114444', 75.0, 'Pune', '10.0.0.4',
+     {'registered_ip': '10.0.0.4', 'current_card_limit': 50000.0},
+     {'total_transactions': 1, 'avg_spend': 75.0, 'usual_city': 'Pune',
+      'last_transaction_location': 'Pune', 'last_transaction_timestamp': LAST_SEEN}),
+]
+
+
+def online(case):
+    user_id, card_no, amount, location, ip, user_data, behavior_data = case
+    check = prepare_fraud_check(user_id, card_no, amount, location, ip, user_data, behavior_data)
+    return finish_fraud_check(check, ML_PROB)
+
+
+def batch_frame():
+    rows = []
+    for i, (user_id, card_no, amount, location, ip, user_data, behavior_data) in enumerate(CASES, 1):
+        rows.append({
+            'transaction_id': i, 'user_id': user_id, 'card_no_last4': card_no[-4:],
+            'amount': amount, 'transaction_location': location, 'transaction_ip': ip,
+            'timestamp': datetime.now(), **user_data, **behavior_data,
+        })
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture(scope='module')
+def scored():
+    return batch_scoring.score_chunk(batch_frame(), lambda matrix: np.full(len(matrix), ML_PROB))
+
+
+def test_batch_matches_online(scored):
+    for case, row in zip(CASES, scored.itertuples(index=False)):
+        expected = online(case)
+        assert row.method == expected['method'], case[0]
+        assert row.status == expected['status'], case[0]
+        assert row.bla_score == pytest.approx(expected['bla_score'], abs=1e-4), case[0]
+        assert row.fraud_score == pytest.approx(expected['fraud_score'], abs=1e-4), case[0]
+
+
+def test_spending_limit_fires_in_replay(scored):
+    by_user = scored.set_index('user_id')
+    assert by_user.loc['u-over-limit', 'spending_limit'] == 1
+    assert by_user.loc['u-normal', 'spending_limit'] == 0
+
+
+def test_query_selects_card_limit():
+    assert 'current_card_limit' in batch_scoring.TRANSACTIONS_QUERY
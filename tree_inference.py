@@ -0,0 +1,325 @@
+"""
+Compiled inference for tree-ensemble fraud models.
+
+A loaded binary classifier (scikit-learn RandomForest / ExtraTrees /
+DecisionTree / GradientBoosting, XGBClassifier, LGBMClassifier) is flattened
+into NumPy arrays: split feature, threshold and first child per node, plus
+leaf values. All trees of the ensemble are walked together, one level per
+step, so scoring one row costs a few array operations per tree level instead
+of a trip through the framework's predict_proba.
+
+Nodes are renumbered so each split's children sit next to each other; a
+step is then `node = left[node] + (x > threshold[node])` (`>=` for XGBoost,
+which sends `x < split` left). Leaves point to themselves with an infinite
+threshold, so every tree can be walked for the depth of the deepest one.
+
+The compiled model is only used if it reproduces the original predict_proba
+within TREE_INFERENCE_TOLERANCE on probe rows built around the model's own
+split points; anything else (multi-class, categorical splits, DART, custom
+init estimators ...) keeps the original model. Rows containing NaN or inf
+are passed to the original model, which knows its missing-value rules.
+
+Enabled with TREE_INFERENCE=1 in the model server workers, the in-process
+model (MODEL_SERVER=inprocess, prefork_server.py) and batch_scoring.py.
+"""
+import os
+import json
+import time
+import logging
+
+import numpy as np
+
+TREE_INFERENCE_TOLERANCE = float(os.environ.get('TREE_INFERENCE_TOLERANCE', 1e-5))
+TREE_INFERENCE_CHECK_ROWS = int(os.environ.get('TREE_INFERENCE_CHECK_ROWS', 512))
+
+
+class UnsupportedModel(ValueError):
+    """The model cannot be compiled; keep scoring with the original."""
+
+
+class CompiledForest:
+    """Flattened tree ensemble with the predict / predict_proba surface of the original."""
+
+    def __init__(self, model, feature, threshold, left, value, roots, depth,
+                 link='mean', strict=False, float32=False, intercept=0.0):
+        self.model = model
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        self.link = link
+        self.strict = strict
+        self.float32 = float32
+        self.intercept = intercept
+        self.n_features_in_ = int(model.n_features_in_)
+        self.classes_ = model.classes_
+        self.source = type(model).__name__
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def leaves(self, X):
+        """Leaf node index reached in every tree, shape (rows, trees)."""
+        n_rows, n_cols = X.shape
+        flat = X.ravel()
+        node = np.tile(self.roots, (n_rows, 1))
+        offset = (np.arange(n_rows) * n_cols)[:, None]
+        feature, threshold, left = self.feature, self.threshold, self.left
+        if self.strict:
+            for _ in range(self.depth):
+                node = left[node] + (flat[offset + feature[node]] >= threshold[node])
+        else:
+            for _ in range(self.depth):
+                node = left[node] + (flat[offset + feature[node]] > threshold[node])
+        return node
+
+    def raw(self, X):
+        """Sum of leaf values per row (the margin before the link function)."""
+        return self.value[self.leaves(X)].sum(axis=1)
+
+    def positive(self, X):
+        raw = self.raw(X)
+        if self.link == 'mean':
+            return raw / self.n_trees
+        return 1.0 / (1.0 + np.exp(-(raw + self.intercept)))
+
+    def prepare(self, X):
+        """X as the framework compares it: float32-rounded for scikit-learn and XGBoost."""
+        X = np.asarray(X, dtype=float)
+        return X.astype(np.float32).astype(float) if self.float32 else X
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=float)
+        if not np.isfinite(X).all():
+            return self.model.predict_proba(X)
+        p = self.positive(self.prepare(X))
+        return np.column_stack([1.0 - p, p])
+
+    def predict(self, X):
+        return self.classes_[(self.predict_proba(X)[:, 1] > 0.5).astype(int)]
+
+
+# ---------------------------------------------------------------------------
+# Flattening
+# ---------------------------------------------------------------------------
+
+def _sklearn_trees(model):
+    """(trees, link) for scikit-learn forests and gradient boosting."""
+    from sklearn.tree import DecisionTreeClassifier
+    from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier, GradientBoostingClassifier
+
+    if isinstance(model, GradientBoostingClassifier):
+        if getattr(model, 'n_classes_', None) != 2:
+            raise UnsupportedModel("only binary gradient boosting is supported")
+        estimators, link, scale = model.estimators_[:, 0], 'logistic', model.learning_rate
+    elif isinstance(model, (RandomForestClassifier, ExtraTreesClassifier)):
+        estimators, link, scale = model.estimators_, 'mean', 1.0
+    elif isinstance(model, DecisionTreeClassifier):
+        estimators, link, scale = [model], 'mean', 1.0
+    else:
+        raise UnsupportedModel(f"{type(model).__name__} is not a tree ensemble")
+    if link == 'mean' and (getattr(model, 'n_outputs_', 1) != 1 or len(model.classes_) != 2):
+        raise UnsupportedModel("only single-output binary classifiers are supported")
+
+    trees = []
+    for estimator in estimators:
+        tree = estimator.tree_
+        if link == 'mean':
+            counts = tree.value[:, 0, :]
+            value = counts[:, 1] / np.maximum(counts.sum(axis=1), 1e-300)
+        else:
+            value = tree.value[:, 0, 0] * scale
+        trees.append((tree.feature, tree.threshold, tree.children_left, tree.children_right, value))
+    return trees, link
+
+
+def _xgboost_trees(model):
+    booster = model.get_booster()
+    config = json.loads(booster.save_config())
+    objective = config['learner']['objective']['name']
+    if objective != 'binary:logistic':
+        raise UnsupportedModel(f"XGBoost objective {objective} is not supported")
+    missing = getattr(model, 'missing', np.nan)
+    if missing is not None and not np.isnan(missing):
+        raise UnsupportedModel("XGBoost models with a custom missing value are not supported")
+    learner = json.loads(bytes(booster.save_raw('json')))['learner']
+    gradient_booster = learner['gradient_booster']
+    if gradient_booster['name'] != 'gbtree':
+        raise UnsupportedModel(f"XGBoost booster {gradient_booster['name']} is not supported")
+    raw_trees = gradient_booster['model']['trees']
+    # predict_proba stops at the early-stopping iteration when there is one
+    indptr = gradient_booster['model'].get('iteration_indptr')
+    try:
+        best = model.best_iteration
+    except (AttributeError, ValueError):
+        best = None
+    if best is not None and indptr:
+        raw_trees = raw_trees[:indptr[best + 1]]
+
+    trees = []
+    for tree in raw_trees:
+        if any(tree.get('split_type', ())):
+            raise UnsupportedModel("XGBoost categorical splits are not supported")
+        left = np.asarray(tree['left_children'])
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32).astype(float)
+        value = np.where(left < 0, conditions, 0.0)  # leaves keep their weight in split_conditions
+        trees.append((np.asarray(tree['split_indices']), conditions, left,
+                      np.asarray(tree['right_children']), value))
+    return trees, 'logistic'
+
+
+def _lightgbm_trees(model):
+    booster = model.booster_
+    dump = booster.dump_model(num_iteration=booster.best_iteration or None)
+    objective = dump.get('objective', '').split()
+    if not objective or objective[0] != 'binary' or dump.get('num_class', 1) != 1:
+        raise UnsupportedModel(f"LightGBM objective {dump.get('objective')} is not supported")
+    sigmoid = 1.0
+    for option in objective[1:]:
+        if option.startswith('sigmoid:'):
+            sigmoid = float(option.split(':', 1)[1])
+
+    trees = []
+    for info in dump['tree_info']:
+        feature, threshold, left, right, value = [], [], [], [], []
+
+        def add(node):
+            index = len(feature)
+            feature.append(0)
+            threshold.append(0.0)
+            left.append(-1)
+            right.append(-1)
+            value.append(0.0)
+            if 'leaf_value' in node:
+                value[index] = node['leaf_value'] * sigmoid
+                return index
+            if node.get('decision_type') != '<=':
+                raise UnsupportedModel("LightGBM categorical splits are not supported")
+            if node.get('missing_type') == 'Zero':
+                raise UnsupportedModel("LightGBM zero-as-missing splits are not supported")
+            feature[index] = node['split_feature']
+            threshold[index] = float(node['threshold'])
+            left[index] = add(node['left_child'])
+            right[index] = add(node['right_child'])
+            return index
+
+        add(info['tree_structure'])
+        trees.append((np.asarray(feature), np.asarray(threshold), np.asarray(left),
+                      np.asarray(right), np.asarray(value)))
+    return trees, 'logistic'
+
+
+def _flatten(trees):
+    """Concatenate trees breadth-first with sibling children; returns arrays, roots and depth."""
+    feature, threshold, left, value, roots = [], [], [], [], []
+    depth = 0
+    for tree_feature, tree_threshold, tree_left, tree_right, tree_value in trees:
+        root = len(feature)
+        roots.append(root)
+        level, tree_depth = [0], 0
+        new_index = {0: root}
+        feature.append(0)
+        threshold.append(np.inf)
+        left.append(root)
+        value.append(0.0)
+        while level:
+            next_level = []
+            for old in level:
+                index = new_index[old]
+                if tree_left[old] < 0:
+                    value[index] = float(tree_value[old])
+                    continue
+                children = (int(tree_left[old]), int(tree_right[old]))
+                feature[index] = int(tree_feature[old])
+                threshold[index] = float(tree_threshold[old])
+                left[index] = len(feature)
+                for child in children:
+                    new_index[child] = len(feature)
+                    feature.append(0)
+                    threshold.append(np.inf)
+                    left.append(len(left))  # leaf until proven otherwise: points to itself
+                    value.append(0.0)
+                    next_level.append(child)
+            if next_level:
+                tree_depth += 1
+            level = next_level
+        depth = max(depth, tree_depth)
+    return (np.asarray(feature, dtype=np.intp), np.asarray(threshold, dtype=float),
+            np.asarray(left, dtype=np.intp), np.asarray(value, dtype=float),
+            np.asarray(roots, dtype=np.intp), depth)
+
+
+def _check_rows(compiled, n_rows, seed=0):
+    """Rows that land on both sides of the model's split points, plus the all-zero row."""
+    rng = np.random.default_rng(seed)
+    X = np.zeros((n_rows, compiled.n_features_in_))
+    split = np.isfinite(compiled.threshold)
+    for column in np.unique(compiled.feature[split]):
+        points = compiled.threshold[split & (compiled.feature == column)]
+        picked = rng.choice(points, n_rows)
+        X[:, column] = picked + rng.choice([-1.0, 1.0], n_rows) * (np.abs(picked) * 1e-3 + 1e-3)
+    X[0] = 0.0
+    return X
+
+
+def _median_ms(fn, rows, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(rows)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+def compile_model(model, tolerance=None, check_rows=None):
+    """A CompiledForest equivalent to `model`, or None if it cannot be compiled or does not match."""
+    tolerance = TREE_INFERENCE_TOLERANCE if tolerance is None else tolerance
+    name = type(model).__name__
+    try:
+        if getattr(model, 'n_features_in_', None) is None or not hasattr(model, 'predict_proba'):
+            raise UnsupportedModel("model has no n_features_in_ / predict_proba")
+        if hasattr(model, 'get_booster'):
+            trees, link = _xgboost_trees(model)
+            strict, float32 = True, True
+        elif hasattr(model, 'booster_'):
+            trees, link = _lightgbm_trees(model)
+            strict, float32 = False, False
+        elif type(model).__module__.startswith('sklearn.'):
+            trees, link = _sklearn_trees(model)
+            strict, float32 = False, True
+        else:
+            raise UnsupportedModel(f"{name} is not a supported tree ensemble")
+        if not trees:
+            raise UnsupportedModel("model has no trees")
+        feature, threshold, left, value, roots, depth = _flatten(trees)
+        compiled = CompiledForest(model, feature, threshold, left, value, roots, depth,
+                                  link=link, strict=strict, float32=float32)
+
+        X = _check_rows(compiled, check_rows or TREE_INFERENCE_CHECK_ROWS)
+        expected = np.asarray(model.predict_proba(X), dtype=float)[:, 1]
+        if link == 'logistic':
+            # Base score / init estimate: whatever the framework adds to the tree sum
+            usable = (expected > 1e-6) & (expected < 1 - 1e-6)
+            if not usable.any():
+                raise UnsupportedModel("no probe row with a usable probability to fit the base score")
+            margin = np.log(expected[usable] / (1 - expected[usable]))
+            compiled.intercept = float(np.median(margin - compiled.raw(compiled.prepare(X[usable]))))
+        error = float(np.max(np.abs(compiled.predict_proba(X)[:, 1] - expected)))
+        if error > tolerance:
+            raise UnsupportedModel(f"compiled scores differ by {error:.2e} (tolerance {tolerance:.0e})")
+    except UnsupportedModel as e:
+        logging.warning(f"Tree inference not used for {name}: {e}")
+        return None
+    except Exception:
+        logging.exception(f"Tree inference failed to compile {name}")
+        return None
+
+    row = X[:1]
+    logging.info(f"Compiled {name}: {compiled.n_trees} trees, {len(feature)} nodes, depth {depth}, "
+                 f"max error {error:.1e}; one row {_median_ms(compiled.predict_proba, row):.3f} ms "
+                 f"vs {_median_ms(model.predict_proba, row):.3f} ms")
+    return compiled
+
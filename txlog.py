@@ -0,0 +1,422 @@
+"""
+Write-behind log for transactions rows (TXLOG=1).
+
+The payment path commits only what the decision needs - the conditional
+card-limit debit and the behavior update - and appends the transactions row
+(scores, method, device, IP) to a local append-only file instead. A writer
+thread sends the queued rows to MySQL in multi-row INSERTs, one commit per
+batch, so the fsync MySQL does for each commit is shared by up to
+TXLOG_BATCH_ROWS payments and no longer sits on the request path. Payments
+that send an OTP are still written synchronously: verification needs their
+row in the database.
+
+Rows carry their transaction_id from the start: ids are reserved in blocks
+of TXLOG_ID_BLOCK from the transaction_ids table (migrations/
+004_transaction_ids.sql), so every process writing transactions must run
+with the same TXLOG setting.
+
+Each process appends to its own segment file in TXLOG_DIR, locked with
+flock while the process lives. A line is `<crc32> <json values>`; append()
+returns once the line is on disk (TXLOG_FSYNC, with concurrent appends
+sharing one fsync). Segments are removed once rotated and fully flushed.
+Segments left behind by a crashed or killed process are found by their
+released lock - at start() and every TXLOG_RECOVER_INTERVAL seconds - and
+replayed; rows that already reached MySQL are skipped by id.
+
+payment_dao appends a row after its debit succeeded and before the COMMIT,
+so every committed debit has its row on disk. If the process dies in
+between, or the COMMIT itself fails, the row is still written: it records
+a payment whose debit may have rolled back, never the other way round.
+This is a known gap: recover() does not reconcile such rows, as nothing
+records whether the debit committed.
+
+A batch MySQL rejects for its data (a value too long, out of range or
+invalid) is retried row by row, and the rows that fail again are moved to
+TXLOG_DEAD_LETTER as JSON lines with the error, so one bad row never holds
+up the rest of the log. Any other error retries the batch with backoff.
+"""
+import os
+import json
+import glob
+import time
+import zlib
+import fcntl
+import socket
+import logging
+import threading
+from collections import deque
+from datetime import date, datetime
+from decimal import Decimal
+
+from db_pool import get_pool
+from payment_dao import LOGGED_TRANSACTION_COLUMNS, insert_logged_transactions, reserve_transaction_ids
+
+TXLOG_ENABLED = os.environ.get('TXLOG', '0') == '1'
+TXLOG_DIR = os.environ.get('TXLOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'txlog'))
+TXLOG_FSYNC = os.environ.get('TXLOG_FSYNC', '1') == '1'
+TXLOG_BATCH_ROWS = int(os.environ.get('TXLOG_BATCH_ROWS', 500))
+TXLOG_FLUSH_MS = float(os.environ.get('TXLOG_FLUSH_MS', 20))  # wait for a batch to fill
+TXLOG_SEGMENT_BYTES = int(os.environ.get('TXLOG_SEGMENT_BYTES', 16 * 1024 * 1024))
+TXLOG_ID_BLOCK = int(os.environ.get('TXLOG_ID_BLOCK', 1000))
+TXLOG_RECOVER_INTERVAL = float(os.environ.get('TXLOG_RECOVER_INTERVAL', 60))
+TXLOG_RETRY_MAX = float(os.environ.get('TXLOG_RETRY_MAX', 10))  # seconds between flush retries
+TXLOG_DEAD_LETTER = os.environ.get('TXLOG_DEAD_LETTER', os.path.join(TXLOG_DIR, 'dead-letter.jsonl'))
+
+# MySQL errors caused by a row's values rather than by the server or connection:
+# bad null, out of range, truncated, bad datetime, bad value, too long
+DATA_ERRORS = (1048, 1264, 1265, 1292, 1366, 1406)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat(' ') if isinstance(value, datetime) else value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if hasattr(value, 'item'):
+        return value.item()  # numpy scalars
+    raise TypeError(f"{type(value).__name__} is not loggable")
+
+
+def encode(values):
+    body = json.dumps(values, default=_json_default, separators=(',', ':')).encode()
+    return b'%08x %s\n' % (zlib.crc32(body), body)
+
+
+def data_error(exc):
+    """Whether a driver exception is one of DATA_ERRORS (PyMySQL args[0], mysql.connector errno)."""
+    code = getattr(exc, 'errno', None)
+    if code is None and exc.args and isinstance(exc.args[0], int):
+        code = exc.args[0]
+    return code in DATA_ERRORS
+
+
+def decode(line):
+    """Values from one log line, or None for a torn or corrupt line."""
+    try:
+        crc, body = line.rstrip(b'\n').split(b' ', 1)
+        if int(crc, 16) != zlib.crc32(body):
+            return None
+        return tuple(json.loads(body))
+    except ValueError:
+        return None
+
+
+class _Segment:
+    """One log file, owned (flock) by the process appending to it."""
+
+    def __init__(self, path):
+        self.path = path
+        # Locked before it gets the name recover() looks for
+        self.fd = os.open(path + '.new', os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(path + '.new', path)
+        self.size = 0
+        self.pending = 0  # rows appended but not yet in MySQL
+        self.syncing = 0  # fsyncs in progress: the fd must stay open
+        self.sealed = False
+        self.closed = False
+
+
+class TxLog:
+    """Durable local queue of transactions rows, written to MySQL by a background thread."""
+
+    def __init__(self, enabled=None, directory=None, fsync=None, batch_rows=None, flush_ms=None,
+                 segment_bytes=None, id_block=None, recover_interval=None, dead_letter=None):
+        self.enabled = TXLOG_ENABLED if enabled is None else enabled
+        self.directory = directory or TXLOG_DIR
+        self.dead_letter = dead_letter or (os.path.join(directory, 'dead-letter.jsonl') if directory
+                                           else TXLOG_DEAD_LETTER)
+        self.fsync = TXLOG_FSYNC if fsync is None else fsync
+        self.batch_rows = batch_rows or TXLOG_BATCH_ROWS
+        self.flush_ms = TXLOG_FLUSH_MS if flush_ms is None else flush_ms
+        self.segment_bytes = segment_bytes or TXLOG_SEGMENT_BYTES
+        self.id_block = id_block or TXLOG_ID_BLOCK
+        self.recover_interval = recover_interval or TXLOG_RECOVER_INTERVAL
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._sync_lock = threading.Lock()
+        self._queue = deque()  # (values, segment) in append order
+        self._inflight = 0  # rows taken by the writer, not yet committed
+        self._segment = None
+        self._written = 0
+        self._synced = 0
+        self._ids = [0, 0]  # current block: next id, end (exclusive)
+        self._spare = None  # block reserved ahead by the writer
+        self._want_ids = False
+        self._started = False
+        self.metrics = {'appended': 0, 'flushed': 0, 'batches': 0, 'errors': 0,
+                        'recovered': 0, 'fsyncs': 0, 'dead_letters': 0}
+
+    def after_fork(self):
+        """Reset in a forked child: the parent's ids, segment and writer thread are not its own."""
+        self._reset()
+
+    def start(self):
+        """Replay segments left by dead processes and start the writer (at app startup)."""
+        if not self.enabled:
+            return self
+        with self._lock:
+            if self._started:
+                return self
+            self._started = True
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            self.recover()
+        except Exception:
+            logging.exception("Transaction log replay failed; retrying in the background")
+        threading.Thread(target=self._run, name='txlog-writer', daemon=True).start()
+        return self
+
+    # -- ids --------------------------------------------------------------
+
+    def take_id(self):
+        """Next pre-allocated transaction id, or None when none are left (reserve a block, add_ids)."""
+        with self._lock:
+            if self._ids[0] >= self._ids[1] and self._spare:
+                self._ids, self._spare = list(self._spare), None
+            next_id, end = self._ids
+            if next_id >= end:
+                return None
+            self._ids[0] = next_id + 1
+            if self._spare is None and end - next_id <= self.id_block // 4:
+                self._want_ids = True
+                self._wake.notify()
+            return next_id
+
+    def add_ids(self, first, end):
+        with self._lock:
+            if self._ids[0] >= self._ids[1]:
+                self._ids = [first, end]
+            else:
+                self._spare = (first, end)
+
+    # -- appending --------------------------------------------------------
+
+    def append(self, transaction):
+        """Log a transactions row (dict of LOGGED_TRANSACTION_COLUMNS); returns once it is durable."""
+        if not self._started:
+            self.start()
+        values = tuple(transaction.get(column) for column in LOGGED_TRANSACTION_COLUMNS)
+        line = encode(values)
+        with self._lock:
+            segment = self._open_segment(len(line))
+            os.write(segment.fd, line)
+            segment.size += len(line)
+            segment.pending += 1
+            self._written += 1
+            position = self._written
+            self._queue.append((values, segment))
+            self.metrics['appended'] += 1
+            self._wake.notify()
+        if self.fsync:
+            self._sync(position)
+
+    def _open_segment(self, size):
+        # Caller holds the lock
+        segment = self._segment
+        if segment is not None and segment.size and segment.size + size > self.segment_bytes:
+            if self.fsync:
+                os.fsync(segment.fd)
+            self._seal(segment)
+            segment = None
+        if segment is None:
+            name = f"{socket.gethostname()}-{os.getpid()}-{time.time_ns()}.log"
+            segment = self._segment = _Segment(os.path.join(self.directory, name))
+        return segment
+
+    def _seal(self, segment):
+        # Caller holds the lock
+        segment.sealed = True
+        if self._segment is segment:
+            self._segment = None
+        self._release(segment)
+
+    def _release(self, segment):
+        # Caller holds the lock. Unlink before closing, so the file is never unlocked on disk
+        if segment.sealed and segment.pending == 0 and segment.syncing == 0 and not segment.closed:
+            segment.closed = True
+            os.unlink(segment.path)
+            os.close(segment.fd)
+
+    def _sync(self, position):
+        """Group commit: one fsync covers every append made before it started."""
+        with self._sync_lock:
+            if self._synced >= position:
+                return
+            with self._lock:
+                segment, written = self._segment, self._written
+                # Keep the fd open while we fsync outside the lock (close() or a flush may seal it);
+                # a segment sealed before we got here was synced when it was sealed
+                if segment is not None:
+                    segment.syncing += 1
+            if segment is not None:
+                try:
+                    os.fsync(segment.fd)
+                finally:
+                    with self._lock:
+                        segment.syncing -= 1
+                        self._release(segment)
+            self._synced = written
+            with self._lock:
+                self.metrics['fsyncs'] += 1
+
+    # -- writing to MySQL ---------------------------------------------------
+
+    def _run(self):
+        delay = 0.0
+        recovered_at = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._queue and not self._want_ids:
+                    self._wake.wait(self.recover_interval)
+                want_ids, self._want_ids = self._want_ids, False
+                queued = len(self._queue)
+            if want_ids:
+                self._reserve_ids()
+            if 0 < queued < self.batch_rows and self.flush_ms > 0:
+                time.sleep(self.flush_ms / 1000)  # let a group build up
+            if not self._flush():
+                delay = min(max(delay * 2, 0.1), TXLOG_RETRY_MAX)
+                time.sleep(delay)
+                continue
+            delay = 0.0
+            if time.monotonic() - recovered_at >= self.recover_interval:
+                recovered_at = time.monotonic()
+                try:
+                    self.recover()
+                except Exception:
+                    logging.exception("Transaction log replay failed")
+
+    def _reserve_ids(self):
+        conn = None
+        try:
+            conn = get_pool().connection()
+            self.add_ids(*reserve_transaction_ids(conn, self.id_block))
+        except Exception:
+            logging.exception("Could not reserve transaction ids ahead")  # the next take_id asks again
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _insert(self, rows):
+        conn = get_pool().connection()
+        try:
+            insert_logged_transactions(conn, rows)
+        finally:
+            conn.close()
+
+    def _insert_or_dead_letter(self, rows):
+        """
+        Insert rows in one commit. If MySQL rejects their data, insert them one
+        by one and dead-letter those it rejects again. Other errors are raised.
+        """
+        try:
+            self._insert(rows)
+            return
+        except Exception as e:
+            if not data_error(e):
+                raise
+            logging.warning(f"Transaction log batch of {len(rows)} rows rejected ({e}); inserting row by row")
+        for values in rows:
+            try:
+                self._insert([values])
+            except Exception as e:
+                if not data_error(e):
+                    raise
+                self._dead_letter(values, e)
+
+    def _dead_letter(self, values, error):
+        record = {'error': str(error), 'values': dict(zip(LOGGED_TRANSACTION_COLUMNS, values))}
+        line = json.dumps(record, default=_json_default) + '\n'
+        os.makedirs(os.path.dirname(self.dead_letter) or '.', exist_ok=True)
+        with open(self.dead_letter, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self.metrics['dead_letters'] += 1
+        logging.error(f"Transaction {values[0]} rejected by MySQL ({error}); moved to {self.dead_letter}")
+
+    def _flush(self):
+        """Insert up to batch_rows queued rows in one commit; False if it failed (rows stay queued)."""
+        with self._lock:
+            batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.batch_rows))]
+            self._inflight = len(batch)
+        if not batch:
+            return True
+        try:
+            self._insert_or_dead_letter([values for values, _ in batch])
+        except Exception:
+            logging.exception(f"Transaction log flush of {len(batch)} rows failed; will retry")
+            with self._lock:
+                self._queue.extendleft(reversed(batch))
+                self._inflight = 0
+                self.metrics['errors'] += 1
+            return False
+        with self._lock:
+            for _, segment in batch:
+                segment.pending -= 1
+                self._release(segment)
+            self._inflight = 0
+            self.metrics['flushed'] += len(batch)
+            self.metrics['batches'] += 1
+        return True
+
+    def recover(self):
+        """Replay segments whose owner is gone, then remove them. Returns the rows replayed."""
+        replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.log'))):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # still being written
+                with os.fdopen(os.dup(fd), 'rb') as f:
+                    rows = [values for values in map(decode, f) if values is not None]
+                for i in range(0, len(rows), self.batch_rows):
+                    self._insert_or_dead_letter(rows[i:i + self.batch_rows])
+                os.unlink(path)
+                replayed += len(rows)
+                logging.info(f"Replayed {len(rows)} transactions from {path}")
+            finally:
+                os.close(fd)
+        with self._lock:
+            self.metrics['recovered'] += replayed
+        return replayed
+
+    def wait(self, timeout=None):
+        """Block until every row appended so far is in MySQL (tests/shutdown). False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if not self._queue and not self._inflight:
+                    return True
+                self._wake.notify()
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def close(self, timeout=10):
+        """Flush and remove this process's log (clean shutdown); anything left is replayed later."""
+        if not self._started or not self.wait(timeout):
+            return
+        with self._lock:
+            if self._segment is not None:
+                self._seal(self._segment)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+            stats['pending'] = len(self._queue)
+            stats['ids_left'] = max(self._ids[1] - self._ids[0], 0)
+        return stats
+
+
+txlog = TxLog()